@@ -0,0 +1,118 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from Simplifier import EARTH_RADIUS
+
+
+def haversine(longitudes1, latitudes1, longitudes2, latitudes2):
+    '''Great circle distance in metres between arrays of points given in degrees'''
+    lon1, lat1, lon2, lat2 = (np.radians(a) for a in (longitudes1, latitudes1, longitudes2, latitudes2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def _fill(values):
+    '''Replaces NaNs with the previous value, leading ones with the first value which is not NaN'''
+    known = ~np.isnan(values)
+    if not known.any():
+        return values
+    index = np.maximum.accumulate(np.where(known, np.arange(len(values)), 0))
+    filled = values[index]
+    filled[:np.argmax(known)] = values[np.argmax(known)]
+    return filled
+
+
+class Analysis(object):
+    '''Derived metrics of a track.
+
+    Per track point arrays: cumulative `distance` (metres), noise filtered `elevation` (metres) and `grade` (percent,
+    NaN where the point moved less than `Analyzer.MIN_GRADE_DISTANCE`). `laps` holds totals of every lap.
+    '''
+
+    def __init__(self, distance, elevation, grade, laps):
+        self.distance = distance
+        self.elevation = elevation
+        self.grade = grade
+        self.laps = laps
+
+    def summary(self):
+        '''Totals of the whole track and of every lap, e.g. for JSON'''
+        total = OrderedDict([('distance', 0.0), ('ascent', 0.0), ('descent', 0.0)])
+        for lap in self.laps:
+            for key in total:
+                total[key] += lap[key]
+        total = OrderedDict((k, round(v, 1)) for k, v in total.items())
+        total['laps'] = self.laps
+        return total
+
+
+class Analyzer(object):
+    '''Computes `Analysis` of a track with NumPy, in time linear in the number of track points.
+
+    Elevations are smoothed by a centred moving average over `smoothing` track points before computing grades
+    and ascent/descent, so that noise of the elevation source does not add up.
+    '''
+    SMOOTHING = 5
+    MIN_GRADE_DISTANCE = 1
+
+    def __init__(self, smoothing=SMOOTHING):
+        self.smoothing = max(int(smoothing), 1)
+
+    def analyze_store(self, store, coordinates, lap_starts=(0,)):
+        '''Analysis of track points of a `TrackStore` with altitudes from `coordinates`'''
+        indices = np.frombuffer(store.indices, dtype=np.int32)
+        known = indices >= 0
+        longitudes, latitudes, elevations = (np.full(len(indices), np.nan) for _ in range(3))
+        longitudes[known] = np.frombuffer(store.longitudes, dtype=np.float64)[indices[known]]
+        latitudes[known] = np.frombuffer(store.latitudes, dtype=np.float64)[indices[known]]
+        heights = np.array([np.nan if h is None else h for h in store.altitudes(coordinates)], dtype=np.float64)
+        elevations[known] = heights[indices[known]]
+        return self.analyze(longitudes, latitudes, elevations, lap_starts)
+
+    def analyze(self, longitudes, latitudes, elevations, lap_starts=(0,)):
+        '''Analysis of track points given as arrays, NaN where a point has no position or elevation'''
+        longitudes, latitudes, elevations = (np.asarray(a, dtype=np.float64) for a in
+                                             (longitudes, latitudes, elevations))
+        segments = np.zeros(len(longitudes))
+        positioned = np.flatnonzero(~np.isnan(longitudes) & ~np.isnan(latitudes))
+        segments[positioned[1:]] = haversine(longitudes[positioned[:-1]], latitudes[positioned[:-1]],
+                                             longitudes[positioned[1:]], latitudes[positioned[1:]])
+        elevation = self._smooth(_fill(elevations))
+        rises = np.zeros(len(elevation))
+        rises[1:] = np.diff(elevation)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            grade = np.where(segments >= self.MIN_GRADE_DISTANCE, 100 * rises / segments, np.nan)
+        rises = np.nan_to_num(rises)
+        return Analysis(np.cumsum(segments), elevation, grade, self._laps(segments, rises, elevation, lap_starts))
+
+    def _smooth(self, values):
+        if self.smoothing < 2 or not len(values):
+            return values
+        sums = np.concatenate([[0], np.cumsum(values)])
+        positions = np.arange(len(values))
+        low = np.clip(positions - self.smoothing // 2, 0, len(values))
+        high = np.clip(positions + (self.smoothing + 1) // 2, 0, len(values))
+        return (sums[high] - sums[low]) / (high - low)
+
+    def _laps(self, segments, rises, elevation, lap_starts):
+        if not len(segments):
+            return []
+        starts = np.unique(np.concatenate([[0], np.asarray(lap_starts, dtype=np.int64)]))
+        starts = starts[(starts >= 0) & (starts < len(segments))]
+        # the first point of a lap continues from the last point of the previous one
+        distances = np.add.reduceat(segments, starts)
+        ascents = np.add.reduceat(np.maximum(rises, 0), starts)
+        descents = np.add.reduceat(np.maximum(-rises, 0), starts)
+        ends = np.append(starts[1:], len(segments))
+        laps = []
+        for start, end, distance, ascent, descent in zip(starts.tolist(), ends.tolist(), distances.tolist(),
+                                                         ascents.tolist(), descents.tolist()):
+            lap_elevation = elevation[start:end]
+            known = not np.isnan(lap_elevation).all()
+            laps.append(OrderedDict([
+                ('start', start), ('points', end - start), ('distance', round(distance, 1)),
+                ('ascent', round(ascent, 1)), ('descent', round(descent, 1)),
+                ('min_elevation', round(float(np.nanmin(lap_elevation)), 1) if known else None),
+                ('max_elevation', round(float(np.nanmax(lap_elevation)), 1) if known else None)]))
+        return laps
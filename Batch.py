@@ -0,0 +1,165 @@
+import glob
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from Enhancer import Enhancer
+from Streams import EXTENSIONS
+from utils import _extension, _output_name
+
+
+def find_inputs(source, output_dir):
+    '''Returns list of (input, output) pairs described by `source`.
+
+    `source` is a directory (all TCX/GPX/ttbin files in it, compressed too), a glob pattern or a manifest file listing
+    one input per line, optionally followed by its output path. Outputs default to `output_dir`
+    with the input's file name (.tcx for .ttbin inputs).
+    '''
+    if os.path.isdir(source):
+        inputs = sorted(os.path.join(source, name) for name in os.listdir(source)
+                        if _extension(name) in EXTENSIONS)
+    elif os.path.isfile(source) and _extension(source) not in EXTENSIONS:
+        pairs = []
+        with open(source) as manifest:
+            for line in manifest:
+                fields = line.split()
+                if fields and not fields[0].startswith('#'):
+                    pairs.append((fields[0], fields[1] if len(fields) > 1 else None))
+        return [(i, o or os.path.join(output_dir, _output_name(os.path.basename(i)))) for i, o in pairs]
+    else:
+        inputs = sorted(glob.glob(source))
+    return [(i, os.path.join(output_dir, _output_name(os.path.basename(i)))) for i in inputs]
+
+
+def _serve(connection, format, options):
+    '''Worker process: parses files, keeps them until their altitudes come, then writes them'''
+    enhancers = {}
+    for kind, index, payload in iter(connection.recv, None):
+        try:
+            if kind == 'parse':
+                input, output = payload
+                enhancer = Enhancer(input, output, None, format=format, **options)
+                enhancer.parse()
+                enhancers[index] = enhancer
+                result = enhancer.coordinates
+            else:
+                enhancer = enhancers.pop(index)
+                # heights of the file's own points, in their order
+                enhancer.coordinates.update(zip(list(enhancer.coordinates), payload))
+                if enhancer._check_thresholds() < enhancer.error_threshold:
+                    # with a valid sidecar the document is parsed, and altitudes set on it, only by `write`
+                    enhancer._append_altitudes()
+                enhancer.write()
+                result = None
+        except Exception as e:
+            # not every exception can be pickled (lxml's XMLSyntaxError can not), its message is what matters
+            result = ValueError(str(e))
+        connection.send((index, result))
+
+
+class BatchEnhancer(object):
+    '''Enhances many files at once.
+
+    Files are parsed by worker processes, which keep them, coordinates of all of them are merged and
+    fetched together, then the workers set altitudes and write their files. A failure of one file
+    does not affect the others, see `failures` after `run`.
+    '''
+
+    def __init__(self, pairs, api_key, format='guess', processes=None, streaming=False, **kwargs):
+        self.pairs = pairs
+        self.format = format
+        self.processes = processes
+        self.streaming = streaming
+        # options of the enhancers reading and writing files in worker processes
+        self.options = dict(streaming=streaming, incremental=kwargs.get('incremental', False),
+                            sidecar=kwargs.pop('sidecar', False))
+        self.enhancer = Enhancer(None, None, api_key, format='tcx', **kwargs)
+        self.metrics = self.enhancer.metrics
+        self.coordinates = OrderedDict()
+        self.failures = OrderedDict()
+        self.enhanced = []
+
+    def run(self):
+        workers = self._start(min(self.processes or os.cpu_count(), len(self.pairs)))
+        try:
+            assigned = self._assign(len(workers))
+            with self.metrics.stage('parse'):
+                parsed = self._run(workers, assigned, [('parse', i, pair) for i, pair in enumerate(self.pairs)])
+            for points in parsed.values():
+                for k, v in points.items():
+                    if self.coordinates.get(k) is None:
+                        self.coordinates[k] = v
+            self.enhancer.coordinates = self.coordinates
+            self.enhancer.fetch_altitudes()
+            # only heights go back, workers have the points already
+            jobs = [('write', i, [self.coordinates[k] for k in points]) for i, points in parsed.items()]
+            with self.metrics.stage('write'):
+                self.enhanced = [self.pairs[i][0] for i in self._run(workers, assigned, jobs)]
+        finally:
+            self._stop(workers)
+        if self.enhancer.checkpoint is not None and not self.failures:
+            self.enhancer.checkpoint.remove()
+        self._report()
+        return not self.failures
+
+    def _assign(self, count):
+        '''Worker of every file, the largest ones go first to the least loaded worker'''
+        sizes = [os.path.getsize(i) if os.path.isfile(i) else 0 for i, _ in self.pairs]
+        loads = [0] * count
+        assigned = [0] * len(self.pairs)
+        for i in sorted(range(len(self.pairs)), key=lambda i: -sizes[i]):
+            worker = loads.index(min(loads))
+            assigned[i] = worker
+            loads[worker] += sizes[i]
+        return assigned
+
+    def _start(self, count):
+        workers = []
+        for _ in range(count):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve, args=(child, self.format, self.options), daemon=True)
+            process.start()
+            child.close()
+            workers.append((process, connection))
+        return workers
+
+    def _stop(self, workers):
+        for process, connection in workers:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process, connection in workers:
+            process.join()
+            connection.close()
+
+    def _run(self, workers, assigned, jobs):
+        '''Runs jobs on their workers, returns OrderedDict of results of successful ones by file index in order
+        of jobs, failures are recorded by input name'''
+        results = {}
+
+        def serve(worker):
+            # one job at a time, so that neither side blocks on a full pipe
+            connection = workers[worker][1]
+            for job in jobs:
+                if assigned[job[1]] == worker:
+                    connection.send(job)
+                    index, results[index] = connection.recv()
+
+        if workers:
+            with ThreadPoolExecutor(len(workers)) as executor:
+                list(executor.map(serve, range(len(workers))))
+        succeeded = OrderedDict()
+        for _, index, _ in jobs:
+            if isinstance(results[index], Exception):
+                self.failures[self.pairs[index][0]] = str(results[index])
+            else:
+                succeeded[index] = results[index]
+        return succeeded
+
+    def _report(self):
+        print('[INFO]: {} files enhanced, {} failed, {} unique points'.format(
+            len(self.enhanced), len(self.failures), len(self.coordinates)))
+        for input, error in self.failures.items():
+            print('[ERROR]: {}: {}'.format(input, error))
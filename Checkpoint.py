@@ -0,0 +1,50 @@
+import json
+import os
+
+
+class Checkpoint(object):
+    '''Journal of resolved altitudes, so an interrupted run can resume where it stopped.
+
+    Every resolved chunk is appended as one JSON line of [longitude, latitude, height] triples and flushed
+    to disk. A line cut short by a crash is ignored when loading. Heights depend only on coordinates, so
+    a checkpoint can safely be loaded for any input.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def load(self):
+        '''Returns dict of heights of all points stored so far'''
+        heights = {}
+        if not os.path.exists(self.path):
+            return heights
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    heights.update(((lon, lat), h) for lon, lat, h in json.loads(line))
+                except (ValueError, TypeError):
+                    continue
+        return heights
+
+    def append(self, altitudes):
+        '''Stores (point, height) pairs, skipping unknown heights'''
+        rows = [[p[0], p[1], h] for p, h in altitudes if h is not None]
+        if not rows:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(json.dumps(rows) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        '''Drops the checkpoint once the output is written'''
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
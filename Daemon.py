@@ -0,0 +1,210 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import queue
+import select
+import signal
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+from Enhancer import Enhancer
+from Fetcher import Fetcher
+from Metrics import Metrics
+from Streams import EXTENSIONS, split_compression
+from utils import _extension, _output_name
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    '''Accepts a single JSON line {"input": ..., "output": ..., "format": ...} and answers with a JSON line'''
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline().decode('utf-8'))
+            self.server.enhancer_daemon.submit(job['input'], job.get('output'), job.get('format'))
+            reply = {'queued': True}
+        except queue.Full:
+            reply = {'queued': False, 'error': 'queue is full'}
+        except (ValueError, KeyError, TypeError) as e:
+            reply = {'queued': False, 'error': 'invalid job: {}'.format(e)}
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+class _JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Inotify(object):
+    '''Minimal ctypes binding of Linux inotify, reporting files written or moved into a directory'''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def read(self, timeout):
+        '''Returns names of files finished within `timeout` seconds'''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            names.append(os.fsdecode(data[offset:offset + length].rstrip(b'\x00')))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller(object):
+    '''Fallback for `Inotify`, reports files whose size and mtime did not change between two scans'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.seen = self._scan()
+        self.candidates = {}
+
+    def _scan(self):
+        return dict((e.name, (e.stat().st_size, e.stat().st_mtime)) for e in os.scandir(self.directory) if e.is_file())
+
+    def read(self, timeout):
+        time.sleep(timeout)
+        current = self._scan()
+        names = [n for n, stat in current.items() if self.seen.get(n) != stat and self.candidates.get(n) == stat]
+        self.candidates = dict((n, stat) for n, stat in current.items() if self.seen.get(n) != stat)
+        for n in names:
+            self.seen[n] = current[n]
+            del self.candidates[n]
+        return names
+
+    def close(self):
+        pass
+
+
+class EnhancerDaemon(object):
+    '''Long running enhancer.
+
+    Jobs come from a Unix socket (see `EnhancerClient`) and/or from a watched directory and are processed
+    by `jobs` worker threads. All jobs share one `Fetcher` (so its connection pool and rate limit), cache
+    and provider, as well as `metrics`. At most `queue_size` jobs wait in the queue, further ones are refused.
+    '''
+    JOBS = 2
+    QUEUE_SIZE = 100
+    POLL_INTERVAL = 1
+
+    def __init__(self, api_key, output_dir=None, format='guess', streaming=False, jobs=JOBS, queue_size=QUEUE_SIZE,
+                 **options):
+        self.api_key = api_key
+        self.output_dir = output_dir
+        self.format = format
+        self.streaming = streaming
+        self.metrics = options.pop('metrics', None) or Metrics()
+        self.fetcher = Fetcher(workers=options.pop('workers', Fetcher.WORKERS), rate=options.pop('rate', Fetcher.RATE),
+                               metrics=self.metrics)
+        self.options = options
+        self.queue = queue.Queue(queue_size)
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(jobs)]
+        self.server = None
+
+    def _output(self, input):
+        if self.output_dir:
+            return os.path.join(self.output_dir, _output_name(os.path.basename(input)))
+        output = _output_name(input)
+        uncompressed = split_compression(output)[0]
+        base, extension = os.path.splitext(uncompressed)
+        return '{}.out{}{}'.format(base, extension, output[len(uncompressed):])
+
+    def submit(self, input, output=None, format=None):
+        self.queue.put_nowait((input, output or self._output(input), format or self.format))
+
+    def enhance(self, input, output, format):
+        enhancer = Enhancer(input, output, self.api_key, format=format, streaming=self.streaming,
+                            fetcher=self.fetcher, metrics=self.metrics, **self.options)
+        enhancer.enhance()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self.enhance(*job)
+                self.metrics.count('files_enhanced')
+                print('[INFO]: {} enhanced into {}'.format(job[0], job[1]))
+            except Exception as e:
+                self.metrics.count('files_failed')
+                print('[ERROR]: {}: {}'.format(job[0], e))
+            finally:
+                self.queue.task_done()
+
+    def start(self, socket_path=None, watch_dir=None, poll=False):
+        for thread in self.threads:
+            thread.start()
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self.server = _JobServer(socket_path, _JobHandler)
+            self.server.enhancer_daemon = self
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if watch_dir:
+            watcher = self._watcher(watch_dir, poll)
+            threading.Thread(target=self._watch, args=(watch_dir, watcher), daemon=True).start()
+
+    def _watcher(self, directory, poll):
+        if not poll:
+            try:
+                return Inotify(directory)
+            except (OSError, AttributeError):
+                print('[WARNING]: inotify not available, polling {}'.format(directory))
+        return Poller(directory)
+
+    def _watch(self, directory, watcher):
+        try:
+            while not self.stopped.is_set():
+                for name in watcher.read(self.POLL_INTERVAL):
+                    if _extension(name) in EXTENSIONS:
+                        try:
+                            self.submit(os.path.join(directory, name))
+                        except queue.Full:
+                            print('[ERROR]: queue is full, skipping {}'.format(name))
+        finally:
+            watcher.close()
+
+    def stop(self):
+        '''Stops accepting jobs and waits for queued ones to finish'''
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            os.unlink(self.server.server_address)
+        running = [thread for thread in self.threads if thread.is_alive()]
+        for _ in running:
+            self.queue.put(None)
+        for thread in running:
+            thread.join()
+
+    def run(self, socket_path=None, watch_dir=None, poll=False):
+        self.start(socket_path, watch_dir, poll)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
@@ -0,0 +1,184 @@
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from ElevationProvider import ElevationProvider
+from Metrics import Metrics
+
+
+class ServiceStats(object):
+    '''Latencies and outcomes of the last `WINDOW` requests sent to a service'''
+    WINDOW = 50
+    MIN_SAMPLES = 10
+    MAX_ERROR_RATE = 0.5
+    # an unhealthy service gets a request again after this many seconds, so that it may recover
+    PROBE_AFTER = 30
+
+    def __init__(self):
+        self.latencies = deque(maxlen=self.WINDOW)
+        self.outcomes = deque(maxlen=self.WINDOW)
+        self.failed_at = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds, ok):
+        with self.lock:
+            self.outcomes.append(ok)
+            if ok:
+                self.latencies.append(seconds)
+            else:
+                self.failed_at = time.monotonic()
+
+    @property
+    def latency(self):
+        '''Median latency, 0 for a service not asked yet so that it gets tried'''
+        with self.lock:
+            return statistics.median(self.latencies) if self.latencies else 0
+
+    @property
+    def p95(self):
+        '''95th percentile of latency, None until there are `MIN_SAMPLES` of them'''
+        with self.lock:
+            if len(self.latencies) < self.MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(int(0.95 * len(ordered)), len(ordered) - 1)]
+
+    @property
+    def error_rate(self):
+        with self.lock:
+            return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0
+
+    def healthy(self):
+        return self.error_rate <= self.MAX_ERROR_RATE or time.monotonic() - self.failed_at > self.PROBE_AFTER
+
+
+class HedgedDispatcher(ElevationProvider):
+    '''Spreads chunks of points over several `ElevationService`s to cut tail latency.
+
+    Every chunk goes to the healthy service with the lowest median latency. When it takes longer than the 95th
+    percentile of that service's latency (`hedge_after` seconds until enough requests were seen), a duplicate is
+    sent to the next service, and when a service fails the next one is asked straight away. `policy` decides
+    which heights win:
+
+    - `first`: heights of the first answer, points it misses are taken from other answers already received;
+    - `priority`: heights of the service listed first in `services`;
+    - `median`: median of the heights answered for each point.
+
+    With `priority` and `median` a hedged chunk waits up to another `hedge_after` seconds for the outstanding
+    answer, so that there is something to choose from.
+    '''
+    POLICIES = ('first', 'priority', 'median')
+    WORKERS = 4
+    HEDGE_AFTER = 2.0
+    # heights differing more than this many metres count as a disagreement
+    TOLERANCE = 5
+
+    def __init__(self, services, policy='first', workers=WORKERS, hedge_after=HEDGE_AFTER, chunk_size=None,
+                 metrics=None):
+        if not services:
+            raise ValueError('no elevation services to dispatch to')
+        if policy not in self.POLICIES:
+            raise ValueError('unknown policy {}, known are: {}'.format(policy, ', '.join(self.POLICIES)))
+        self.services = list(services)
+        self.policy = policy
+        self.workers = max(workers, 1)
+        self.hedge_after = hedge_after
+        self.chunk_size = chunk_size or min(s.MAX_POINTS for s in self.services)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.stats = dict((id(s), ServiceStats()) for s in self.services)
+
+    def get_heights(self, points):
+        chunks = [points[i:i + self.chunk_size] for i in range(0, len(points), self.chunk_size)]
+        heights = []
+        # chunk workers wait on requests run by a separate pool, losing requests are not waited for
+        requests_pool = ThreadPoolExecutor(2 * self.workers)
+        try:
+            with ThreadPoolExecutor(self.workers) as executor:
+                for chunk_heights in executor.map(lambda chunk: self._dispatch(requests_pool, chunk), chunks):
+                    heights.extend(chunk_heights)
+        finally:
+            requests_pool.shutdown(wait=False)
+        return heights
+
+    def _rank(self):
+        '''Services to ask in order, healthy ones first, faster ones first'''
+        return sorted(self.services, key=lambda s: (not self.stats[id(s)].healthy(), self.stats[id(s)].latency))
+
+    def _metric(self, service, name):
+        return 'service_{}_{}'.format(service.NAME.replace('-', '_'), name)
+
+    def _fetch(self, service, points):
+        start = time.perf_counter()
+        try:
+            heights = service.fetch(points)
+        except Exception as e:
+            # any failure of one service (e.g. an answer of unexpected shape) falls over to the next one
+            print('[WARNING]: {}: {!r}'.format(service.NAME, e))
+            heights = None
+        seconds = time.perf_counter() - start
+        self.stats[id(service)].record(seconds, heights is not None)
+        self.metrics.count(self._metric(service, 'requests'))
+        if heights is None:
+            self.metrics.count(self._metric(service, 'errors'))
+        else:
+            self.metrics.observe(self._metric(service, 'seconds'), seconds)
+        return heights
+
+    def _dispatch(self, pool, points):
+        ranked = iter(self._rank())
+        primary = next(ranked)
+        pending = {pool.submit(self._fetch, primary, points): primary}
+        timeout = self.stats[id(primary)].p95 or self.hedge_after
+        hedged = False
+        answers = []
+        while pending and not answers:
+            done, _ = wait(pending, timeout=None if hedged else timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # slower than usual, ask another service too
+                if self._submit(pool, ranked, points, pending):
+                    self.metrics.count('hedged_requests')
+                hedged = True
+                continue
+            for future in done:
+                service = pending.pop(future)
+                if future.result() is None:
+                    # failed, fall over to the next service
+                    self._submit(pool, ranked, points, pending)
+                else:
+                    answers.append((service, future.result()))
+        if not answers:
+            self.metrics.count('failed_chunks')
+            return [None] * len(points)
+        if pending and self.policy != 'first':
+            done, _ = wait(pending, timeout=self.hedge_after)
+            answers.extend((pending[f], f.result()) for f in done if f.result() is not None)
+        if hedged and answers[0][0] is not primary:
+            self.metrics.count('hedge_wins')
+        return self._merge(answers)
+
+    def _submit(self, pool, ranked, points, pending):
+        service = next(ranked, None)
+        if service is None:
+            return False
+        pending[pool.submit(self._fetch, service, points)] = service
+        return True
+
+    def _merge(self, answers):
+        '''Heights of points chosen by `policy` out of (service, heights) answers, in order of arrival'''
+        if self.policy == 'priority':
+            answers.sort(key=lambda a: self.services.index(a[0]))
+        merged = []
+        for values in zip(*(heights for _, heights in answers)):
+            known = [h for h in values if h is not None]
+            if known and max(known) - min(known) > self.TOLERANCE:
+                self.metrics.count('disagreements')
+            if not known:
+                merged.append(None)
+            elif self.policy == 'median':
+                median = statistics.median(known)
+                merged.append(int(median) if median == int(median) else round(median, 1))
+            else:
+                merged.append(known[0])
+        return merged
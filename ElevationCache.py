@@ -0,0 +1,90 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ElevationCache(object):
+    '''Persistent SQLite cache of heights keyed by normalized (longitude, latitude) tuples.
+
+    The database can be shared by several processes, and an instance by several threads. When it grows over
+    `max_size` entries the least recently used ones are evicted. `hits` and `misses` count lookups made
+    through this instance.
+    '''
+    MAX_SIZE = 1000000
+    TIMEOUT = 30
+    # number of points per statement, keeps the number of SQL variables under SQLite's limit
+    BATCH_SIZE = 400
+
+    def __init__(self, path, max_size=MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, timeout=self.TIMEOUT, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # height has no type, so integer heights come back as integers, written the same as fetched ones
+        self.connection.execute('CREATE TABLE IF NOT EXISTS heights (lon REAL NOT NULL, lat REAL NOT NULL, '
+                                'height NOT NULL, used REAL NOT NULL, PRIMARY KEY (lon, lat)) WITHOUT ROWID')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS heights_used ON heights (used)')
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM heights').fetchone()[0]
+
+    def _batches(self, _list):
+        for i in range(0, len(_list), self.BATCH_SIZE):
+            yield _list[i:i+self.BATCH_SIZE]
+
+    def get(self, points):
+        '''Returns dict of heights for those of `points` which are in the cache'''
+        points = [p for p in points if None not in p]
+        found = {}
+        with self._transaction():
+            now = time.time()
+            for batch in self._batches(points):
+                values = ','.join(['(?,?)'] * len(batch))
+                params = [x for p in batch for x in p]
+                rows = self.connection.execute('SELECT lon, lat, height FROM heights WHERE (lon, lat) IN (VALUES {})'.
+                                               format(values), params).fetchall()
+                self.connection.executemany('UPDATE heights SET used = ? WHERE lon = ? AND lat = ?',
+                                            ((now, lon, lat) for lon, lat, _ in rows))
+                found.update(((lon, lat), height) for lon, lat, height in rows)
+        self.hits += len(found)
+        self.misses += len(points) - len(found)
+        return found
+
+    def within(self, left, bottom, right, top):
+        '''Returns list of (point, height) of cached points within given bounds'''
+        with self.lock:
+            rows = self.connection.execute('SELECT lon, lat, height FROM heights WHERE lon BETWEEN ? AND ? '
+                                           'AND lat BETWEEN ? AND ?', (left, right, bottom, top)).fetchall()
+        return [((lon, lat), height) for lon, lat, height in rows]
+
+    def put(self, heights):
+        '''Stores (point, height) pairs, skipping unknown heights'''
+        now = time.time()
+        rows = [(p[0], p[1], h, now) for p, h in heights if h is not None and None not in p]
+        if not rows:
+            return
+        with self._transaction():
+            self.connection.executemany('INSERT OR REPLACE INTO heights (lon, lat, height, used) VALUES (?,?,?,?)', rows)
+            excess = len(self) - self.max_size
+            if self.max_size and excess > 0:
+                self.connection.execute('DELETE FROM heights WHERE (lon, lat) IN '
+                                        '(SELECT lon, lat FROM heights ORDER BY used LIMIT ?)', (excess,))
+
+    @contextmanager
+    def _transaction(self):
+        # take the write lock up front, so concurrent processes wait for each other instead of failing
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,192 @@
+import os
+import re
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ElevationProvider(object):
+    '''Source of heights for a list of (longitude, latitude) points'''
+
+    def get_heights(self, points):
+        '''Returns list of heights, in order of `points`. Unknown heights are None'''
+        raise NotImplementedError
+
+
+class Raster(object):
+    '''Regular lon/lat grid of heights, `data[0][0]` is the north-west sample at (`left`, `top`)'''
+
+    def __init__(self, data, left, top, dx, dy, nodata=None):
+        self.data = data
+        self.left = left
+        self.top = top
+        self.dx = dx
+        self.dy = dy
+        self.nodata = nodata
+
+    @property
+    def bounds(self):
+        rows, cols = self.data.shape
+        return self.left, self.top - (rows - 1) * self.dy, self.left + (cols - 1) * self.dx, self.top
+
+    def interpolate(self, lon, lat):
+        '''Bilinear interpolation of heights at arrays of coordinates. Voids give NaN'''
+        rows, cols = self.data.shape
+        x = np.clip((lon - self.left) / self.dx, 0, cols - 1)
+        y = np.clip((self.top - lat) / self.dy, 0, rows - 1)
+        col = np.minimum(np.floor(x).astype(np.intp), cols - 2)
+        row = np.minimum(np.floor(y).astype(np.intp), rows - 2)
+        fx = x - col
+        fy = y - row
+        corners = np.stack([self.data[row, col], self.data[row, col + 1],
+                            self.data[row + 1, col], self.data[row + 1, col + 1]]).astype(np.float64)
+        weights = np.stack([(1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy])
+        if self.nodata is not None:
+            # voids do not count, remaining corners are weighted accordingly
+            void = corners == self.nodata
+            corners[void] = 0
+            weights[void] = 0
+        total = weights.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(total > 0, (corners * weights).sum(axis=0) / total, np.nan)
+
+
+class HGTTile(object):
+    '''SRTM .hgt tile, named after its south-west corner, e.g. N50E017.hgt'''
+    NAME = re.compile(r'^([NS])(\d{2})([EW])(\d{3})\.hgt$', re.IGNORECASE)
+    NODATA = -32768
+
+    @classmethod
+    def bounds(cls, path):
+        match = cls.NAME.match(os.path.basename(path))
+        if not match:
+            return None
+        lat = int(match.group(2)) * (1 if match.group(1).upper() == 'N' else -1)
+        lon = int(match.group(4)) * (1 if match.group(3).upper() == 'E' else -1)
+        return lon, lat, lon + 1, lat + 1
+
+    @classmethod
+    def open(cls, path):
+        size = int(round((os.path.getsize(path) // 2) ** 0.5))
+        if size < 2 or size * size * 2 != os.path.getsize(path):
+            raise ValueError('{} is not a valid SRTM tile'.format(path))
+        west, south, east, north = cls.bounds(path)
+        data = np.memmap(path, dtype='>i2', mode='r', shape=(size, size))
+        return Raster(data, west, north, 1 / (size - 1), 1 / (size - 1), cls.NODATA)
+
+
+class GeoTIFFTile(object):
+    '''Single band, uncompressed, stripped GeoTIFF with lon/lat pixel scale and tie point'''
+    TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 11: ('f', 4), 12: ('d', 8), 16: ('Q', 8)}
+    SAMPLE_FORMATS = {1: 'u', 2: 'i', 3: 'f'}
+    PIXEL_IS_AREA = 1
+
+    @classmethod
+    def _read_tags(cls, path):
+        with open(path, 'rb') as f:
+            header = f.read(8)
+            if header[0:4] not in (b'II*\x00', b'MM\x00*'):
+                raise ValueError('{} is not a classic TIFF file'.format(path))
+            endian = '<' if header[0:2] == b'II' else '>'
+            (offset,) = struct.unpack(endian + 'I', header[4:8])
+            f.seek(offset)
+            (count,) = struct.unpack(endian + 'H', f.read(2))
+            entries = [struct.unpack(endian + 'HHI4s', f.read(12)) for _ in range(count)]
+            tags = {}
+            for tag, _type, n, value in entries:
+                if _type not in cls.TYPES:
+                    continue
+                code, size = cls.TYPES[_type]
+                if n * size > 4:
+                    f.seek(struct.unpack(endian + 'I', value)[0])
+                    value = f.read(n * size)
+                fmt = '{}{}{}'.format(endian, n, code)
+                tags[tag] = struct.unpack(fmt, value[0:n * size])
+        tags['endian'] = endian
+        return tags
+
+    @classmethod
+    def _raster_params(cls, path):
+        tags = cls._read_tags(path)
+        if tags.get(259, (1,))[0] != 1 or tags.get(277, (1,))[0] != 1 or 322 in tags:
+            raise ValueError('{}: only uncompressed, single band, stripped GeoTIFF is supported'.format(path))
+        if 33550 not in tags or 33922 not in tags:
+            raise ValueError('{}: missing GeoTIFF pixel scale or tie point'.format(path))
+        width, height = tags[256][0], tags[257][0]
+        offsets, counts = tags[273], tags[279]
+        if any(offsets[i] + counts[i] != offsets[i + 1] for i in range(len(offsets) - 1)):
+            raise ValueError('{}: strips are not contiguous'.format(path))
+        dtype = np.dtype('{}{}{}'.format(tags['endian'], cls.SAMPLE_FORMATS[tags.get(339, (1,))[0]], tags[258][0] // 8))
+        dx, dy = tags[33550][0:2]
+        i, j, _, x, y, _ = tags[33922][0:6]
+        left, top = x - i * dx, y + j * dy
+        keys = tags.get(34735, ())
+        raster_type = dict((keys[k], keys[k + 3]) for k in range(4, len(keys), 4)).get(1025, cls.PIXEL_IS_AREA)
+        if raster_type == cls.PIXEL_IS_AREA:
+            left, top = left + dx / 2, top - dy / 2
+        nodata = tags.get(42113)
+        nodata = float(nodata[0].rstrip(b'\x00')) if nodata else None
+        return dict(offset=offsets[0], dtype=dtype, shape=(height, width), left=left, top=top, dx=dx, dy=dy,
+                    nodata=nodata)
+
+    @classmethod
+    def bounds(cls, path):
+        params = cls._raster_params(path)
+        height, width = params['shape']
+        return (params['left'], params['top'] - (height - 1) * params['dy'],
+                params['left'] + (width - 1) * params['dx'], params['top'])
+
+    @classmethod
+    def open(cls, path):
+        params = cls._raster_params(path)
+        data = np.memmap(path, dtype=params['dtype'], mode='r', offset=params['offset'], shape=params['shape'])
+        return Raster(data, params['left'], params['top'], params['dx'], params['dy'], params['nodata'])
+
+
+class DEMProvider(ElevationProvider):
+    '''Offline heights from SRTM .hgt and GeoTIFF tiles stored in `directory`.
+
+    Tiles are memory mapped on first use and at most `max_open_tiles` are kept open. Heights are rounded to
+    whole metres, as elevation services answer them.
+    '''
+    MAX_OPEN_TILES = 16
+    TILE_TYPES = {'.hgt': HGTTile, '.tif': GeoTIFFTile, '.tiff': GeoTIFFTile}
+
+    def __init__(self, directory, max_open_tiles=MAX_OPEN_TILES):
+        self.directory = directory
+        self.max_open_tiles = max_open_tiles
+        self.open_tiles = OrderedDict()
+        # heights are asked for by several fetch workers at once
+        self.lock = threading.Lock()
+        self.tiles = []
+        for name in sorted(os.listdir(directory)):
+            tile_type = self.TILE_TYPES.get(os.path.splitext(name)[1].lower())
+            if tile_type is not None:
+                path = os.path.join(directory, name)
+                bounds = tile_type.bounds(path)
+                if bounds is not None:
+                    self.tiles.append((bounds, path, tile_type))
+
+    def _open(self, path, tile_type):
+        with self.lock:
+            raster = self.open_tiles.pop(path, None)
+            if raster is None:
+                raster = tile_type.open(path)
+                while len(self.open_tiles) >= self.max_open_tiles:
+                    self.open_tiles.popitem(last=False)
+            self.open_tiles[path] = raster
+            return raster
+
+    def get_heights(self, points):
+        if not len(points):
+            return []
+        coordinates = np.array([p if None not in p else (np.nan, np.nan) for p in points], dtype=np.float64)
+        lon, lat = coordinates[:, 0], coordinates[:, 1]
+        heights = np.full(len(points), np.nan)
+        for (west, south, east, north), path, tile_type in self.tiles:
+            mask = np.isnan(heights) & (lon >= west) & (lon <= east) & (lat >= south) & (lat <= north)
+            if mask.any():
+                heights[mask] = self._open(path, tile_type).interpolate(lon[mask], lat[mask])
+        return [None if np.isnan(h) else int(round(h)) for h in heights.tolist()]
@@ -0,0 +1,113 @@
+import json
+import urllib
+from collections import OrderedDict
+
+import requests
+
+from ElevationProvider import ElevationProvider
+from Fetcher import Fetcher
+from utils import _encode_polyline
+
+
+class ElevationService(ElevationProvider):
+    '''Web service answering heights of (longitude, latitude) points.
+
+    Subclasses build the request for at most `MAX_POINTS` points and read heights out of its response. `fetch`
+    raises ValueError or `requests.RequestException` when a service fails, `get_heights` reports failed chunks
+    and leaves their heights unknown.
+    '''
+    NAME = None
+    API_URL = None
+    MAX_POINTS = 100
+
+    def __init__(self, api_key=None, fetcher=None, url=None):
+        self.api_key = api_key
+        self.url = url or self.API_URL
+        self.fetcher = fetcher or Fetcher()
+
+    def request(self, points):
+        '''Url to GET or `requests.Request` asking for heights of `points`'''
+        raise NotImplementedError
+
+    def heights(self, jsn, points):
+        '''List of heights of `points` read from decoded JSON response'''
+        raise NotImplementedError
+
+    def fetch(self, points):
+        resp = self.fetcher.fetch(self.request(points))
+        if not resp.ok:
+            raise ValueError('{} answered HTTP {}'.format(self.NAME, resp.status_code))
+        heights = self.heights(resp.json(), points)
+        if len(heights) != len(points):
+            raise ValueError('{} answered {} heights for {} points'.format(self.NAME, len(heights), len(points)))
+        return heights
+
+    def get_heights(self, points):
+        heights = []
+        for i in range(0, len(points), self.MAX_POINTS):
+            chunk = points[i:i + self.MAX_POINTS]
+            try:
+                heights.extend(self.fetch(chunk))
+            except (ValueError, requests.RequestException) as e:
+                print('[ERROR]: {}'.format(e))
+                heights.extend([None] * len(chunk))
+        return heights
+
+
+class MapzenService(ElevationService):
+    '''[Mapzen Elevation Service](https://mapzen.com/documentation/elevation/elevation-service/)'''
+    NAME = 'mapzen'
+    API_URL = 'http://elevation.mapzen.com/height'
+
+    def request(self, points):
+        shape = [OrderedDict([("lat", k[1]), ("lon", k[0])]) for k in points]
+        params = urllib.parse.urlencode(OrderedDict([('json', json.dumps({'shape': shape})),
+                                                     ('api_key', self.api_key)]))
+        return '{}?{}'.format(self.url, params)
+
+    def heights(self, jsn, points):
+        return jsn.get('height') or []
+
+
+class GoogleService(ElevationService):
+    '''[Google Elevation API](https://developers.google.com/maps/documentation/elevation/intro)'''
+    NAME = 'google'
+    API_URL = 'https://maps.googleapis.com/maps/api/elevation/json'
+    MAX_POINTS = 256
+
+    def request(self, points):
+        params = urllib.parse.urlencode(OrderedDict([('locations', 'enc:' + _encode_polyline(points, 5)),
+                                                     ('key', self.api_key)]))
+        return '{}?{}'.format(self.url, params)
+
+    def heights(self, jsn, points):
+        if jsn.get('status') != 'OK':
+            raise ValueError('google answered {}: {}'.format(jsn.get('status'), jsn.get('error_message', '')))
+        return [round(r['elevation'], 1) if r.get('elevation') is not None else None for r in jsn['results']]
+
+
+class OpenElevationService(ElevationService):
+    '''[Open-Elevation](https://open-elevation.com), no API key needed'''
+    NAME = 'open-elevation'
+    API_URL = 'https://api.open-elevation.com/api/v1/lookup'
+    MAX_POINTS = 1000
+
+    def request(self, points):
+        locations = [OrderedDict([('latitude', k[1]), ('longitude', k[0])]) for k in points]
+        return requests.Request('POST', self.url, data=json.dumps({'locations': locations}),
+                                headers={'Content-Type': 'application/json'})
+
+    def heights(self, jsn, points):
+        return [r.get('elevation') for r in jsn.get('results') or []]
+
+
+# services by name, code embedding the enhancer may register its own
+SERVICES = OrderedDict((cls.NAME, cls) for cls in (MapzenService, GoogleService, OpenElevationService))
+
+
+def create_service(spec, api_key=None, fetcher=None):
+    '''Creates service from `NAME[=API_KEY]` specification, `api_key` is used if the key is not given'''
+    name, _, key = spec.partition('=')
+    if name not in SERVICES:
+        raise ValueError('unknown elevation service {}, known are: {}'.format(name, ', '.join(SERVICES)))
+    return SERVICES[name](key or api_key, fetcher=fetcher)
@@ -1,82 +1,431 @@
+import io
+import itertools
 import json
-import time
-import requests
 import urllib
 from collections import OrderedDict
 
-from TrainingDocument import GPXDocument, TCXDocument
-from utils import _normalized_float
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from Analyzer import Analyzer
+from Checkpoint import Checkpoint
+from Fetcher import Fetcher
+from Metrics import Metrics
+from QueryPlanner import QueryPlanner
+from Simplifier import Simplifier
+from SpatialIndex import SpatialIndex
+from Streams import STDIO, guess_format, is_path, spool, split_compression
+from TrackSidecar import TrackSidecar
+from TrainingDocument import GPXDocument, TCXDocument, StreamingGPXDocument, StreamingTCXDocument, TTBinDocument, \
+    CSVDocument
+from utils import _polyline_point, _encode_polyline
 
 
 class Enhancer(object):
     API_URL='http://elevation.mapzen.com/height'
-    CHUNK_SIZE = 112
+    CHUNK_SIZE = 2000
+    # points are looked up in the cache (and cached heights around them loaded) this many at a time, before they
+    # are cut into requests
+    LOOKUP_SIZE = 400
+    MAX_GET_BYTES = 8192
+    MAX_POST_BYTES = 1024 * 1024
+    PAYLOADS = ('json', 'polyline')
     warning_threshold = 0.25
     error_threshold = 0.75
 
-    def __init__(self,  input, output, api_key, format='guess', chunk_size = CHUNK_SIZE):
+    def __init__(self,  input, output, api_key, format='guess', chunk_size = CHUNK_SIZE, streaming=False,
+                 workers=Fetcher.WORKERS, rate=Fetcher.RATE, cache=None, provider=None, simplify=0,
+                 payload='json', method='GET', max_request_bytes=None, fetcher=None, metrics=None,
+                 incremental=False, checkpoint=None, sidecar=False, reuse_radius=0, query_order='track'):
+        if input is not None and not is_path(input) and (input == STDIO or not input.seekable()):
+            # read more than once (format detection, streaming documents)
+            input = spool(input)
         self.input = input
         self.output = output
         self.api_key = api_key
         self.chunk_size = chunk_size
+        self.streaming = streaming
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.fetcher = fetcher or Fetcher(workers=workers, rate=rate, metrics=self.metrics)
+        self.cache = cache
+        self.provider = provider
+        self.simplifier = Simplifier(simplify) if simplify else None
+        self.spatial = SpatialIndex(reuse_radius) if reuse_radius else None
+        self.planner = QueryPlanner(query_order) if query_order != 'track' else None
+        self.query_points = None
+        self.payload = payload
+        self.method = method.upper()
+        if max_request_bytes is None:
+            max_request_bytes = self.MAX_POST_BYTES if self.method == 'POST' else self.MAX_GET_BYTES
+        self.max_request_bytes = max_request_bytes
         if format == 'guess':
-            format = self.input.split('.')[-1]
+            format = guess_format(self.input) or 'tcx'
         self.document = self._document_factory(format)
+        self.document.incremental = incremental
+        self.checkpoint = Checkpoint(checkpoint) if checkpoint else None
+        self.sidecar = TrackSidecar(self.input) if sidecar and is_path(self.input) else None
+        self.document.collect_times = self.sidecar is not None
+        self._loaded = None
+        # with a valid sidecar the document is parsed, and altitudes are set on it, only when it is written
+        self._deferred = False
+        self._unapplied = False
         self.coordinates = OrderedDict()
 
     def _document_factory(self, format):
         '''Yes, I do use design patterns :P '''
+        if format.upper() == 'TTBIN':
+            # binary input, written in the format of the output file's extension
+            output_format = split_compression(self.output)[0].split('.')[-1] if is_path(self.output) else 'tcx'
+            return TTBinDocument('gpx' if output_format.upper() == 'GPX' else 'tcx')
+        if format.upper() == 'CSV':
+            # always read in blocks, `streaming` or not
+            return CSVDocument()
         if format.upper() == 'GPX':
-            return GPXDocument()
+            return StreamingGPXDocument() if self.streaming else GPXDocument()
         else:
-            return TCXDocument()
+            return StreamingTCXDocument() if self.streaming else TCXDocument()
 
     def parse(self):
-        self.document.parse(self.input)
-        self.coordinates = self.document.get_coordinates()
+        loaded = self._load_sidecar()
+        if loaded is None:
+            with self.metrics.stage('parse'):
+                self.document.parse(self.input)
+        else:
+            # coordinates come from the sidecar, no need to read the document for them
+            self._deferred = True
+            self.document.store = loaded[0]
+        with self.metrics.stage('get_coordinates'):
+            self.coordinates = self.document.get_coordinates()
+        if loaded is not None:
+            self.coordinates.update((k, h) for k, h in zip(loaded[0].keys(), loaded[1]) if h is not None)
+
+    def _load_sidecar(self):
+        '''Loads the sidecar once, returns (store, altitudes, lap starts) or None if there is no valid one'''
+        if self.sidecar is not None and self._loaded is None:
+            self._loaded = self.sidecar.load() or False
+            self.metrics.count('sidecar_hits' if self._loaded else 'sidecar_misses')
+        return self._loaded or None
 
 
     def _chunks(self, _list, n):
         for i in range(0, len(_list), n):
             yield _list[i:i+n]
 
+    def _batches(self, points, n):
+        '''Lists of `n` items of iterable `points`, taken only as they are needed'''
+        points = iter(points)
+        batch = list(itertools.islice(points, n))
+        while batch:
+            yield batch
+            batch = list(itertools.islice(points, n))
+
+
+    def _pending_points(self):
+        '''Points which still have to be sent to elevation service'''
+        return [k for k, v in self.coordinates.items()
+                if v is None and (self.query_points is None or k in self.query_points)]
+
+    def _track(self):
+        '''Unique points in the order the track passes them, again every time it comes back to them'''
+        store = self.document.store
+        if store is None:
+            # coordinates merged from several documents (batch mode) follow no single track
+            return list(self.coordinates.keys())
+        keys = list(store.keys())
+        track = []
+        prev = -1
+        for index in store.indices:
+            if index >= 0 and index != prev:
+                track.append(keys[index])
+                prev = index
+        return track
+
+    def _simplify(self):
+        track = self._track()
+        self.query_points = set(track[i] for i in self.simplifier.simplify(track).tolist())
+        print('[INFO]: querying {} out of {} track points, max deviation {:.1f} m'.format(
+            len(self.query_points), len(self.coordinates), self.simplifier.error))
+
+    def _interpolate_altitudes(self):
+        # between neighbours along the track, a point passed several times takes the height of its first pass
+        track = self._track()
+        heights = self.simplifier.interpolate(track, [self.coordinates.get(p) for p in track])
+        interpolated = OrderedDict()
+        for point, height in zip(track, heights):
+            if self.coordinates.get(point) is None:
+                interpolated.setdefault(point, height)
+        self.coordinates.update(interpolated)
+
+    def _payload(self, points):
+        if self.payload == 'polyline':
+            return {'encoded_polyline': _encode_polyline(points)}
+        return {'shape': [OrderedDict([("lat", k[1]),("lon",k[0])]) for k in points]}
 
-    def _build_request_urls(self):
-        shape_list = [OrderedDict([("lat", k[1]),("lon",k[0])]) for k in self.coordinates.keys()]
-        for l in self._chunks(shape_list, self.chunk_size):
-            dic = {'shape': l}
-            params=urllib.parse.urlencode(OrderedDict([('json',json.dumps(dic)), ('api_key',self.api_key)]))
-            yield '{}?{}'.format(self.API_URL,params)
+    def _build_request(self, points):
+        dic = self._payload(points)
+        if self.method == 'POST':
+            params=urllib.parse.urlencode(OrderedDict([('api_key',self.api_key)]))
+            return requests.Request('POST', '{}?{}'.format(self.API_URL,params), data=json.dumps(dic),
+                                    headers={'Content-Type': 'application/json'})
+        params=urllib.parse.urlencode(OrderedDict([('json',json.dumps(dic)), ('api_key',self.api_key)]))
+        return '{}?{}'.format(self.API_URL,params)
 
+    def _request_size(self, request):
+        if isinstance(request, str):
+            return len(request)
+        return len(request.url) + len(request.data)
+
+    def _point_size(self, point, prev):
+        if self.payload == 'polyline':
+            data = _polyline_point(point, prev)
+        else:
+            data = json.dumps(OrderedDict([("lat", point[1]),("lon",point[0])])) + ', '
+        return len(urllib.parse.quote_plus(data)) if self.method == 'GET' else len(data)
+
+    def _size_chunks(self, points):
+        '''Splits points into chunks whose requests fit in `max_request_bytes` and have at most `chunk_size` points'''
+        budget = self.max_request_bytes - self._request_size(self._build_request([]))
+        chunk, size, prev = [], 0, None
+        for p in points:
+            cost = self._point_size(p, prev)
+            if chunk and size + cost > budget:
+                yield chunk
+                chunk, size = [], 0
+                cost = self._point_size(p, None)
+            chunk.append(p)
+            size += cost
+            prev = p
+            if self.chunk_size and len(chunk) >= self.chunk_size:
+                # full already, do not wait for the next point
+                yield chunk
+                chunk, size, prev = [], 0, None
+        if chunk:
+            yield chunk
+
+    def _plan_chunks(self, points, pending=iter):
+        '''Chunks of `points` to request, in query order of `planner` if there is one, so that no chunk spans
+        several tiles. `pending` filters points of every group as chunks are cut.'''
+        groups = self.planner.groups(points) if self.planner is not None else [points]
+        return (chunk for group in groups for chunk in self._size_chunks(pending(group)))
+
+    def _request_chunks(self):
+        '''Chunks of pending points to request, nearby points are resolved as chunks are cut'''
+        pending = self._unresolved if self.spatial is not None else iter
+        return self._plan_chunks(self._pending_points(), pending)
+
+    def _build_request_urls(self, chunks=None):
+        '''Yields request of every one of `chunks`, by default of those `_get_responses` fetches'''
+        for chunk in self._request_chunks() if chunks is None else chunks:
+            yield self._build_request(chunk)
 
     def _get_responses(self):
-        self.responses = []
-        for url in self._build_request_urls():
+        '''Yields (points, response) for chunks of pending points'''
+        return self._fetch_chunks(self._request_chunks())
+
+    def _fetch_chunks(self, chunks):
+        '''Yields (points, response) for chunks of points. Chunks are consumed lazily, only as far as requests
+        in flight need, so they may still be produced (e.g. parsed) while earlier ones are being fetched.'''
+        chunks, pending = itertools.tee(chunks)
+        for points, future in zip(chunks, self.fetcher.map(self._build_request_urls(pending))):
             try:
-                resp = requests.get(url)
-                self.responses.append(resp)
-                if resp.status_code == 429:
-                    time.sleep(2)
-                    resp = requests.get(url)
-                yield resp
+                resp = future.result()
+                if resp.status_code in (413, 414) and len(points) > 1:
+                    # request too large, shrink the budget for good and retry the points in smaller chunks
+                    self.metrics.count('split_requests')
+                    self.max_request_bytes = self._request_size(self._build_request(points)) // 2
+                    yield from self._fetch_chunks(self._size_chunks(points))
+                    continue
+                yield points, resp
             except Exception as e:
+                self.metrics.count('failed_requests')
                 print(str(e))
-            time.sleep(0.5)
+
+    def _decode(self, resp):
+        '''JSON body of `resp`, decoded with orjson if it is installed'''
+        return orjson.loads(resp.content) if orjson is not None else json.loads(resp.content)
 
     def get_altitudes(self):
-        for resp in self._get_responses():
-            if resp.ok:
-                jsn = resp.json()
-                shape = jsn.get('shape')
-                height = jsn.get('height')
-                if shape and height:
-                    shape_list =[(_normalized_float(x.get('lon')), _normalized_float(x.get('lat'))) for x in shape]
-                    res = zip(shape_list, height)
-                    for p,h in res:
-                        self.coordinates[p] = h
+        self.fetch_altitudes()
         if self._check_thresholds() < self.error_threshold:
+            self._append_altitudes()
+
+    def _append_altitudes(self):
+        if self._deferred:
+            # left to `write`, once the document is parsed
+            self._unapplied = True
+            return
+        with self.metrics.stage('append_altitudes'):
             self.document.append_altitudes(self.coordinates)
 
+    def fetch_altitudes(self):
+        '''Resolves altitudes of `coordinates` without touching the document'''
+        self.metrics.count('points', len(self.coordinates))
+        with self.metrics.stage('fetch'):
+            self._fetch_altitudes()
+        self.metrics.count('points_resolved', sum(1 for v in self.coordinates.values() if v is not None))
+
+    def _fetch_altitudes(self):
+        if self.checkpoint is not None:
+            resolved = [(k, h) for k, h in self.checkpoint.load().items() if k in self.coordinates]
+            self.metrics.count('checkpoint_points', len(resolved))
+            self.coordinates.update(resolved)
+        if self.cache is not None:
+            self.coordinates.update(self._cached(self._pending_points()))
+        if self.spatial is not None:
+            self.spatial.update((k, h) for k, h in self.coordinates.items() if h is not None)
+            if self.simplifier is not None or self.provider is not None:
+                # requested points are resolved as they are cut into chunks instead, see `_get_responses`
+                for chunk in self._chunks(self._pending_points(), self.CHUNK_SIZE):
+                    self.coordinates.update(self._resolve_nearby(chunk))
+        if self.simplifier is not None:
+            self._simplify()
+        if self.provider is not None:
+            points = self._pending_points()
+            if self.planner is not None:
+                points = self.planner.ordered(points)
+            self._store_altitudes(list(zip(points, self.provider.get_heights(points))))
+        else:
+            for points, resp in self._get_responses():
+                self._store_response(resp, points)
+        if self.simplifier is not None:
+            self._interpolate_altitudes()
+
+    def _cached(self, points):
+        '''Returns dict of heights of those of `points` which are in the cache'''
+        found = self.cache.get(points)
+        self.metrics.count('cache_hits', len(found))
+        self.metrics.count('cache_misses', len(points) - len(found))
+        return found
+
+    def _unresolved(self, points):
+        '''Yields those of `points` which cannot be resolved from nearby known heights. Every point is looked up
+        only when it is consumed, so heights answered meanwhile (e.g. of earlier laps) are reused.'''
+        for batch in self._batches(points, self.LOOKUP_SIZE):
+            self._load_nearby(batch)
+            for point in batch:
+                height = self._nearby(point)
+                if height is None:
+                    yield point
+                else:
+                    self.coordinates[point] = height
+
+    def _load_nearby(self, points):
+        '''Adds cached heights of earlier tracks around `points` to the spatial index'''
+        if self.cache is not None:
+            bounds = self.spatial.bounds(points)
+            if bounds is not None:
+                self.spatial.update(self.cache.within(*bounds))
+
+    def _nearby(self, point):
+        '''Height of `point` interpolated from known heights within `reuse_radius` metres, None if there are none'''
+        height = self.spatial.height(point)
+        if height is not None:
+            self.metrics.count('nearby_hits')
+        return height
+
+    def _resolve_nearby(self, points):
+        '''Returns dict of heights of `points` interpolated from known heights within `reuse_radius` metres,
+        including cached heights of earlier tracks'''
+        self._load_nearby(points)
+        found = self.spatial.resolve(points)
+        self.metrics.count('nearby_hits', len(found))
+        return found
+
+    def _store_response(self, resp, points):
+        '''Stores heights answered for chunk `points`. The service answers them in order of the request, so they
+        are matched by position rather than by coordinates echoed back.'''
+        if resp.ok:
+            height = self._decode(resp).get('height')
+            if height and len(height) == len(points):
+                self._store_altitudes(list(zip(points, height)))
+            elif height:
+                self.metrics.count('mismatched_responses')
+                print('[WARNING]: {} heights answered for {} points, chunk skipped'.format(len(height), len(points)))
+
+    def enhance(self):
+        '''Parses input, resolves altitudes and writes output.
+
+        Reading the input, fetching and setting altitudes overlap: chunks of points are requested as soon as
+        they are read and altitudes are set on track points as soon as their chunk returns. Simplification
+        and spatial query order need the whole track and a provider resolves all points in one call, so with
+        them the stages run one after another, as well as when coordinates can be loaded from a valid sidecar.
+        '''
+        if self.simplifier is not None or self.provider is not None or self.planner is not None or \
+                self._load_sidecar() is not None:
+            self.parse()
+            self.get_altitudes()
+        else:
+            with self.metrics.stage('pipeline'):
+                self._pipeline()
+            self.metrics.count('points_resolved', sum(1 for v in self.coordinates.values() if v is not None))
+            if self._check_thresholds() < self.error_threshold:
+                with self.metrics.stage('append_altitudes'):
+                    self.document.append_altitudes(self.coordinates)
+        self.write()
+
+    def _pipeline(self):
+        resolved = self.checkpoint.load() if self.checkpoint is not None else {}
+        self.coordinates = OrderedDict()
+        # unique point index of points waiting for altitudes, kept only until their chunk returns
+        positions = {}
+
+        def points():
+            for point, altitude in self.document.iter_coordinates(self.input):
+                altitude = self.coordinates[point] = resolved.get(point, altitude)
+                if altitude is None:
+                    positions[point] = len(self.coordinates) - 1
+                    yield point
+                elif self.spatial is not None:
+                    self.spatial.add(point, altitude)
+
+        def settle(chunk, found):
+            self.coordinates.update(found)
+            for point in found:
+                del positions[point]
+            return [p for p in chunk if p not in found]
+
+        def unresolved(points):
+            # cached and nearby points are dropped before points are cut into requests, so that requests stay full
+            for batch in self._batches(points, self.LOOKUP_SIZE):
+                if self.cache is not None:
+                    batch = settle(batch, self._cached(batch))
+                if self.spatial is None:
+                    yield from batch
+                    continue
+                self._load_nearby(batch)
+                for point in batch:
+                    # heights of earlier laps of the track may have been answered meanwhile
+                    height = self._nearby(point)
+                    if height is None:
+                        yield point
+                    else:
+                        self.coordinates[point] = height
+                        del positions[point]
+
+        if self.cache is None and self.spatial is None:
+            chunks = self._size_chunks(points())
+        else:
+            chunks = self._size_chunks(unresolved(points()))
+        for chunk, resp in self._fetch_chunks(chunks):
+            self._store_response(resp, chunk)
+            settled = max(positions.pop(p) for p in chunk) + 1
+            self.document.append_altitudes(self.coordinates, settled)
+        self.metrics.count('points', len(self.coordinates))
+
+    def _store_altitudes(self, altitudes):
+        # every point has its entry already, heights are written in place
+        self.coordinates.update(altitudes)
+        if self.checkpoint is not None:
+            self.checkpoint.append(altitudes)
+        if self.cache is not None:
+            self.cache.put(altitudes)
+        if self.spatial is not None:
+            self.spatial.update(altitudes)
+
     def _check_thresholds(self):
         num_points = len(self.coordinates)
         empty_fraction = 0
@@ -91,5 +440,41 @@ class Enhancer(object):
         return empty_fraction
 
 
+    def analyze(self, analyzer=None):
+        '''Returns `Analysis` (distance, grade, smoothed elevation, ascent/descent per lap) of the track with
+        altitudes resolved so far'''
+        if self.document.store is None:
+            self.document.get_coordinates()
+        with self.metrics.stage('analysis'):
+            return (analyzer or Analyzer()).analyze_store(self.document.store, self.coordinates,
+                                                          self._lap_starts())
+
+    def _lap_starts(self):
+        loaded = self._load_sidecar()
+        return loaded[2] if loaded is not None else self.document.get_lap_starts()
+
     def write(self):
-        self.document.write(self.output)
+        if self._deferred:
+            store = self.document.store
+            with self.metrics.stage('parse'):
+                self.document.parse(self.input)
+            self.document.store = store
+            self._deferred = False
+            if self._unapplied:
+                self._unapplied = False
+                self._append_altitudes()
+        with self.metrics.stage('write'):
+            self.document.write(self.output)
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+        if self.sidecar is not None and self.document.store is not None:
+            self.sidecar.save(self.document.store, self.coordinates, self._lap_starts())
+
+
+def enhance_bytes(data, api_key=None, format='guess', **options):
+    '''Enhances document given as bytes (or binary file object), without touching the filesystem. Returns the
+    enhanced document as bytes, ttbin activities as TCX. `options` are those of `Enhancer`.'''
+    source = io.BytesIO(data) if isinstance(data, (bytes, bytearray, memoryview)) else data
+    output = io.BytesIO()
+    Enhancer(source, output, api_key, format=format, **options).enhance()
+    return output.getvalue()
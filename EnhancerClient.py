@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+'''Thin client handing a file over to a running `EnhancerDaemon`.
+
+Imports nothing but the standard library, so it starts quickly.
+'''
+import argparse
+import json
+import os
+import socket
+import sys
+
+
+def submit(socket_path, input, output=None, format=None):
+    '''Queues a job in the daemon listening on `socket_path`, returns its reply'''
+    job = {'input': os.path.abspath(input)}
+    if output:
+        job['output'] = os.path.abspath(output)
+    if format:
+        job['format'] = format
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(job).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as reply:
+            return json.loads(reply.readline().decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('socket', help = "Unix socket of running TrainingEnhancer daemon")
+    parser.add_argument('input', help = "Name of input TCX/GPX file")
+    parser.add_argument('output', nargs='?', help = "Name of output TCX/GPX file. "
+                        "If none, daemon's output directory is used")
+    parser.add_argument('-f', '--format', choices=['tcx','gpx','TCX','GPX','ttbin','TTBIN','csv','CSV', 'guess'],
+                        help="Input and output file format")
+    args = parser.parse_args()
+    reply = submit(args.socket, args.input, args.output, args.format)
+    if not reply.get('queued'):
+        print('[ERROR]: {}'.format(reply.get('error')))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
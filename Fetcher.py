@@ -0,0 +1,145 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from Metrics import Metrics
+
+
+class TokenBucket(object):
+    '''Thread safe token bucket allowing `rate` acquisitions per second with bursts of up to `burst`.
+
+    Rate 0 (or None) disables limiting. `pause` blocks everybody for a given time, e.g. when server
+    asks to back off.
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.blocked_until = 0
+        # number of threads currently waiting for a token
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if not self.rate:
+                        return
+                    self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                    self.timestamp = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                self.waiting += 1
+            try:
+                time.sleep(wait)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+
+    def pause(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class Fetcher(object):
+    '''Sends requests over a pooled `requests.Session` using a bounded pool of worker threads.
+
+    A request is either an url to GET or a `requests.Request`. Requests are paced by a `TokenBucket`.
+    Responses with status 429 are retried after the delay given in `Retry-After` header, or after
+    exponential backoff if there is none. Requests, retries, 429s, transferred bytes and latencies are
+    recorded in `metrics`.
+    '''
+    WORKERS = 4
+    RATE = 2
+    BURST = 2
+    MAX_RETRIES = 3
+    BACKOFF = 2
+    TIMEOUT = 30
+
+    def __init__(self, workers=WORKERS, rate=RATE, burst=BURST, max_retries=MAX_RETRIES, session=None, metrics=None):
+        self.workers = max(workers, 1)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.session = session or self._create_session()
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def fetch(self, request):
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            start = time.perf_counter()
+            resp = self._send(request)
+            self.metrics.observe('request_seconds', time.perf_counter() - start)
+            self.metrics.count('requests')
+            self.metrics.count('bytes_sent', self._size(request))
+            self.metrics.count('bytes_received', len(resp.content))
+            if resp.status_code != 429 or attempt >= self.max_retries:
+                return resp
+            delay = self._retry_after(resp, attempt)
+            self.metrics.count('throttled')
+            self.metrics.count('retries')
+            self.metrics.count('backoff_seconds', delay)
+            self.bucket.pause(delay)
+            attempt += 1
+
+    def saturated(self):
+        '''Whether more requests wait for the rate limit (or for a back-off asked by the service) than there are
+        workers, i.e. the service can not keep up with requests coming in'''
+        return self.bucket.waiting > self.workers or self.bucket.blocked_until > time.monotonic()
+
+    def _size(self, request):
+        if isinstance(request, str):
+            return len(request)
+        return len(request.url) + len(request.data or '')
+
+    def _send(self, request):
+        if isinstance(request, str):
+            return self.session.get(request, timeout=self.TIMEOUT)
+        return self.session.request(request.method, request.url, data=request.data, headers=request.headers,
+                                    timeout=self.TIMEOUT)
+
+    def _retry_after(self, resp, attempt):
+        value = resp.headers.get('Retry-After')
+        if value:
+            try:
+                return max(float(value), 0)
+            except ValueError:
+                pass
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                pass
+        return self.BACKOFF * 2 ** attempt
+
+    def map(self, reqs):
+        '''Yields futures of `fetch` for every request, in order of requests.
+
+        At most twice the number of workers requests are in flight at any time.
+        '''
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = deque()
+            for request in reqs:
+                futures.append(executor.submit(self.fetch, request))
+                if len(futures) >= 2 * self.workers:
+                    yield futures.popleft()
+            while futures:
+                yield futures.popleft()
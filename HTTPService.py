@@ -0,0 +1,223 @@
+import asyncio
+import io
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from lxml import etree
+
+from Enhancer import Enhancer
+from Fetcher import Fetcher
+from Metrics import Metrics
+from Streams import guess_format
+
+CONTENT_TYPES = {'tcx': 'application/vnd.garmin.tcx+xml', 'gpx': 'application/gpx+xml', 'csv': 'text/csv'}
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 411: 'Length Required',
+           413: 'Payload Too Large', 422: 'Unprocessable Entity', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+
+
+class _ResponseStream(io.RawIOBase):
+    '''Binary file object passing what a worker thread writes to the event loop through `queue`, blocking the
+    thread while the queue is full'''
+
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+
+    def writable(self):
+        return True
+
+    def put(self, item):
+        asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+    def write(self, data):
+        if len(data):
+            self.put(bytes(data))
+        return len(data)
+
+
+class EnhancerService(object):
+    '''HTTP service enhancing uploaded documents, built on asyncio.
+
+    `POST /enhance` takes a TCX/GPX/ttbin document (compressed or not) as request body and streams the enhanced
+    document back as it is written (ttbin activities as TCX). Query parameter `format` overrides recognizing the
+    format from the content. `GET /metrics` returns `metrics` in Prometheus format.
+
+    Documents are enhanced by `jobs` worker threads sharing one `Fetcher` (so its connection pool and rate
+    limit), cache and provider. Uploads wait for a free worker, and while the elevation service can not keep up
+    (`Fetcher.saturated`) no new job is started. At most `queue_size` uploads wait, further ones are refused with
+    503. A client reading the response slowly holds up its worker instead of letting output pile up in memory.
+    '''
+    JOBS = 4
+    QUEUE_SIZE = 32
+    MAX_BODY = 64 * 1024 * 1024
+    CHUNK_SIZE = 64 * 1024
+    # chunks of output waiting to be sent to a client
+    BUFFER_CHUNKS = 4
+    POLL_INTERVAL = 0.1
+    RETRY_AFTER = 5
+
+    def __init__(self, api_key, format='guess', streaming=False, jobs=JOBS, queue_size=QUEUE_SIZE, **options):
+        self.api_key = api_key
+        self.format = format
+        self.streaming = streaming
+        self.metrics = options.pop('metrics', None) or Metrics()
+        self.fetcher = Fetcher(workers=options.pop('workers', Fetcher.WORKERS), rate=options.pop('rate', Fetcher.RATE),
+                               metrics=self.metrics)
+        self.options = options
+        self.queue_size = queue_size
+        self.waiting = 0
+        self.jobs = jobs
+        self.slots = None
+        self.executor = ThreadPoolExecutor(jobs)
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.port = None
+
+    async def _read_head(self, reader):
+        line = (await reader.readline()).decode('latin-1').split()
+        if len(line) != 3:
+            raise ValueError('malformed request line')
+        headers = {}
+        while True:
+            header = (await reader.readline()).decode('latin-1')
+            if header in ('\r\n', '\n', ''):
+                break
+            name, _, value = header.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        url = urllib.parse.urlsplit(line[1])
+        return line[0].upper(), url.path, dict(urllib.parse.parse_qsl(url.query)), headers
+
+    async def _respond(self, writer, status, body=b'', content_type='text/plain; charset=utf-8', headers=()):
+        head = ['HTTP/1.1 {} {}'.format(status, REASONS[status]), 'Content-Type: ' + content_type,
+                'Content-Length: {}'.format(len(body)), 'Connection: close']
+        head.extend('{}: {}'.format(k, v) for k, v in headers)
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        try:
+            method, path, query, headers = await self._read_head(reader)
+            if path == '/metrics':
+                await self._respond(writer, 200, self.metrics.to_prometheus().encode('utf-8'),
+                                    'text/plain; version=0.0.4')
+            elif path != '/enhance':
+                await self._respond(writer, 404)
+            elif method != 'POST':
+                await self._respond(writer, 405, headers=[('Allow', 'POST')])
+            else:
+                await self._enhance(reader, writer, query, headers)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            await self._respond(writer, 400, str(e).encode('utf-8'))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _enhance(self, reader, writer, query, headers):
+        if 'content-length' not in headers:
+            return await self._respond(writer, 411)
+        length = int(headers['content-length'])
+        if length > self.MAX_BODY:
+            return await self._respond(writer, 413)
+        if self.waiting >= self.queue_size:
+            self.metrics.count('uploads_refused')
+            return await self._respond(writer, 503, b'too many uploads waiting',
+                                       headers=[('Retry-After', self.RETRY_AFTER)])
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            # the body is read only once there is a worker for it, so clients are held up by TCP flow control
+            while self.fetcher.saturated():
+                await asyncio.sleep(self.POLL_INTERVAL)
+            body = await reader.readexactly(length)
+            await self._run(writer, body, query.get('format', self.format))
+        finally:
+            self.slots.release()
+
+    async def _run(self, writer, body, format):
+        if format == 'guess':
+            format = guess_format(io.BytesIO(body)) or 'tcx'
+        queue = asyncio.Queue(self.BUFFER_CHUNKS)
+        stream = _ResponseStream(asyncio.get_running_loop(), queue)
+        job = asyncio.get_running_loop().run_in_executor(self.executor, self._work, body, format, stream)
+        item = await queue.get()
+        if isinstance(item, Exception):
+            await job
+            status = 400 if isinstance(item, etree.XMLSyntaxError) else 422 if isinstance(item, ValueError) else 500
+            return await self._respond(writer, status, str(item).encode('utf-8'))
+        content_type = CONTENT_TYPES.get(format.lower(), CONTENT_TYPES['tcx'])
+        writer.write(('HTTP/1.1 200 OK\r\nContent-Type: {}\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n'
+                      '\r\n'.format(content_type)).encode('latin-1'))
+        try:
+            while item is not None and not isinstance(item, Exception):
+                writer.write(b'%x\r\n%s\r\n' % (len(item), item))
+                await writer.drain()
+                item = await queue.get()
+            if item is None:
+                writer.write(b'0\r\n\r\n')
+                await writer.drain()
+            else:
+                # failed half way, the client sees an incomplete chunked response
+                writer.transport.abort()
+        except ConnectionError:
+            # let the worker finish instead of blocking on a full queue
+            while item is not None and not isinstance(item, Exception):
+                item = await queue.get()
+        await job
+
+    def _work(self, body, format, stream):
+        output = io.BufferedWriter(stream, self.CHUNK_SIZE)
+        try:
+            enhancer = Enhancer(io.BytesIO(body), output, self.api_key, format=format, streaming=self.streaming,
+                                fetcher=self.fetcher, metrics=self.metrics, **self.options)
+            enhancer.enhance()
+            output.flush()
+            self.metrics.count('uploads_enhanced')
+            stream.put(None)
+        except Exception as e:
+            self.metrics.count('uploads_failed')
+            print('[ERROR]: upload: {}'.format(e))
+            stream.put(e)
+
+    async def _serve(self, host, port):
+        # made on the serving loop, before Python 3.10 asyncio primitives bind to the loop current when made
+        self.slots = asyncio.Semaphore(self.jobs)
+        return await asyncio.start_server(self._handle, host, port)
+
+    def start(self, host='127.0.0.1', port=0):
+        '''Starts serving in a background thread, returns the port'''
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(self._serve(host, port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        '''Stops accepting uploads and waits for running ones to finish'''
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.executor.shutdown()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def run(self, host='127.0.0.1', port=8080):
+        self.start(host, port)
+        print('[INFO]: serving on {}:{}'.format(host, self.port))
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
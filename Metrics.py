@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Histogram(object):
+    '''Counts observed values in cumulative buckets, like a Prometheus histogram'''
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''Returns list of (upper bound, number of values not greater than it), the last bound is +Inf'''
+        total, result = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics(object):
+    '''Thread safe collection of stage timings, counters and histograms of one or more runs.
+
+    Hooks registered with `add_hook` are called as hook(kind, name, value) for every recorded value,
+    kind being 'stage', 'counter' or 'histogram', so embedding code can collect the data its own way.
+    '''
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def _notify(self, kind, name, value):
+        for hook in self.hooks:
+            hook(kind, name, value)
+
+    @contextmanager
+    def stage(self, name):
+        '''Adds time spent in the block to stage `name`'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0) + seconds
+            self._notify('stage', name, seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self._notify('counter', name, value)
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+        self._notify('histogram', name, value)
+
+    def to_dict(self):
+        with self.lock:
+            return OrderedDict([
+                ('stages', OrderedDict((k, round(v, 6)) for k, v in self.stages.items())),
+                ('counters', OrderedDict(self.counters)),
+                ('histograms', OrderedDict((k, OrderedDict([
+                    ('buckets', OrderedDict((str(b), c) for b, c in h.cumulative())),
+                    ('sum', round(h.sum, 6)),
+                    ('count', h.count)])) for k, h in self.histograms.items()))])
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix='enhancer'):
+        '''Returns metrics in Prometheus text exposition format'''
+        data = self.to_dict()
+        lines = ['# TYPE {}_stage_seconds gauge'.format(prefix)]
+        lines.extend('{}_stage_seconds{{stage="{}"}} {}'.format(prefix, k, v) for k, v in data['stages'].items())
+        for name, value in data['counters'].items():
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total {}'.format(prefix, name, value))
+        for name, histogram in data['histograms'].items():
+            lines.append('# TYPE {}_{} histogram'.format(prefix, name))
+            lines.extend('{}_{}_bucket{{le="{}"}} {}'.format(prefix, name, '+Inf' if b == 'inf' else b, c)
+                         for b, c in histogram['buckets'].items())
+            lines.append('{}_{}_sum {}'.format(prefix, name, histogram['sum']))
+            lines.append('{}_{}_count {}'.format(prefix, name, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''Writes metrics to `path`: Prometheus textfile if it ends with .prom, JSON otherwise, '-' is stdout'''
+        if path == '-':
+            print(self.to_json())
+            return
+        text = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        # write atomically, so that collectors never see a partial file
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp, 'w') as f:
+            f.write(text)
+        os.replace(temp, path)
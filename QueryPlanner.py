@@ -0,0 +1,91 @@
+import math
+
+import numpy as np
+
+
+def hilbert_index(x, y, order):
+    '''Distance along the Hilbert curve filling a 2**`order` square grid of cells at integer arrays `x`, `y`'''
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    d = np.zeros(len(x), dtype=np.int64)
+    n = 1 << order
+    s = n >> 1
+    while s:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant, so that the curve within it starts and ends next to its neighbours
+        flip = rx & ~ry
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return d
+
+
+def zorder_index(x, y, order):
+    '''Morton code (interleaved bits) of integer arrays `x`, `y` of a 2**`order` square grid of cells'''
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    d = np.zeros(len(x), dtype=np.int64)
+    for bit in range(order):
+        d |= ((x >> bit) & 1) << (2 * bit)
+        d |= ((y >> bit) & 1) << (2 * bit + 1)
+    return d
+
+
+CURVES = {'hilbert': hilbert_index, 'zorder': zorder_index}
+
+
+class QueryPlanner(object):
+    '''Orders points to be queried so that points close to each other are asked for together.
+
+    Points are grouped by the `tile_size` degrees square tile they lie in (SRTM tiles by default), tiles and the
+    points within them follow a space filling `curve` ('hilbert' or 'zorder'), so an out-and-back route or the
+    laps of a track are queried once for every place instead of spread over distant chunks. Chunks cut from a
+    group cover a small bounding box within a single tile, which keeps tile caches of the service (or the pages
+    of a local DEM) warm, and polyline payloads of close points are smaller too.
+    '''
+    TILE_SIZE = 1.0
+    # 2**24 cells around the globe, about 2.4 m at the equator
+    ORDER = 24
+
+    def __init__(self, curve='hilbert', tile_size=TILE_SIZE):
+        if curve not in CURVES:
+            raise ValueError('unknown curve {}, expected one of {}'.format(curve, ', '.join(CURVES)))
+        self.curve = CURVES[curve]
+        self.tile_size = tile_size
+
+    def _cells(self, lon, lat, size, order):
+        '''Integer (x, y) of `size` degrees cells of a 2**`order` grid covering the globe'''
+        limit = (1 << order) - 1
+        x = np.clip(np.floor((lon + 180) / size), 0, limit).astype(np.int64)
+        y = np.clip(np.floor((lat + 90) / size), 0, limit).astype(np.int64)
+        return x, y
+
+    def plan(self, points):
+        '''Returns (order, tiles): indices of `points` in query order and tile of every one of them in that order.
+        Points without position go last.'''
+        if not len(points):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        coordinates = np.array([p if None not in p else (np.nan, np.nan) for p in points], dtype=np.float64)
+        lon, lat = coordinates[:, 0], coordinates[:, 1]
+        missing = np.isnan(lon) | np.isnan(lat)
+        lon, lat = np.where(missing, 0, lon), np.where(missing, 0, lat)
+        tile_order = max(1, int(math.ceil(math.log2(360 / self.tile_size))))
+        tiles = self.curve(*self._cells(lon, lat, self.tile_size, tile_order), tile_order)
+        tiles[missing] = -1
+        positions = self.curve(*self._cells(lon, lat, 360 / (1 << self.ORDER), self.ORDER), self.ORDER)
+        order = np.lexsort((positions, tiles, missing))
+        return order, tiles[order]
+
+    def ordered(self, points):
+        '''`points` in query order'''
+        return [points[i] for i in self.plan(points)[0].tolist()]
+
+    def groups(self, points):
+        '''Yields lists of `points` in query order, one for every tile'''
+        order, tiles = self.plan(points)
+        bounds = np.flatnonzero(np.diff(tiles)) + 1
+        for group in np.split(order, bounds) if len(order) else ():
+            yield [points[i] for i in group.tolist()]
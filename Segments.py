@@ -0,0 +1,215 @@
+import io
+import multiprocessing
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from lxml import etree
+
+from Enhancer import Enhancer
+from Streams import open_input, open_output
+from TrainingDocument import TCXDocument
+
+_ACTIVITY_START = re.compile(rb'<(?:[\w.-]+:)?Activity[\s>]')
+_ACTIVITY_END = re.compile(rb'</(?:[\w.-]+:)?Activity\s*>')
+_ENCODING = re.compile(rb'^\s*<\?xml[^>]*encoding\s*=\s*["\']([\w.-]+)["\']')
+
+
+def _closing_tags(prefix):
+    '''End tags of elements left open at the end of `prefix`, innermost first'''
+    parser = etree.XMLPullParser(events=('start', 'end'))
+    parser.feed(prefix)
+    stack = []
+    for event, elem in parser.read_events():
+        if event == 'start':
+            stack.append(elem)
+        else:
+            stack.pop()
+    return b''.join('</{}{}>'.format(elem.prefix + ':' if elem.prefix else '', etree.QName(elem).localname)
+                    .encode('utf-8') for elem in reversed(stack))
+
+
+def split_activities(data):
+    '''Splits TCX document `data` at its activities.
+
+    Returns list of (start, end) byte offsets of `<Activity>` elements and list of standalone documents, each
+    holding one activity within the document's head (and closing tags). The first one also keeps everything
+    after the last activity. Returns None if there are less than two activities or the document can not be
+    split safely (not UTF-8, activity tags which do not pair up).
+    '''
+    encoding = _ENCODING.match(data)
+    if encoding and encoding.group(1).lower() not in (b'utf-8', b'utf8', b'us-ascii', b'ascii'):
+        return None
+    starts = [m.start() for m in _ACTIVITY_START.finditer(data)]
+    ends = [m.end() for m in _ACTIVITY_END.finditer(data)]
+    if len(starts) < 2 or len(starts) != len(ends) or \
+            any(s >= e for s, e in zip(starts, ends)) or any(e > s for e, s in zip(ends, starts[1:])):
+        return None
+    bounds = list(zip(starts, ends))
+    head = data[:starts[0]]
+    try:
+        closing = _closing_tags(head)
+    except etree.XMLSyntaxError:
+        return None
+    documents = [head + data[starts[0]:ends[0]] + data[ends[-1]:]]
+    documents.extend(head + data[s:e] + closing for s, e in bounds[1:])
+    return bounds, documents
+
+
+def _activity_slice(output):
+    '''(start, end) of the activity element in an enhanced single activity document'''
+    return _ACTIVITY_START.search(output).start(), list(_ACTIVITY_END.finditer(output))[-1].end()
+
+
+def _serve(connection, incremental):
+    '''Worker process: parses segments, keeps them until their altitudes come, then writes them'''
+    documents = {}
+    for kind, index, payload in iter(connection.recv, None):
+        try:
+            if kind == 'parse':
+                document = TCXDocument()
+                document.incremental = incremental
+                document.parse(io.BytesIO(payload))
+                coordinates = document.get_coordinates()
+                documents[index] = document
+                result = coordinates, document.store.indices
+            else:
+                altitudes, carried = payload
+                document = documents.pop(index)
+                # continue from the altitude the previous activity ended with, as a single document would
+                document._applied = (0, carried)
+                if len(altitudes):
+                    document.append_altitudes(altitudes)
+                output = io.BytesIO()
+                document.write(output)
+                result = output.getvalue()
+        except Exception as e:
+            # not every exception can be pickled (lxml's XMLSyntaxError can not), its message is what matters
+            result = ValueError(str(e))
+        connection.send((index, result))
+
+
+class SegmentedEnhancer(object):
+    '''Enhances a TCX file holding many activities using several processes.
+
+    The file is split at `<Activity>` boundaries (see `split_activities`). Every worker process parses its
+    activities and keeps them, coordinates of all of them are merged and fetched together, then the workers set
+    altitudes and serialize their activities, which are stitched back in the original order. The output is the
+    same as `Enhancer` writes. Files which can not be split are enhanced by a single `Enhancer`.
+    '''
+
+    def __init__(self, input, output, api_key, processes=None, **kwargs):
+        self.input = input
+        self.output = output
+        self.api_key = api_key
+        self.processes = processes or os.cpu_count()
+        self.incremental = kwargs.get('incremental', False)
+        kwargs.pop('sidecar', None)
+        kwargs.pop('streaming', None)
+        self.kwargs = kwargs
+        self.enhancer = Enhancer(None, None, api_key, format='tcx', **kwargs)
+        self.metrics = self.enhancer.metrics
+
+    def enhance(self):
+        with open_input(self.input) as f:
+            data = f.read()
+        split = split_activities(data)
+        if split is None:
+            print('[INFO]: {} can not be split into activities, enhancing it as a whole'.format(self.input))
+            options = dict(self.kwargs, fetcher=self.enhancer.fetcher, metrics=self.metrics)
+            return Enhancer(io.BytesIO(data), self.output, self.api_key, format='tcx', **options).enhance()
+        bounds, documents = split
+        workers = self._start(min(self.processes, len(documents)))
+        try:
+            assigned = self._assign(documents, len(workers))
+            with self.metrics.stage('parse'):
+                parsed = self._run(workers, assigned, [('parse', i, d) for i, d in enumerate(documents)])
+            for coordinates, _ in parsed:
+                for k, v in coordinates.items():
+                    if self.enhancer.coordinates.get(k) is None:
+                        self.enhancer.coordinates[k] = v
+            self.enhancer.fetch_altitudes()
+            apply = self.enhancer._check_thresholds() < self.enhancer.error_threshold
+            jobs = []
+            carried = 0
+            for i, (coordinates, indices) in enumerate(parsed):
+                altitudes = OrderedDict((k, self.enhancer.coordinates[k]) for k in coordinates) if apply else {}
+                jobs.append(('write', i, (altitudes, carried)))
+                carried = self._carried(list(coordinates), altitudes, indices, carried)
+            with self.metrics.stage('write'):
+                self._stitch(data, bounds, self._run(workers, assigned, jobs))
+        finally:
+            self._stop(workers)
+        if self.enhancer.checkpoint is not None:
+            self.enhancer.checkpoint.remove()
+
+    def _carried(self, keys, altitudes, indices, carried):
+        '''Altitude the last track point of an activity is set to, i.e. the one the next one starts with'''
+        for index in reversed(indices):
+            if index >= 0:
+                altitude = altitudes.get(keys[index])
+                if altitude:
+                    return altitude
+        return carried
+
+    def _assign(self, documents, count):
+        '''Worker of every document, the largest ones go first to the least loaded worker'''
+        loads = [0] * count
+        assigned = [0] * len(documents)
+        for i in sorted(range(len(documents)), key=lambda i: -len(documents[i])):
+            worker = loads.index(min(loads))
+            assigned[i] = worker
+            loads[worker] += len(documents[i])
+        return assigned
+
+    def _start(self, count):
+        workers = []
+        for _ in range(count):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve, args=(child, self.incremental), daemon=True)
+            process.start()
+            child.close()
+            workers.append((process, connection))
+        return workers
+
+    def _stop(self, workers):
+        for process, connection in workers:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process, connection in workers:
+            process.join()
+            connection.close()
+
+    def _run(self, workers, assigned, jobs):
+        '''Runs jobs on their workers, returns results in order of jobs, raises the first failure'''
+        results = [None] * len(jobs)
+
+        def serve(worker):
+            # one job at a time, so that neither side blocks on a full pipe
+            connection = workers[worker][1]
+            for job in jobs:
+                if assigned[job[1]] == worker:
+                    connection.send(job)
+                    index, results[index] = connection.recv()
+
+        with ThreadPoolExecutor(len(workers)) as executor:
+            list(executor.map(serve, range(len(workers))))
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def _stitch(self, data, bounds, outputs):
+        # head and tail of the document come from the first activity's document, which has all of them
+        first_end = _activity_slice(outputs[0])[1]
+        with open_output(self.output) as out:
+            out.write(outputs[0][:first_end])
+            for (_, prev_end), (next_start, _), output in zip(bounds, bounds[1:], outputs[1:]):
+                # whitespace (or comments) between activities, as in the input
+                out.write(data[prev_end:next_start])
+                start, end = _activity_slice(output)
+                out.write(output[start:end])
+            out.write(outputs[0][first_end:])
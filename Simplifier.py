@@ -0,0 +1,69 @@
+import numpy as np
+
+EARTH_RADIUS = 6371008.8
+
+
+def _project(points):
+    '''Equirectangular projection of (longitude, latitude) points to metres, good enough for a single track'''
+    coordinates = np.radians(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+    scale = np.cos(coordinates[:, 1].mean()) if len(coordinates) else 1
+    return np.column_stack([coordinates[:, 0] * scale, coordinates[:, 1]]) * EARTH_RADIUS
+
+
+class Simplifier(object):
+    '''Douglas-Peucker simplification of a track.
+
+    Only points kept by `simplify` need to be sent to elevation service, heights of remaining ones are
+    interpolated by distance along the track. `error` is the largest distance (in metres) between a dropped
+    point and the simplified track, as achieved by the last `simplify` call.
+    '''
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.error = 0
+
+    def simplify(self, points):
+        '''Returns sorted indices of `points` which have to be kept'''
+        self.error = 0
+        xy = _project(points)
+        keep = np.zeros(len(xy), dtype=bool)
+        if not len(xy):
+            return np.flatnonzero(keep)
+        keep[[0, -1]] = True
+        stack = [(0, len(xy) - 1)]
+        while stack:
+            start, end = stack.pop()
+            if end - start < 2:
+                continue
+            distances = self._distances(xy[start + 1:end], xy[start], xy[end])
+            index = int(distances.argmax())
+            if distances[index] > self.tolerance:
+                index += start + 1
+                keep[index] = True
+                stack.append((start, index))
+                stack.append((index, end))
+            else:
+                self.error = max(self.error, float(distances[index]))
+        return np.flatnonzero(keep)
+
+    def _distances(self, xy, start, end):
+        segment = end - start
+        length = segment.dot(segment)
+        if length == 0:
+            return np.hypot(*(xy - start).T)
+        t = np.clip((xy - start).dot(segment) / length, 0, 1)
+        return np.hypot(*(xy - start - np.outer(t, segment)).T)
+
+    def interpolate(self, points, heights):
+        '''Fills None `heights` of `points` linearly by distance along the track between known heights'''
+        known = np.array([h is not None for h in heights], dtype=bool)
+        if not known.any() or known.all():
+            return list(heights)
+        xy = _project(points)
+        distance = np.concatenate([[0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))])
+        values = np.array([h for h in heights if h is not None], dtype=np.float64)
+        filled = np.interp(distance[~known], distance[known], values)
+        result = list(heights)
+        for i, h in zip(np.flatnonzero(~known).tolist(), filled.tolist()):
+            result[i] = round(h, 1)
+        return result
@@ -0,0 +1,93 @@
+import math
+from collections import defaultdict
+
+from Simplifier import EARTH_RADIUS
+
+METRES_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+class SpatialIndex(object):
+    '''Grid of known heights answering heights of points within `radius` metres of them.
+
+    Points are bucketed into cells `radius` metres high and as many degrees wide, so neighbours of a point are in
+    the cells around it (more of them across longitudes far from the equator). A point is resolved by inverse
+    distance weighting of its `NEIGHBOURS` nearest known points within `radius`.
+    '''
+    NEIGHBOURS = 4
+    # closer than this many metres a known point is taken as it is
+    SAME_POINT = 0.01
+
+    def __init__(self, radius):
+        self.radius = radius
+        self.cell = radius / METRES_PER_DEGREE
+        self.cells = defaultdict(dict)
+
+    def __len__(self):
+        return sum(len(c) for c in self.cells.values())
+
+    def _key(self, lon, lat):
+        return int(math.floor(lon / self.cell)), int(math.floor(lat / self.cell))
+
+    def add(self, point, height):
+        if height is not None and None not in point:
+            self.cells[self._key(*point)][point] = height
+
+    def update(self, heights):
+        '''Adds (point, height) pairs, skipping unknown heights'''
+        for point, height in heights:
+            self.add(point, height)
+
+    def bounds(self, points):
+        '''(left, bottom, right, top) of `points` extended by `radius`, None if no point has coordinates'''
+        points = [p for p in points if None not in p]
+        if not points:
+            return None
+        lons, lats = zip(*points)
+        span = self.cell / max(math.cos(math.radians(max(abs(min(lats)), abs(max(lats))))), 0.01)
+        return min(lons) - span, min(lats) - self.cell, max(lons) + span, max(lats) + self.cell
+
+    def neighbours(self, point):
+        '''List of (distance, height) of known points within `radius` of `point`, nearest first'''
+        lon, lat = point
+        # cells of the row nearer to the pole are narrower in metres
+        span = int(math.ceil(1 / max(math.cos(math.radians(min(abs(lat) + self.cell, 90))), 0.01)))
+        column, row = self._key(lon, lat)
+        found = []
+        for x in range(column - span, column + span + 1):
+            for y in range(row - 1, row + 2):
+                for (known_lon, known_lat), height in self.cells.get((x, y), {}).items():
+                    distance = _distance(lon, lat, known_lon, known_lat)
+                    if distance <= self.radius:
+                        found.append((distance, height))
+        found.sort(key=lambda n: n[0])
+        return found
+
+    def height(self, point):
+        '''Height interpolated at `point` from known points within `radius`, None if there are none'''
+        if None in point:
+            return None
+        nearest = self.neighbours(point)[:self.NEIGHBOURS]
+        if not nearest:
+            return None
+        if nearest[0][0] < self.SAME_POINT:
+            return nearest[0][1]
+        weights = [1 / d ** 2 for d, _ in nearest]
+        height = sum(w * h for w, (_, h) in zip(weights, nearest)) / sum(weights)
+        # keep integers when neighbours are, like the service answers
+        return int(round(height)) if all(isinstance(h, int) for _, h in nearest) else round(height, 1)
+
+    def resolve(self, points):
+        '''Returns dict of heights of those of `points` which have known points within `radius`'''
+        found = {}
+        for point in points:
+            height = self.height(point)
+            if height is not None:
+                found[point] = height
+        return found
+
+
+def _distance(lon1, lat1, lon2, lat2):
+    '''Haversine distance in metres'''
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1)))
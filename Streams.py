@@ -0,0 +1,160 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import re
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+STDIO = '-'
+# inputs read from pipes are kept in memory up to this size, in a temporary file above it
+SPOOL_SIZE = 16 * 1024 * 1024
+HEAD_SIZE = 4096
+
+
+def _zstd_reader(f):
+    if zstandard is None:
+        raise ValueError('zstandard package is needed to read zstd compressed input')
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, closefd=False))
+
+
+def _zstd_writer(f):
+    if zstandard is None:
+        raise ValueError('zstandard package is needed to write zstd compressed output')
+    return zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+
+
+# name: (magic bytes, file name suffix, reader, writer); readers and writers leave the wrapped file open
+COMPRESSIONS = OrderedDict([
+    ('gzip', (b'\x1f\x8b', '.gz', lambda f: gzip.GzipFile(fileobj=f, mode='rb'),
+              lambda f: gzip.GzipFile(fileobj=f, mode='wb', mtime=0))),
+    ('bz2', (b'BZh', '.bz2', lambda f: bz2.BZ2File(f, 'rb'), lambda f: bz2.BZ2File(f, 'wb'))),
+    ('xz', (b'\xfd7zXZ\x00', '.xz', lambda f: lzma.LZMAFile(f, 'rb'), lambda f: lzma.LZMAFile(f, 'wb'))),
+    ('zstd', (b'\x28\xb5\x2f\xfd', '.zst', _zstd_reader, _zstd_writer)),
+])
+
+# file name extensions of documents which can be enhanced, see `guess_format`
+EXTENSIONS = ('.tcx', '.gpx', '.ttbin', '.csv')
+_XML_ROOT = re.compile(rb'<(?:[\w.-]+:)?(TrainingCenterDatabase|gpx)[\s>/]')
+# header row of a CSV track naming latitude and longitude columns
+_CSV_HEADER = re.compile(rb'^(?=[^\n<]*(?:^|[,;\t])\s*"?(?:lat|latitude)"?\s*(?:[,;\t]|$))'
+                         rb'(?=[^\n<]*(?:^|[,;\t])\s*"?(?:lon|long|longitude|lng)"?\s*(?:[,;\t]|$))', re.I | re.M)
+
+
+def is_path(source):
+    '''Whether `source` is a file name, rather than standard input/output or a file object'''
+    return isinstance(source, (str, os.PathLike)) and source != STDIO
+
+
+def split_compression(name):
+    '''Returns (`name` without compression suffix, compression name or None)'''
+    for compression, (_, suffix, _, _) in COMPRESSIONS.items():
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)], compression
+    return name, None
+
+
+def _peek(f, size):
+    if hasattr(f, 'peek'):
+        return f.peek(size)[:size]
+    position = f.tell()
+    head = f.read(size)
+    f.seek(position)
+    return head
+
+
+@contextmanager
+def open_input(source):
+    '''Binary file object reading `source`: a file name, '-' for standard input or a binary file object (read from
+    its start if it is seekable). Content compressed with gzip, bz2, xz or zstd is decompressed on the fly, the
+    compression is recognized by its magic bytes. Only files opened here are closed afterwards.'''
+    if is_path(source):
+        f = owned = open(source, 'rb')
+    else:
+        f = sys.stdin.buffer if source == STDIO else source
+        owned = None
+        if f.seekable():
+            f.seek(0)
+        elif not hasattr(f, 'peek'):
+            f = io.BufferedReader(f)
+    try:
+        head = _peek(f, 8)
+        reader = next((r(f) for magic, _, r, _ in COMPRESSIONS.values() if head.startswith(magic)), None)
+        try:
+            yield reader or f
+        finally:
+            if reader is not None:
+                reader.close()
+    finally:
+        if owned is not None:
+            owned.close()
+
+
+@contextmanager
+def open_output(target, compression=None):
+    '''Binary file object writing `target`: a file name, '-' for standard output or a binary file object.
+    Output is compressed with `compression`, by default the one of the file name suffix (.gz, .bz2, .xz, .zst).'''
+    if is_path(target):
+        compression = compression or split_compression(str(target))[1]
+        f = owned = open(target, 'wb')
+    else:
+        f = sys.stdout.buffer if target == STDIO else target
+        owned = None
+    try:
+        writer = COMPRESSIONS[compression][3](f) if compression else None
+        try:
+            yield writer or f
+        finally:
+            if writer is not None:
+                writer.close()
+            f.flush()
+    finally:
+        if owned is not None:
+            owned.close()
+
+
+def sniff_format(f):
+    '''Format ('tcx', 'gpx', 'ttbin' or 'csv') of a document from the first bytes of binary file object `f`, which must
+    support `peek` or be seekable, or None if it is not recognized'''
+    head = _peek(f, HEAD_SIZE)
+    if head[:1] == b'\x20' and not head.lstrip().startswith(b'<'):
+        # file header record tag, XML may only start with a space
+        return 'ttbin'
+    match = _XML_ROOT.search(head)
+    if match:
+        return 'tcx' if match.group(1) == b'TrainingCenterDatabase' else 'gpx'
+    if _CSV_HEADER.match(head.split(b'\n', 1)[0].lstrip(b'\xef\xbb\xbf')):
+        return 'csv'
+    return None
+
+
+def guess_format(source):
+    '''Format of `source` recognized from its (decompressed) content, or from the file name suffix if it can not
+    be read'''
+    try:
+        with open_input(source) as f:
+            format = sniff_format(f)
+    except (OSError, EOFError, ValueError):
+        format = None
+    if format is None and is_path(source):
+        format = os.path.splitext(split_compression(str(source))[0])[1].lstrip('.').lower() or None
+    return format
+
+
+def spool(source):
+    '''Copies standard input or a file object which can be read only once to a seekable temporary file, so that
+    it can be read several times, e.g. by streaming documents or for format detection'''
+    f = sys.stdin.buffer if source == STDIO else source
+    spooled = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    shutil.copyfileobj(f, spooled)
+    spooled.seek(0)
+    return spooled
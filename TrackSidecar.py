@@ -0,0 +1,62 @@
+import hashlib
+import os
+from array import array
+
+import numpy as np
+
+from TrackStore import TrackStore
+
+
+class TrackSidecar(object):
+    '''Binary columnar copy of a parsed track, kept next to its source file as `<source>.track.npz`.
+
+    Holds the `TrackStore` columns (coordinates, track point mapping, times), lap starts and resolved altitudes.
+    It is only used while the source file has the same size, modification time and hash as when it was saved.
+    '''
+    SUFFIX = '.track.npz'
+    VERSION = 1
+    COLUMNS = (('longitudes', 'd'), ('latitudes', 'd'), ('heights', 'd'), ('indices', 'i'), ('times', 'd'))
+
+    def __init__(self, source):
+        self.source = source
+        self.path = source + self.SUFFIX
+
+    def _signature(self):
+        stat = os.stat(self.source)
+        digest = hashlib.blake2b()
+        with open(self.source, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64), digest.hexdigest()
+
+    def load(self):
+        '''Returns (store, altitudes, lap starts) saved for the current source, altitudes being a list aligned with
+        unique points of the store, None where unknown. Returns None if there is no valid sidecar.'''
+        try:
+            with np.load(self.path) as data:
+                signature, digest = self._signature()
+                if int(data['version']) != self.VERSION or not np.array_equal(data['signature'], signature) \
+                        or str(data['hash']) != digest:
+                    return None
+                store = TrackStore.from_columns(*(array(typecode, data[name].tobytes())
+                                                  for name, typecode in self.COLUMNS))
+                altitudes = [None if np.isnan(h) else int(h) if integer else h
+                             for h, integer in zip(data['altitudes'].tolist(), data['integers'].tolist())]
+                lap_starts = data['lap_starts'].tolist()
+        except (OSError, KeyError, ValueError):
+            return None
+        return store, altitudes, lap_starts
+
+    def save(self, store, coordinates, lap_starts):
+        '''Saves `store`, altitudes of its points from `coordinates` and `lap_starts`, atomically'''
+        signature, digest = self._signature()
+        altitudes = store.altitudes(coordinates)
+        # services answer with integers, keep them so as to write them the same way
+        integers = np.array([isinstance(h, int) for h in altitudes], dtype=bool)
+        altitudes = np.array([np.nan if h is None else h for h in altitudes], dtype=np.float64)
+        columns = dict((name, np.frombuffer(getattr(store, name), dtype=typecode)) for name, typecode in self.COLUMNS)
+        temp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temp, 'wb') as f:
+            np.savez(f, version=self.VERSION, signature=signature, hash=digest, altitudes=altitudes,
+                     integers=integers, lap_starts=np.array(lap_starts, dtype=np.int64), **columns)
+        os.replace(temp, self.path)
@@ -0,0 +1,114 @@
+from array import array
+from collections import OrderedDict
+from itertools import islice
+from math import isnan
+
+import numpy as np
+
+from utils import _normalized_float
+
+
+class TrackStore(object):
+    '''Columnar storage of track point coordinates.
+
+    `longitudes` and `latitudes` hold unique normalized coordinates in order of first appearance,
+    `indices` maps every track point to its position in them, or -1 if the point has no (valid) position.
+    `heights` holds altitudes already present in the document (NaN where there are none) and `times` the time
+    of every track point as seconds since epoch (NaN where there is none), if collected.
+    '''
+
+    def __init__(self):
+        self.longitudes = array('d')
+        self.latitudes = array('d')
+        self.heights = array('d')
+        self.indices = array('i')
+        self.times = array('d')
+        self._lookup = {}
+
+    @classmethod
+    def from_columns(cls, longitudes, latitudes, heights, indices, times=()):
+        '''Finished store with given columns, e.g. loaded from `TrackSidecar`'''
+        store = cls()
+        store.longitudes.extend(longitudes)
+        store.latitudes.extend(latitudes)
+        store.heights.extend(heights)
+        store.indices.extend(indices)
+        store.times.extend(times)
+        return store.finish()
+
+    def __len__(self):
+        return len(self.longitudes)
+
+    def add(self, longitude, latitude, altitude=None, time=None):
+        '''Adds next track point, `longitude`, `latitude` and `altitude` are strings as read from the document.
+
+        `time` is given (NaN if the point has none) only if times are collected.
+        '''
+        index = -1
+        if longitude is not None and latitude is not None:
+            key = (_normalized_float(longitude), _normalized_float(latitude))
+            if None not in key:
+                index = self._lookup.get(key)
+                if index is None:
+                    index = self._lookup[key] = len(self.longitudes)
+                    self.longitudes.append(key[0])
+                    self.latitudes.append(key[1])
+                    self.heights.append(float('nan'))
+                height = _normalized_float(altitude)
+                if height is not None and isnan(self.heights[index]):
+                    self.heights[index] = height
+        self.indices.append(index)
+        if time is not None:
+            self.times.append(time)
+
+    def add_columns(self, longitudes, latitudes, heights=None, times=None):
+        '''Adds track points from NumPy arrays of normalized coordinates (NaN where a point has no position),
+        altitudes already present (NaN where there are none) and times, the same way `add` adds them one by one'''
+        count = len(self.longitudes)
+        indices = np.full(len(longitudes), -1, dtype=np.int32)
+        valid = np.flatnonzero(~(np.isnan(longitudes) | np.isnan(latitudes)))
+        lookup = self._lookup
+        indices[valid] = [lookup.setdefault(k, len(lookup))
+                          for k in zip(longitudes[valid].tolist(), latitudes[valid].tolist())]
+        # new points got consecutive indices in order of first appearance
+        found = indices[valid]
+        added = valid[found >= count]
+        rows = added[np.unique(indices[added], return_index=True)[1]]
+        self.longitudes.frombytes(longitudes[rows].astype(np.float64).tobytes())
+        self.latitudes.frombytes(latitudes[rows].astype(np.float64).tobytes())
+        self.heights.frombytes(np.full(len(rows), np.nan).tobytes())
+        if heights is not None:
+            known = valid[~np.isnan(heights[valid])]
+            points, first = np.unique(indices[known], return_index=True)
+            column = np.frombuffer(self.heights, dtype=np.float64)
+            missing = np.isnan(column[points])
+            column[points[missing]] = heights[known[first[missing]]]
+            # a view left behind would keep the array from growing
+            del column
+        self.indices.frombytes(indices.tobytes())
+        if times is not None:
+            self.times.frombytes(np.asarray(times, dtype=np.float64).tobytes())
+
+    def finish(self):
+        '''Drops lookup table used while adding points, no more points can be added afterwards'''
+        self._lookup = None
+        return self
+
+    def key(self, index):
+        return self.longitudes[index], self.latitudes[index]
+
+    def height(self, index):
+        height = self.heights[index]
+        return None if isnan(height) else height
+
+    def keys(self):
+        return zip(self.longitudes, self.latitudes)
+
+    def coordinates(self, max_points=0):
+        '''OrderedDict of altitudes already known (None if not) of at most `max_points` first unique points'''
+        return OrderedDict((k, None if isnan(h) else h)
+                           for k, h in islice(zip(self.keys(), self.heights), max_points or None))
+
+    def altitudes(self, coordinates):
+        '''List of altitudes from `coordinates` dict, in order of unique points'''
+        return [coordinates.get(k) for k in self.keys()]
@@ -1,10 +1,21 @@
+import csv
+import io
+import shutil
+import struct
+import time
+from array import array
 from collections import OrderedDict
+import numpy as np
 from lxml import etree
-from utils import _normalized_float
+from Streams import open_input, open_output
+from TrackStore import TrackStore
+from utils import _normalized_float, _normalized_floats, _timestamp
 
 class TrainingDocument(object):
     def __init__(self):
         self.coordinates = OrderedDict()
+        self.store = None
+        self._applied = (0, 0)
 
     def parse(self, input):
         raise NotImplementedError
@@ -15,18 +26,52 @@ class TrainingDocument(object):
     def get_coordinates(self, max_points=0):
         raise NotImplementedError
 
-    def append_altitudes(self, coordinates):
+    def iter_coordinates(self, input):
+        raise NotImplementedError
+
+    def append_altitudes(self, coordinates, settled=None):
+        raise NotImplementedError
+
+    def get_lap_starts(self):
+        '''Index of the first track point of every lap'''
         raise NotImplementedError
 
 
 class XMLDocument(TrainingDocument):
+    '''In `incremental` mode altitudes already present in the document are read with coordinates and kept
+    when writing, so only points without them need to be resolved.
+    '''
     namespaces = {}
+    incremental = False
+    collect_times = False
+    track_point_tag = None
+    lap_tag = None
 
     def parse(self, input):
-        self.etree = etree.parse(input)
+        with open_input(input) as f:
+            self.etree = etree.parse(f)
+        self.store = None
+        self._applied = (0, 0)
+        self._find_track_points()
+
+    def _find_track_points(self):
+        raise NotImplementedError
+
+    def _iterparse(self, input):
+        '''Yields track points as soon as they are read, the whole tree is kept as with `parse`'''
+        self.track_points = []
+        self._applied = (0, 0)
+        with open_input(input) as f:
+            context = etree.iterparse(f, tag=self.track_point_tag)
+            for _, p in context:
+                self.track_points.append(p)
+                yield p
+        self.etree = context.root.getroottree()
+        self._find_track_points()
 
     def write(self, output):
-        self.etree.write(output, encoding='utf-8', xml_declaration=True, method='xml')
+        with open_output(output) as f:
+            self.etree.write(f, encoding='utf-8', xml_declaration=True, method='xml')
 
     def _get_longitude(self, point):
         raise NotImplementedError
@@ -34,42 +79,107 @@ class XMLDocument(TrainingDocument):
     def _get_latitude(self, point):
         raise NotImplementedError
 
+    def _get_position(self, point):
+        return self._get_longitude(point), self._get_latitude(point)
+
     def _create_altitude_elem(self):
         raise NotImplementedError
 
+    def _find_altitude_elem(self, point):
+        raise NotImplementedError
+
+    def _get_altitude(self, point):
+        altitude_elem = self._find_altitude_elem(point)
+        return altitude_elem.text if altitude_elem is not None else None
+
+    def _get_time(self, point):
+        raise NotImplementedError
+
+    def _add_point(self, store, point):
+        store.add(*self._get_position(point), altitude=self._get_altitude(point) if self.incremental else None,
+                  time=_timestamp(self._get_time(point)) if self.collect_times else None)
+
+    def _build_store(self, track_points):
+        store = TrackStore()
+        for p in track_points:
+            self._add_point(store, p)
+        return store.finish()
+
     def get_coordinates(self, max_points=0):
-        for p in self.track_points:
-            longitude = self._get_longitude(p)
-            latitude = self._get_latitude(p)
-            if longitude is not None and latitude is not None:
-                try:
-                    self.coordinates[(_normalized_float(longitude), _normalized_float(latitude))] = None
-                except ValueError:
-                    pass
-            if max_points and max_points <= len(self.coordinates):
-                self.coordinates = OrderedDict((k, self.coordinates[k]) for k in list(self.coordinates.keys())[0:max_points])
+        if self.store is None:
+            self.store = self._build_store(self.track_points)
+        self.coordinates = self.store.coordinates(max_points)
         return self.coordinates
 
-    def append_altitudes(self, coordinates):
+    def iter_coordinates(self, input):
+        '''Parses `input`, yielding (point, known altitude or None) of every unique point as soon as it is read.
+
+        Once exhausted, the document is in the same state as after `parse` and `get_coordinates`.
+        '''
+        self.store = TrackStore()
+        for p in self._iterparse(input):
+            count = len(self.store)
+            self._add_point(self.store, p)
+            if len(self.store) > count:
+                yield self.store.key(count), self.store.height(count)
+        self.store.finish()
+        self.coordinates = self.store.coordinates()
+
+    def append_altitudes(self, coordinates, settled=None):
+        '''Sets altitudes from `coordinates` on track points.
+
+        With `settled`, stops before the first track point whose unique point index is not lower than that,
+        e.g. because its altitude is still being fetched, and the next call continues from there.
+        '''
         if len(coordinates):
-            prev = 0
-            for p in self.track_points:
-                altitude_elem = self._create_altitude_elem()
-                longitude = self._get_longitude(p)
-                latitude = self._get_latitude(p)
-                if latitude is not None and longitude is not None:
-                    prev = coordinates.get((_normalized_float(longitude), _normalized_float(latitude))) or prev
-                altitude_elem.text = str(prev)
-                p.append(altitude_elem)
+            if self.store is None:
+                self.store = self._build_store(self.track_points)
+            position, prev = self._applied
+            indices = self.store.indices
+            while position < len(indices):
+                index = indices[position]
+                if settled is not None and index >= settled:
+                    break
+                if index >= 0:
+                    prev = coordinates.get(self.store.key(index)) or prev
+                self._set_altitude(self.track_points[position], prev)
+                position += 1
+            self._applied = (position, prev)
+
+    def get_lap_starts(self):
+        return self._lap_starts(self.etree.iter(*self._lap_tags()))
+
+    def _lap_tags(self):
+        return [tag for tag in (self.lap_tag, self.track_point_tag) if tag]
+
+    def _lap_starts(self, elements):
+        starts, count = [0], 0
+        for elem in elements:
+            if elem.tag == self.track_point_tag:
+                count += 1
+            elif count > starts[-1]:
+                starts.append(count)
+        return starts
+
+    def _set_altitude(self, point, altitude):
+        '''Sets altitude of `point`, updating its altitude element if it has one already'''
+        altitude_elem = self._find_altitude_elem(point)
+        if altitude_elem is None:
+            altitude_elem = self._create_altitude_elem()
+            point.append(altitude_elem)
+        elif self.incremental and _normalized_float(altitude_elem.text) is not None:
+            return
+        altitude_elem.text = str(altitude)
 
 
 class GPXDocument(XMLDocument):
     namespaces = {'gpx':'http://www.topografix.com/GPX/1/1',
                   'gpxx':'http://www.garmin.com/xmlschemas/GpxExtensions/v3',
                   'gpxtpx':'http://www.garmin.com/xmlschemas/TrackPointExtension/v1'}
+    track_point_tag = '{{{}}}trkpt'.format(namespaces['gpx'])
+    lap_tag = '{{{}}}trkseg'.format(namespaces['gpx'])
 
-    def parse(self, input):
-        super().parse(input)
+    def _find_track_points(self):
         self.track_points = self.etree.findall('.//gpx:trkpt', self.namespaces)
 
     def _get_longitude(self, point):
@@ -78,33 +188,699 @@ class GPXDocument(XMLDocument):
     def _get_latitude(self, point):
         return point.attrib.get('lat')
 
+    def _get_time(self, point):
+        return point.findtext('gpx:time', namespaces=self.namespaces)
+
     def _create_altitude_elem(self):
         return etree.Element('ele')
 
+    def _find_altitude_elem(self, point):
+        # elements created by this class have no namespace until the document is read again
+        altitude_elem = point.find('gpx:ele', self.namespaces)
+        return altitude_elem if altitude_elem is not None else point.find('ele')
+
 
 class TCXDocument(XMLDocument):
 
     namespaces = {'tcx':'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2',
                   'ae':'http://www.garmin.com/xmlschemas/ActivityExtension/v2'}
+    track_point_tag = '{{{}}}Trackpoint'.format(namespaces['tcx'])
+    lap_tag = '{{{}}}Lap'.format(namespaces['tcx'])
 
-    def parse(self, input):
-        super().parse(input)
+    def _find_track_points(self):
         self.laps = self.etree.findall('.//tcx:Lap', self.namespaces)
         self.track_points = self.etree.findall('.//tcx:Trackpoint', self.namespaces)
 
+    _longitude = etree.XPath('tcx:Position/tcx:LongitudeDegrees/text()', namespaces=namespaces)
+    _latitude = etree.XPath('tcx:Position/tcx:LatitudeDegrees/text()', namespaces=namespaces)
+
     def _get_longitude(self, point):
-        longitude = point.find('./tcx:Position/tcx:LongitudeDegrees', self.namespaces)
-        if longitude is not None:
-            return longitude.text
-        else:
-            return None
+        longitude = self._longitude(point)
+        return longitude[0] if longitude else None
 
     def _get_latitude(self, point):
-        latitude = point.find('./tcx:Position/tcx:LatitudeDegrees', self.namespaces)
-        if latitude is not None:
-            return latitude.text
-        else:
-            return None
+        latitude = self._latitude(point)
+        return latitude[0] if latitude else None
+
+    def _get_time(self, point):
+        return point.findtext('tcx:Time', namespaces=self.namespaces)
 
     def _create_altitude_elem(self):
         return etree.Element('AltitudeMeters')
+
+    def _find_altitude_elem(self, point):
+        altitude_elem = point.find('tcx:AltitudeMeters', self.namespaces)
+        return altitude_elem if altitude_elem is not None else point.find('AltitudeMeters')
+
+
+class StreamingXMLDocument(XMLDocument):
+    '''XML document processed with `etree.iterparse` instead of a full tree.
+
+    `get_coordinates` and `write` each read the input once and keep only the
+    currently processed track point, so memory usage does not grow with file
+    size. The input therefore has to be a file name or a seekable file object,
+    as it is read twice.
+    Output is byte for byte the same as `XMLDocument.write` would produce.
+    '''
+    xml_declaration = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+
+    def parse(self, input):
+        self.input = input
+        self.store = None
+        self.altitudes = OrderedDict()
+
+    def write(self, output):
+        with open_output(output) as out:
+            out.write(self.xml_declaration)
+            self._write_elements(out)
+
+    def get_coordinates(self, max_points=0):
+        if self.store is None:
+            self.store = self._build_store(self._iter_track_points())
+        return super().get_coordinates(max_points)
+
+    def _iterparse(self, input):
+        self.input = input
+        self.altitudes = OrderedDict()
+        return self._iter_track_points()
+
+    def _iter_events(self, **kwargs):
+        with open_input(self.input) as f:
+            yield from etree.iterparse(f, **kwargs)
+
+    def _iter_track_points(self):
+        for _, p in self._iter_events(tag=self.track_point_tag):
+            yield p
+            self._release(p)
+
+    def append_altitudes(self, coordinates, settled=None):
+        self.altitudes = coordinates
+
+    def get_lap_starts(self):
+        return self._lap_starts(self._iter_lap_elements())
+
+    def _iter_lap_elements(self):
+        for event, elem in self._iter_events(events=('start', 'end'), tag=self._lap_tags()):
+            if event == 'start':
+                yield elem
+            else:
+                self._release(elem)
+
+    def _write_elements(self, out):
+        if len(self.altitudes) and self.store is None:
+            self.store = self._build_store(self._iter_track_points())
+        altitudes = self.store.altitudes(self.altitudes) if len(self.altitudes) else None
+        indices = iter(self.store.indices) if len(self.altitudes) else None
+        prev = 0
+        pending = None
+        track_point = None
+        for event, elem in self._iter_events(events=('start', 'end', 'comment', 'pi')):
+            if track_point is not None:
+                if event == 'end' and elem is track_point:
+                    if altitudes is not None:
+                        index = next(indices)
+                        if index >= 0:
+                            prev = altitudes[index] or prev
+                        self._set_altitude(elem, prev)
+                    out.write(self._serialize(elem))
+                    self._release(elem)
+                    track_point = None
+                continue
+            if event == 'end':
+                if elem is pending:
+                    out.write(self._serialize(elem))
+                    pending = None
+                else:
+                    out.write(self._escape(elem[-1].tail))
+                    out.write(self._end_tag(elem))
+                self._release(elem)
+                continue
+            parent = elem.getparent()
+            if parent is not None and parent is pending:
+                # parent turned out to have children, open it before the first one
+                out.write(self._start_tag(parent))
+                out.write(self._escape(parent.text))
+                pending = None
+            elif parent is not None:
+                out.write(self._escape(elem.getprevious().tail))
+            if event != 'start':
+                out.write(self._serialize(elem))
+                self._release(elem)
+            elif elem.tag == self.track_point_tag:
+                track_point = elem
+            else:
+                pending = elem
+
+    def _release(self, elem):
+        elem.clear(keep_tail=True)
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+
+    def _serialize(self, elem):
+        data = etree.tostring(elem, encoding='utf-8', with_tail=False)
+        parent = elem.getparent()
+        if parent is None or not isinstance(elem.tag, str):
+            return data
+        # tostring() redeclares namespaces inherited from ancestors, which are already in scope
+        end = data.index(b'>')
+        start_tag = data[:end]
+        for prefix, uri in parent.nsmap.items():
+            declaration = ' xmlns="{}"'.format(uri) if prefix is None else ' xmlns:{}="{}"'.format(prefix, uri)
+            start_tag = start_tag.replace(declaration.encode('utf-8'), b'', 1)
+        return start_tag + data[end:]
+
+    def _start_tag(self, elem):
+        data = self._serialize(elem)
+        return data[:data.index(b'>') + 1]
+
+    def _end_tag(self, elem):
+        name = etree.QName(elem).localname
+        if elem.prefix:
+            name = '{}:{}'.format(elem.prefix, name)
+        return '</{}>'.format(name).encode('utf-8')
+
+    def _escape(self, text):
+        if not text:
+            return b''
+        text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+        return text.encode('utf-8')
+
+
+class StreamingGPXDocument(StreamingXMLDocument, GPXDocument):
+    pass
+
+
+class StreamingTCXDocument(StreamingXMLDocument, TCXDocument):
+    pass
+
+
+class TTBinDocument(TrainingDocument):
+    '''TomTom watch activity file (.ttbin), written as TCX or GPX (`output_format`).
+
+    Records are decoded with `struct` straight from a memoryview of the file into array columns, so
+    no XML is produced or parsed on the way in. Positions, cumulative distance, calories, speed and cadence
+    (steps or pedal revolutions) come from GPS records, heart rate from heart rate records and lap boundaries
+    from lap records, other records are skipped using the record lengths listed in the file header.
+    '''
+    TAG_FILE_HEADER = 0x20
+    TAG_STATUS = 0x21
+    TAG_GPS = 0x22
+    TAG_HEART_RATE = 0x25
+    TAG_LAP = 0x2f
+    # records with this length start with their own 16 bit length
+    VARIABLE_LENGTH = 0xffff
+    # file_version, firmware_version, product_id, start_time, software_version, gps_firmware_version,
+    # watch_time, local_time_offset, reserved, length_count
+    HEADER = struct.Struct('<H4sHI16s80sIiBB')
+    RECORD_LENGTH = struct.Struct('<BH')
+    # latitude, longitude (degrees * 1e7), heading, gps_speed, timestamp, calories, instant_speed,
+    # cum_distance, cycles
+    GPS = struct.Struct('<iiHHIHffB')
+    # heart_rate, reserved, timestamp
+    HEART_RATE = struct.Struct('<BBI')
+    # status, activity, timestamp
+    STATUS = struct.Struct('<BBI')
+    SPORTS = {0: 'Running', 1: 'Biking', 7: 'Running'}
+    GPX_NAMESPACE = 'http://www.topografix.com/GPX/1/1'
+    GPXTPX_NAMESPACE = 'http://www.garmin.com/xmlschemas/TrackPointExtension/v1'
+    TCX_NAMESPACE = 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'
+    TPX_NAMESPACE = 'http://www.garmin.com/xmlschemas/ActivityExtension/v2'
+
+    def __init__(self, output_format='tcx'):
+        super().__init__()
+        self.output_format = output_format.lower()
+        self.altitudes = OrderedDict()
+
+    def parse(self, input):
+        with open_input(input) as f:
+            data = memoryview(f.read())
+        if len(data) < 1 + self.HEADER.size or data[0] != self.TAG_FILE_HEADER:
+            raise ValueError('{} is not a ttbin file'.format(input))
+        length_count = self.HEADER.unpack_from(data, 1)[-1]
+        offset = 1 + self.HEADER.size
+        lengths = {}
+        for _ in range(length_count):
+            tag, length = self.RECORD_LENGTH.unpack_from(data, offset)
+            lengths[tag] = length
+            offset += self.RECORD_LENGTH.size
+        self.sport = 'Other'
+        self.latitudes = array('i')
+        self.longitudes = array('i')
+        self.timestamps = array('I')
+        self.distances = array('f')
+        self.calories = array('H')
+        self.speeds = array('f')
+        self.cycles = array('B')
+        self.heart_rates = array('B')
+        self.lap_starts = array('I', [0])
+        self.store = None
+        self.altitudes = OrderedDict()
+        heart_rate = 0
+        while offset < len(data):
+            tag = data[offset]
+            length = lengths.get(tag)
+            if length is None:
+                raise ValueError('{}: unknown record 0x{:02x} at offset {}'.format(input, tag, offset))
+            if length == self.VARIABLE_LENGTH:
+                length = 3 + struct.unpack_from('<H', data, offset + 1)[0]
+            if offset + length > len(data):
+                # the watch was switched off while writing
+                break
+            if tag == self.TAG_GPS:
+                lat, lon, _, _, timestamp, calories, speed, distance, cycles = \
+                    self.GPS.unpack_from(data, offset + 1)
+                # records before the first fix have no time
+                if timestamp:
+                    self.latitudes.append(lat)
+                    self.longitudes.append(lon)
+                    self.timestamps.append(timestamp)
+                    self.distances.append(distance)
+                    self.calories.append(calories)
+                    self.speeds.append(speed)
+                    self.cycles.append(cycles)
+                    self.heart_rates.append(heart_rate)
+            elif tag == self.TAG_HEART_RATE:
+                heart_rate = self.HEART_RATE.unpack_from(data, offset + 1)[0]
+            elif tag == self.TAG_STATUS:
+                activity = self.STATUS.unpack_from(data, offset + 1)[1]
+                self.sport = self.SPORTS.get(activity, self.sport)
+            elif tag == self.TAG_LAP and len(self.timestamps) > self.lap_starts[-1]:
+                self.lap_starts.append(len(self.timestamps))
+            offset += length
+
+    def _positions(self):
+        for lat, lon in zip(self.latitudes, self.longitudes):
+            if lat or lon:
+                yield lon / 1e7, lat / 1e7
+            else:
+                yield None, None
+
+    def _build_store(self):
+        store = TrackStore()
+        for position, timestamp in zip(self._positions(), self.timestamps):
+            store.add(*position, time=float(timestamp))
+        return store.finish()
+
+    def get_coordinates(self, max_points=0):
+        if self.store is None:
+            self.store = self._build_store()
+        self.coordinates = self.store.coordinates(max_points)
+        return self.coordinates
+
+    def iter_coordinates(self, input):
+        self.parse(input)
+        self.store = TrackStore()
+        for position, timestamp in zip(self._positions(), self.timestamps):
+            count = len(self.store)
+            self.store.add(*position, time=float(timestamp))
+            if len(self.store) > count:
+                yield self.store.key(count), None
+        self.store.finish()
+        self.coordinates = self.store.coordinates()
+
+    def append_altitudes(self, coordinates, settled=None):
+        self.altitudes = coordinates
+
+    def get_lap_starts(self):
+        return list(self.lap_starts)
+
+    def _point_altitudes(self):
+        '''Altitude of every track point, falling back to the previous one, or None without altitudes'''
+        if not len(self.altitudes):
+            return None
+        if self.store is None:
+            self.store = self._build_store()
+        altitudes = self.store.altitudes(self.altitudes)
+        result = []
+        prev = 0
+        for index in self.store.indices:
+            if index >= 0:
+                prev = altitudes[index] or prev
+            result.append(prev)
+        return result
+
+    def _time(self, timestamp):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+    def _laps(self):
+        '''Yields (first, end) track point index of every lap'''
+        ends = list(self.lap_starts[1:]) + [len(self.timestamps)]
+        for first, end in zip(self.lap_starts, ends):
+            if end > first:
+                yield first, end
+
+    def write(self, output):
+        altitudes = self._point_altitudes()
+        with open_output(output) as f:
+            out = io.TextIOWrapper(f, encoding='utf-8')
+            out.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+            if self.output_format == 'gpx':
+                self._write_gpx(out, altitudes)
+            else:
+                self._write_tcx(out, altitudes)
+            # leave closing of the underlying file to `open_output`
+            out.detach()
+
+    def _write_tcx(self, out, altitudes):
+        out.write('<TrainingCenterDatabase xmlns="{}">\n  <Activities>\n'.format(self.TCX_NAMESPACE))
+        if len(self.timestamps):
+            out.write('    <Activity Sport="{}">\n      <Id>{}</Id>\n'.format(
+                self.sport, self._time(self.timestamps[0])))
+            for first, end in self._laps():
+                # cumulative values at the start of the next lap, or at the last point
+                last = min(end, len(self.timestamps) - 1)
+                out.write('      <Lap StartTime="{}">\n'.format(self._time(self.timestamps[first])))
+                out.write('        <TotalTimeSeconds>{}</TotalTimeSeconds>\n'.format(
+                    self.timestamps[last] - self.timestamps[first]))
+                out.write('        <DistanceMeters>{:.2f}</DistanceMeters>\n'.format(
+                    self.distances[last] - self.distances[first]))
+                out.write('        <Calories>{}</Calories>\n'.format(max(self.calories[last] - self.calories[first], 0)))
+                out.write('        <Intensity>Active</Intensity>\n        <TriggerMethod>Manual</TriggerMethod>\n')
+                out.write('        <Track>\n')
+                for i in range(first, end):
+                    self._write_trackpoint(out, i, altitudes)
+                out.write('        </Track>\n      </Lap>\n')
+            out.write('    </Activity>\n')
+        out.write('  </Activities>\n</TrainingCenterDatabase>\n')
+
+    def _write_trackpoint(self, out, i, altitudes):
+        out.write('          <Trackpoint>\n            <Time>{}</Time>\n'.format(self._time(self.timestamps[i])))
+        if self.latitudes[i] or self.longitudes[i]:
+            out.write('            <Position>\n              <LatitudeDegrees>{}</LatitudeDegrees>\n'
+                      '              <LongitudeDegrees>{}</LongitudeDegrees>\n            </Position>\n'.format(
+                          self.latitudes[i] / 1e7, self.longitudes[i] / 1e7))
+        if altitudes is not None:
+            out.write('            <AltitudeMeters>{}</AltitudeMeters>\n'.format(altitudes[i]))
+        out.write('            <DistanceMeters>{:.2f}</DistanceMeters>\n'.format(self.distances[i]))
+        if self.heart_rates[i]:
+            out.write('            <HeartRateBpm>\n              <Value>{}</Value>\n            </HeartRateBpm>\n'.format(
+                self.heart_rates[i]))
+        if self.sport == 'Biking':
+            out.write('            <Cadence>{}</Cadence>\n'.format(self.cycles[i]))
+        # speed (m/s) and running cadence as ttbincnv exports them
+        out.write('            <Extensions>\n              <TPX xmlns="{}">\n'.format(self.TPX_NAMESPACE))
+        out.write('                <Speed>{:.2f}</Speed>\n'.format(self.speeds[i]))
+        if self.sport == 'Running':
+            out.write('                <RunCadence>{}</RunCadence>\n'.format(self.cycles[i]))
+        out.write('              </TPX>\n            </Extensions>\n          </Trackpoint>\n')
+
+    def _write_gpx(self, out, altitudes):
+        out.write('<gpx xmlns="{}" xmlns:gpxtpx="{}" version="1.1" creator="TrainingEnhancer">\n'.format(
+            self.GPX_NAMESPACE, self.GPXTPX_NAMESPACE))
+        if len(self.timestamps):
+            out.write(' <metadata>\n  <time>{}</time>\n </metadata>\n'.format(self._time(self.timestamps[0])))
+        out.write(' <trk>\n  <type>{}</type>\n'.format(self.sport))
+        for first, end in self._laps():
+            out.write('  <trkseg>\n')
+            for i in range(first, end):
+                # GPX can not hold points without a position
+                if not (self.latitudes[i] or self.longitudes[i]):
+                    continue
+                out.write('   <trkpt lat="{}" lon="{}">\n'.format(self.latitudes[i] / 1e7, self.longitudes[i] / 1e7))
+                if altitudes is not None:
+                    out.write('    <ele>{}</ele>\n'.format(altitudes[i]))
+                out.write('    <time>{}</time>\n'.format(self._time(self.timestamps[i])))
+                if self.heart_rates[i]:
+                    out.write('    <extensions>\n     <gpxtpx:TrackPointExtension>\n      <gpxtpx:hr>{}</gpxtpx:hr>\n'
+                              '     </gpxtpx:TrackPointExtension>\n    </extensions>\n'.format(self.heart_rates[i]))
+                out.write('   </trkpt>\n')
+            out.write('  </trkseg>\n')
+        out.write(' </trk>\n</gpx>\n')
+
+
+class CSVDocument(TrainingDocument):
+    '''Track as delimited text, a header row naming the columns followed by one track point per line.
+
+    Positions come from longitude and latitude columns (`lon`/`lat` and the like), altitudes are written to the
+    altitude column (`ele`, `elevation`, `alt` or `altitude`), which is added if there is none. The input is
+    read in blocks of whole lines, which are split into fields and converted to numbers with NumPy array
+    operations instead of line by line, and output blocks are spliced together from input bytes and altitudes
+    the same way. Blocks with quoted fields or lines with a different number of fields are handled line by line.
+
+    Like `StreamingXMLDocument` the input is read again to write it, so only the track store is kept in memory
+    and the input has to be a file name or a seekable file object.
+    '''
+    BLOCK_SIZE = 1024 * 1024
+    LONGITUDES = ('lon', 'long', 'longitude', 'lng')
+    LATITUDES = ('lat', 'latitude')
+    ALTITUDES = ('ele', 'elevation', 'alt', 'altitude')
+    TIMES = ('time', 'timestamp')
+    DELIMITERS = ',;\t'
+    incremental = False
+    collect_times = False
+
+    def __init__(self):
+        super().__init__()
+        self.altitudes = OrderedDict()
+
+    def parse(self, input):
+        self.input = input
+        self.store = None
+        self.altitudes = OrderedDict()
+        with open_input(input) as f:
+            self._read_header(f)
+
+    def _read_header(self, f):
+        self.header = f.readline()
+        text = self.header.decode('utf-8-sig').rstrip('\r\n')
+        self.delimiter = max(self.DELIMITERS, key=text.count)
+        names = [name.strip().strip('"\'').lower() for name in text.split(self.delimiter)]
+        self.width = len(names)
+
+        def column(aliases):
+            return next((i for i, name in enumerate(names) if name in aliases), None)
+
+        self.longitude, self.latitude = column(self.LONGITUDES), column(self.LATITUDES)
+        self.altitude, self.time = column(self.ALTITUDES), column(self.TIMES)
+        if self.longitude is None or self.latitude is None:
+            raise ValueError('{}: CSV header has no longitude and latitude columns'.format(self.input))
+
+    def _iter_blocks(self, f):
+        '''Yields (block of whole lines, whether a line end was added to its last line) after the header'''
+        rest = b''
+        while True:
+            data = f.read(self.BLOCK_SIZE)
+            if not data:
+                if rest:
+                    yield rest + b'\n', True
+                return
+            data = rest + data
+            end = data.rfind(b'\n') + 1
+            rest = data[end:]
+            if end:
+                yield data[:end], False
+
+    def _split(self, block, buf):
+        '''(field starts, field ends) of every line in `buf` as arrays of (lines, `width`) offsets, None if the
+        lines can not be split by NumPy: they have quoted fields or not `width` fields each'''
+        if b'"' in block:
+            return None
+        separators = np.flatnonzero((buf == ord(self.delimiter)) | (buf == ord('\n')))
+        if len(separators) % self.width:
+            return None
+        ends = separators.reshape(-1, self.width)
+        # every line ends with a line end, so if the last field of each one does, no other can
+        if len(ends) != block.count(b'\n') or not (buf[ends[:, -1]] == ord('\n')).all():
+            return None
+        starts = np.empty_like(ends)
+        starts[:, 1:] = ends[:, :-1] + 1
+        starts[0, 0] = 0
+        starts[1:, 0] = ends[:-1, -1] + 1
+        last = ends[:, -1]
+        last -= (buf[last - 1] == ord('\r')) & (last > starts[:, -1])
+        return starts, ends
+
+    def _numbers(self, buf, starts, ends):
+        '''Normalized numbers in `buf` between `starts` and `ends`, NaN where there are none'''
+        lengths = ends - starts
+        values = np.full(len(starts), np.nan)
+        filled = np.flatnonzero(lengths > 0)
+        if len(filled):
+            width = int(lengths.max())
+            offsets = np.arange(width)
+            chars = buf[np.minimum(starts[filled, None] + offsets, len(buf) - 1)]
+            chars[offsets >= lengths[filled, None]] = 0
+            strings = chars.view('S{}'.format(width)).ravel()
+            try:
+                values[filled] = strings.astype(np.float64)
+            except ValueError:
+                values[filled] = np.array([_normalized_float(s) for s in strings.tolist()], dtype=np.float64)
+        return _normalized_floats(values)
+
+    def _line_fields(self, line):
+        text = line.decode('utf-8', 'replace').rstrip('\r')
+        if '"' in text:
+            return next(csv.reader([text], delimiter=self.delimiter))
+        return text.split(self.delimiter)
+
+    def _lines(self, block):
+        '''Fields of every line of `block` which is not blank'''
+        return [self._line_fields(line) for line in block.split(b'\n')[:-1] if line.strip()]
+
+    def _columns(self, block):
+        '''(longitudes, latitudes, altitudes, times) of lines of `block` as arguments of `TrackStore.add_columns`'''
+        buf = np.frombuffer(block, dtype=np.uint8)
+        split = self._split(block, buf)
+        if split is not None:
+            starts, ends = split
+            rows = len(starts)
+
+            def numbers(column):
+                return self._numbers(buf, starts[:, column], ends[:, column])
+
+            def texts(column):
+                return [block[s:e].decode('utf-8', 'replace') for s, e in zip(starts[:, column].tolist(),
+                                                                              ends[:, column].tolist())]
+        else:
+            lines = self._lines(block)
+            rows = len(lines)
+
+            def texts(column):
+                return [fields[column] if column < len(fields) else None for fields in lines]
+
+            def numbers(column):
+                return _normalized_floats(np.array([_normalized_float(t) for t in texts(column)], dtype=np.float64))
+
+        heights = numbers(self.altitude) if self.incremental and self.altitude is not None else None
+        times = None
+        if self.collect_times:
+            times = np.full(rows, np.nan) if self.time is None else [_timestamp(t) for t in texts(self.time)]
+        return numbers(self.longitude), numbers(self.latitude), heights, times
+
+    def _iter_columns(self):
+        with open_input(self.input) as f:
+            self._read_header(f)
+            for block, _ in self._iter_blocks(f):
+                yield self._columns(block)
+
+    def get_coordinates(self, max_points=0):
+        if self.store is None:
+            self.store = TrackStore()
+            for columns in self._iter_columns():
+                self.store.add_columns(*columns)
+            self.store.finish()
+        self.coordinates = self.store.coordinates(max_points)
+        return self.coordinates
+
+    def iter_coordinates(self, input):
+        '''Reads `input`, yielding (point, known altitude or None) of unique points of every block as soon as
+        it is read'''
+        self.parse(input)
+        self.store = TrackStore()
+        for columns in self._iter_columns():
+            count = len(self.store)
+            self.store.add_columns(*columns)
+            for index in range(count, len(self.store)):
+                yield self.store.key(index), self.store.height(index)
+        self.store.finish()
+        self.coordinates = self.store.coordinates()
+
+    def append_altitudes(self, coordinates, settled=None):
+        self.altitudes = coordinates
+
+    def get_lap_starts(self):
+        return [0]
+
+    def write(self, output):
+        with open_input(self.input) as f, open_output(output) as out:
+            if not len(self.altitudes):
+                shutil.copyfileobj(f, out)
+                return
+            if self.store is None:
+                self.get_coordinates()
+            self._read_header(f)
+            out.write(self._output_header())
+            values = self.store.altitudes(self.altitudes)
+            # NaN at the end is the height of track points without position (index -1)
+            heights = np.array(values + [None], dtype=np.float64)
+            # integers are written without fraction, as `str` does
+            integral = np.array([isinstance(v, int) for v in values] + [False])
+            indices = np.frombuffer(self.store.indices, dtype=np.int32)
+            row, prev = 0, 0
+            for block, added in self._iter_blocks(f):
+                buf = np.frombuffer(block, dtype=np.uint8)
+                split = self._split(block, buf)
+                if split is None:
+                    data, row, prev = self._write_lines(block, values, indices, row, prev)
+                else:
+                    data, row, prev = self._write_block(buf, split, values, (heights, integral), indices, row, prev)
+                out.write(data[:-1] if added else data)
+
+    def _output_header(self):
+        if self.altitude is not None:
+            return self.header
+        text = self.header.rstrip(b'\r\n')
+        return text + self.delimiter.encode('utf-8') + b'altitude' + self.header[len(text):]
+
+    def _write_block(self, buf, split, values, heights, indices, row, prev):
+        '''Returns (lines of a block with altitudes set, next track point, altitude carried to the next block).
+        `heights` are (altitudes, whether they are integers) of unique points as NumPy arrays.'''
+        starts, ends = split
+        heights, integral = heights
+        rows = len(starts)
+        index = indices[row:row + rows]
+        # like `XMLDocument.append_altitudes`: points without altitude get the one of the point before
+        height = heights[index]
+        valid = ~np.isnan(height) & (height != 0)
+        source = np.maximum.accumulate(np.where(valid, np.arange(rows), -1))
+        point = index[source]
+        # every distinct altitude is formatted once, integers apart from equal floats
+        written = np.where(source >= 0, heights[point] + 1j * integral[point], float(prev) + 1j * isinstance(prev, int))
+        written, texts = np.unique(written, return_inverse=True)
+        prefix = b'' if self.altitude is not None else self.delimiter.encode('utf-8')
+        strings = [prefix + str(int(v.real) if v.imag else v.real).encode('utf-8') for v in written.tolist()]
+        lengths = np.array([len(t) for t in strings])
+        text_starts = len(buf) + np.cumsum(lengths) - lengths
+        if self.altitude is not None:
+            cut_start, cut_end = starts[:, self.altitude], ends[:, self.altitude]
+        else:
+            cut_start = cut_end = ends[:, -1]
+        insert_start, insert_length = text_starts[texts], lengths[texts]
+        if self.incremental and self.altitude is not None:
+            # altitudes present in the input are kept
+            keep = ~np.isnan(self._numbers(buf, cut_start, cut_end))
+            insert_start = np.where(keep, cut_start, insert_start)
+            insert_length = np.where(keep, cut_end - cut_start, insert_length)
+        line_ends = np.append(starts[1:, 0], len(buf))
+        segment_starts = np.stack([starts[:, 0], insert_start, cut_end], axis=1).ravel()
+        segment_lengths = np.stack([cut_start - starts[:, 0], insert_length, line_ends - cut_end], axis=1).ravel()
+        source_bytes = np.concatenate([buf, np.frombuffer(b''.join(strings), dtype=np.uint8)])
+        if valid.any():
+            prev = values[point[-1]]
+        return _splice(source_bytes, segment_starts, segment_lengths), row + rows, prev
+
+    def _write_lines(self, block, values, indices, row, prev):
+        '''`_write_block` of lines NumPy can not split'''
+        lines = []
+        for line in block.split(b'\n')[:-1]:
+            if not line.strip():
+                lines.append(line)
+                continue
+            ending = b'\r' if line.endswith(b'\r') else b''
+            fields = self._line_fields(line)
+            index = indices[row]
+            row += 1
+            if index >= 0:
+                prev = values[index] or prev
+            column = self.altitude if self.altitude is not None else max(len(fields), self.width)
+            fields.extend([''] * (column + 1 - len(fields)))
+            if not (self.incremental and _normalized_float(fields[column]) is not None):
+                fields[column] = str(prev)
+            if b'"' in line:
+                text = io.StringIO()
+                csv.writer(text, delimiter=self.delimiter, lineterminator='').writerow(fields)
+                text = text.getvalue()
+            else:
+                text = self.delimiter.join(fields)
+            lines.append(text.encode('utf-8') + ending)
+        lines.append(b'')
+        return b'\n'.join(lines), row, prev
+
+
+def _splice(source, starts, lengths):
+    '''Bytes of segments of NumPy byte array `source` at `starts` with `lengths`, one after another'''
+    total = int(lengths.sum())
+    offsets = np.cumsum(lengths) - lengths
+    return source[np.repeat(starts - offsets, lengths) + np.arange(total)].tobytes()
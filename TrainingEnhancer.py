@@ -1,21 +1,165 @@
 #!/usr/bin/env python3
+import json
+import os
 import sys
+import Analyzer
+import Batch
+import Daemon
+import Dispatcher
+import ElevationCache
+import ElevationProvider
+import ElevationService
 import Enhancer
+import Fetcher
+import HTTPService
+import Metrics
+import QueryPlanner
+import Segments
 import argparse
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('input', help = "Name of input TCX/GPX file")
-    parser.add_argument('output', help = "Name of output TCX/GPX file")
-    parser.add_argument('api_key', help = "Mapzen API Key")
-    parser.add_argument('-f', '--format', choices=['tcx','gpx','TCX','GPX', 'guess'], default='guess', help="Input and output file format. "
-                        "If none, try guessing from extension, or use TCX as fallback")
+    parser.add_argument('input', help = "Name of input TCX/GPX/ttbin file, may be gzip, bz2, xz or zstd "
+                        "compressed, '-' for standard input. With --batch: directory, glob pattern or "
+                        "manifest file listing inputs (and optionally outputs), one per line. With --daemon: "
+                        "directory to watch for new files, '-' for none")
+    parser.add_argument('output', help = "Name of output TCX/GPX/CSV file, compressed if it ends with .gz, .bz2, .xz "
+                        "or .zst, '-' for standard output. With --batch or --daemon: output directory")
+    parser.add_argument('api_key', nargs='?', help = "Mapzen API Key. Not needed with --dem")
+    parser.add_argument('-f', '--format', choices=['tcx','gpx','TCX','GPX','ttbin','TTBIN','csv','CSV', 'guess'], default='guess',
+                        help="Input and output file format. If none, recognize it from content or extension, or use "
+                        "TCX as fallback. TomTom ttbin input is written as GPX if output name ends with .gpx, as TCX otherwise")
+    parser.add_argument('-s', '--streaming', action='store_true', help="Process input incrementally instead of "
+                        "loading the whole document into memory. Use for very large files")
+    parser.add_argument('-w', '--workers', type=int, default=Fetcher.Fetcher.WORKERS,
+                        help="Maximum number of concurrent requests to elevation service")
+    parser.add_argument('-r', '--rate', type=float, default=Fetcher.Fetcher.RATE,
+                        help="Maximum number of requests per second sent to elevation service. 0 means no limit")
+    parser.add_argument('-c', '--cache', help="Path of persistent elevation cache database. "
+                        "Only points not found in the cache are sent to elevation service")
+    parser.add_argument('--cache-size', type=int, default=ElevationCache.ElevationCache.MAX_SIZE,
+                        help="Maximum number of points kept in elevation cache")
+    parser.add_argument('-d', '--dem', help="Directory with SRTM .hgt or GeoTIFF elevation tiles. "
+                        "If given, elevations are read from these files instead of elevation service")
+    parser.add_argument('--providers', metavar='NAME[=KEY],...',
+                        help="Comma separated elevation services to spread requests over ({}). Each chunk goes to the "
+                        "fastest healthy one and is duplicated to another one when it is slow. Services without "
+                        "a key use api_key".format(', '.join(ElevationService.SERVICES)))
+    parser.add_argument('--hedge-policy', choices=Dispatcher.HedgedDispatcher.POLICIES, default='first',
+                        help="Which heights win when several services answered: the first answer, the answer of "
+                        "the service listed first or the median")
+    parser.add_argument('--simplify', type=float, default=0, metavar='METRES',
+                        help="Only query points needed to keep the track within given distance from the original one, "
+                        "interpolate heights of the remaining points")
+    parser.add_argument('--reuse-radius', type=float, default=0, metavar='METRES',
+                        help="Resolve points within given distance of points with known elevation (earlier laps, "
+                        "cached tracks) locally, interpolating from them, instead of asking elevation service")
+    parser.add_argument('--query-order', choices=('track',) + tuple(QueryPlanner.CURVES), default='track',
+                        help="Order in which points are sent to elevation service. 'hilbert' and 'zorder' query "
+                        "points close to each other (e.g. laps, out-and-back routes) together, tile by tile, "
+                        "after the whole track is read")
+    parser.add_argument('--payload', choices=Enhancer.Enhancer.PAYLOADS, default='json',
+                        help="Encoding of points sent to elevation service. 'polyline' is several times smaller")
+    parser.add_argument('--post', action='store_true', help="Send points in request body instead of the url")
+    parser.add_argument('--max-request-bytes', type=int, help="Size limit of a single request. Requests are filled "
+                        "up to this size and split further if the service rejects them as too large")
+    parser.add_argument('-b', '--batch', action='store_true', help="Enhance many files at once. Files are parsed "
+                        "in parallel and points shared by them are fetched only once")
+    parser.add_argument('-p', '--processes', type=int, help="Number of worker processes in batch mode or with "
+                        "--split-activities. Defaults to number of CPUs")
+    parser.add_argument('--split-activities', action='store_true', help="Parse and write every activity of a TCX "
+                        "file with many of them in a separate process")
+    parser.add_argument('--daemon', action='store_true', help="Keep running and enhance files appearing in input "
+                        "directory or submitted through --socket with EnhancerClient.py")
+    parser.add_argument('--socket', help="Unix socket on which daemon accepts jobs")
+    parser.add_argument('--jobs', type=int, default=Daemon.EnhancerDaemon.JOBS,
+                        help="Number of files daemon or HTTP service enhances concurrently")
+    parser.add_argument('--http', metavar='[HOST:]PORT', help="Serve POST /enhance over HTTP: uploaded documents "
+                        "are enhanced and streamed back. Input and output are not used then, pass '-'")
+    parser.add_argument('--poll', action='store_true', help="Poll watched directory instead of using inotify")
+    parser.add_argument('-i', '--incremental', action='store_true', help="Keep altitudes already present in the "
+                        "input and only resolve points without them")
+    parser.add_argument('--checkpoint', help="Journal resolved altitudes to this file, so that an interrupted run "
+                        "resumes where it stopped when started again with the same file. Removed once output is written")
+    parser.add_argument('--sidecar', action='store_true', help="Keep parsed track and resolved altitudes in a "
+                        "binary <INPUT>.track.npz file next to the input and use it while the input is unchanged")
+    parser.add_argument('--analysis', help="Write distance, ascent and descent of the track and of every lap as "
+                        "JSON to this file ('-' for stdout). Single file mode only")
+    parser.add_argument('--smoothing', type=int, default=Analyzer.Analyzer.SMOOTHING,
+                        help="Number of track points elevation is averaged over before computing ascent and grade")
+    parser.add_argument('--metrics', help="Write stage timings, request counters and latency histograms to this file "
+                        "when finished: Prometheus textfile if it ends with .prom, JSON otherwise, '-' for stdout")
     args = parser.parse_args()
-    enh = Enhancer.Enhancer(args.input, args.output, args.api_key, format=args.format)
-    enh.parse()
-    enh.get_altitudes()
-    enh.write()
+    metrics = Metrics.Metrics()
+    try:
+        return run(parser, args, metrics)
+    finally:
+        if args.metrics:
+            metrics.write(args.metrics)
+
+
+def run(parser, args, metrics):
+    if args.dem and args.providers:
+        parser.error('--dem can not be used with --providers')
+    provider = ElevationProvider.DEMProvider(args.dem) if args.dem else None
+    if args.providers:
+        try:
+            services = [ElevationService.create_service(spec, args.api_key, Fetcher.Fetcher(
+                workers=args.workers, rate=args.rate, metrics=metrics)) for spec in args.providers.split(',')]
+        except ValueError as e:
+            parser.error(str(e))
+        provider = Dispatcher.HedgedDispatcher(services, policy=args.hedge_policy, workers=args.workers,
+                                               metrics=metrics)
+    cache = ElevationCache.ElevationCache(args.cache, args.cache_size) if args.cache else None
+    options = dict(workers=args.workers, rate=args.rate, cache=cache, provider=provider, simplify=args.simplify,
+                   payload=args.payload, method='POST' if args.post else 'GET',
+                   max_request_bytes=args.max_request_bytes, metrics=metrics, incremental=args.incremental,
+                   sidecar=args.sidecar, reuse_radius=args.reuse_radius, query_order=args.query_order)
+    if args.http:
+        host, _, port = args.http.rpartition(':')
+        service = HTTPService.EnhancerService(args.api_key, format=args.format, streaming=args.streaming,
+                                              jobs=args.jobs, **options)
+        service.run(host or '127.0.0.1', int(port))
+        return 0
+    if args.daemon:
+        if args.checkpoint:
+            parser.error('--checkpoint can not be used with --daemon')
+        watch_dir = None if args.input == '-' else args.input
+        if watch_dir and os.path.abspath(watch_dir) == os.path.abspath(args.output):
+            parser.error('output directory must differ from the watched one')
+        os.makedirs(args.output, exist_ok=True)
+        daemon = Daemon.EnhancerDaemon(args.api_key, output_dir=args.output, format=args.format,
+                                       streaming=args.streaming, jobs=args.jobs, **options)
+        daemon.run(socket_path=args.socket, watch_dir=watch_dir, poll=args.poll)
+        return 0
+    if args.batch:
+        os.makedirs(args.output, exist_ok=True)
+        batch = Batch.BatchEnhancer(Batch.find_inputs(args.input, args.output), args.api_key, format=args.format,
+                                    processes=args.processes, streaming=args.streaming, checkpoint=args.checkpoint,
+                                    **options)
+        return 0 if batch.run() else 1
+    output = args.output
+    if output == '-':
+        # keep messages out of the written document
+        output = sys.stdout.buffer
+        sys.stdout = sys.stderr
+    if args.split_activities:
+        if args.streaming or args.analysis or args.format.lower() not in ('tcx', 'guess'):
+            parser.error('--split-activities works with TCX files only, without --streaming and --analysis')
+        Segments.SegmentedEnhancer(args.input, output, args.api_key, processes=args.processes,
+                                   checkpoint=args.checkpoint, **options).enhance()
+        return 0
+    enh = Enhancer.Enhancer(args.input, output, args.api_key, format=args.format, streaming=args.streaming,
+                            checkpoint=args.checkpoint, **options)
+    enh.enhance()
+    if args.analysis:
+        summary = json.dumps(enh.analyze(Analyzer.Analyzer(args.smoothing)).summary(), indent=2)
+        if args.analysis == '-':
+            print(summary)
+        else:
+            with open(args.analysis, 'w') as f:
+                f.write(summary)
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+'''Generator of synthetic TCX and GPX tracks of any size, written incrementally'''
+import argparse
+import math
+import random
+import sys
+from datetime import datetime, timedelta
+
+TCX_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2" xmlns:ae="http://www.garmin.com/xmlschemas/ActivityExtension/v2">
+  <Activities>
+'''
+TCX_FOOTER = '''  </Activities>
+</TrainingCenterDatabase>
+'''
+TCX_POINT = '''          <Trackpoint>
+            <Time>{time}</Time>
+            <Position>
+              <LatitudeDegrees>{lat:.7f}</LatitudeDegrees>
+              <LongitudeDegrees>{lon:.7f}</LongitudeDegrees>
+            </Position>
+            <DistanceMeters>{distance:.1f}</DistanceMeters>
+            <HeartRateBpm>
+              <Value>{hr}</Value>
+            </HeartRateBpm>
+            <Extensions>
+              <ae:TPX>
+                <ae:Speed>{speed:.2f}</ae:Speed>
+              </ae:TPX>
+            </Extensions>
+          </Trackpoint>
+'''
+GPX_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1" xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" version="1.1" creator="TrainingEnhancer benchmark">
+ <trk>
+  <name>Synthetic</name>
+'''
+GPX_FOOTER = ''' </trk>
+</gpx>
+'''
+GPX_POINT = '''   <trkpt lat="{lat:.7f}" lon="{lon:.7f}"><time>{time}</time><extensions><gpxtpx:TrackPointExtension><gpxtpx:hr>{hr}</gpxtpx:hr></gpxtpx:TrackPointExtension></extensions></trkpt>
+'''
+START = datetime(2017, 1, 1, 10, 0, 0)
+
+
+def track(points, seed=0, lap_length=400):
+    '''Yields dicts describing 1 Hz points of a noisy run along a closed loop of `lap_length` seconds'''
+    rnd = random.Random(seed)
+    distance = 0
+    for i in range(points):
+        angle = 2 * math.pi * i / lap_length
+        speed = 3 + rnd.random()
+        distance += speed
+        yield dict(time=(START + timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                   lat=51.1 + 0.005 * math.sin(angle) + rnd.gauss(0, 0.00002),
+                   lon=17.0 + 0.008 * math.cos(angle) + rnd.gauss(0, 0.00002),
+                   distance=distance, speed=speed, hr=140 + rnd.randint(-10, 10))
+
+
+def write_tcx(out, points, lap_size=1000, activities=1, seed=0):
+    out.write(TCX_HEADER)
+    per_activity = -(-points // activities) if points else 0
+    generator = track(points, seed)
+    written = 0
+    for a in range(activities):
+        count = min(per_activity, points - written)
+        if count <= 0:
+            break
+        start = (START + timedelta(seconds=written)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        out.write('    <Activity Sport="Running">\n      <Id>{}</Id>\n'.format(start))
+        for lap in range(0, count, lap_size):
+            out.write('      <Lap StartTime="{}">\n        <Track>\n'.format(start))
+            for _ in range(min(lap_size, count - lap)):
+                out.write(TCX_POINT.format(**next(generator)))
+            out.write('        </Track>\n      </Lap>\n')
+        out.write('    </Activity>\n')
+        written += count
+    out.write(TCX_FOOTER)
+
+
+def write_gpx(out, points, seed=0, **kwargs):
+    out.write(GPX_HEADER)
+    out.write('  <trkseg>\n')
+    for p in track(points, seed):
+        out.write(GPX_POINT.format(**p))
+    out.write('  </trkseg>\n')
+    out.write(GPX_FOOTER)
+
+
+def generate(path, format, points, **kwargs):
+    with open(path, 'w', encoding='utf-8', buffering=1024 * 1024) as out:
+        (write_gpx if format.lower() == 'gpx' else write_tcx)(out, points, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('format', choices=['tcx', 'gpx'])
+    parser.add_argument('points', type=int, help="Number of track points")
+    parser.add_argument('output', help="Name of output file")
+    parser.add_argument('--lap-size', type=int, default=1000, help="Track points per lap (TCX only)")
+    parser.add_argument('--activities', type=int, default=1, help="Number of activities (TCX only)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    kwargs = dict(seed=args.seed)
+    if args.format == 'tcx':
+        kwargs.update(lap_size=args.lap_size, activities=args.activities)
+    generate(args.output, args.format, args.points, **kwargs)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+'''Per-stage benchmark of Enhancer against a local stand-in elevation service.
+
+Every case (format, number of points) runs in a fresh process, so peak RSS is measured per case.
+Results can be saved as a baseline and later runs compared against it.
+'''
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+from Enhancer import Enhancer
+from generate import generate
+from server import ElevationServer
+
+STAGES = ('parse', 'get_coordinates', 'build_request_urls', 'get_altitudes', 'append_altitudes', 'write')
+BASELINE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+# stages faster than that are not reported as regressions, they are dominated by noise
+MIN_SECONDS = 0.05
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(input, output, url, options):
+    '''Runs all stages on `input`, returns {stage: {'seconds':..., 'rss_mb':...}}'''
+    results = {}
+    enhancer = Enhancer(input, output, 'benchmark', **options)
+    enhancer.API_URL = url
+
+    def stage(name, function):
+        start = time.perf_counter()
+        result = function()
+        results[name] = {'seconds': round(time.perf_counter() - start, 4), 'rss_mb': round(peak_rss_mb(), 1)}
+        return result
+
+    stage('parse', lambda: enhancer.document.parse(input))
+    enhancer.coordinates = stage('get_coordinates', enhancer.document.get_coordinates)
+    stage('build_request_urls', lambda: list(enhancer._build_request_urls()))
+    stage('get_altitudes', enhancer.fetch_altitudes)
+    stage('append_altitudes', lambda: enhancer.document.append_altitudes(enhancer.coordinates))
+    stage('write', enhancer.write)
+    return results
+
+
+def run(sizes, formats, data_dir, server, options):
+    results = {}
+    for format in formats:
+        for points in sizes:
+            input = os.path.join(data_dir, 'track_{}.{}'.format(points, format))
+            if not os.path.exists(input):
+                generate(input, format, points)
+            output = os.path.join(data_dir, 'enhanced.{}'.format(format))
+            server.reset()
+            with ProcessPoolExecutor(1) as executor:
+                stages = executor.submit(run_case, input, output, server.url, options).result()
+            os.remove(output)
+            name = '{}:{}'.format(format, points)
+            results[name] = dict(stages=stages, requests=server.stats['requests'],
+                                 throttled=server.stats['throttled'], rejected=server.stats['rejected'],
+                                 tiles=server.stats['tiles'])
+            print_case(name, results[name])
+    return results
+
+
+def print_case(name, result):
+    print('{} ({} requests, {} throttled, {} rejected, {} tiles)'.format(
+        name, result['requests'], result['throttled'], result['rejected'], result.get('tiles', 0)))
+    for stage in STAGES:
+        values = result['stages'][stage]
+        print('  {:<20} {:>10.4f} s {:>10.1f} MB'.format(stage, values['seconds'], values['rss_mb']))
+
+
+def compare(results, baseline, tolerance):
+    '''Returns list of (case, stage, seconds, baseline seconds) slower than baseline by more than tolerance'''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for stage in STAGES:
+            seconds = result['stages'][stage]['seconds']
+            expected = baseline[name]['stages'].get(stage, {}).get('seconds')
+            if expected is not None and seconds > expected * (1 + tolerance) and seconds - expected > MIN_SECONDS:
+                regressions.append((name, stage, seconds, expected))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,100000', help="Comma separated numbers of track points")
+    parser.add_argument('--formats', default='tcx,gpx', help="Comma separated formats")
+    parser.add_argument('--data-dir', help="Directory for generated tracks, reused between runs")
+    parser.add_argument('--streaming', action='store_true', help="Use streaming documents")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--payload', default='json')
+    parser.add_argument('--post', action='store_true')
+    parser.add_argument('--query-order', default='track')
+    parser.add_argument('--latency', type=float, default=0, help="Latency of stand-in elevation service")
+    parser.add_argument('--throttle', type=float, default=0, help="Fraction of requests answered with 429")
+    parser.add_argument('--max-url', type=int, default=0, help="Stand-in answers longer urls with 414")
+    parser.add_argument('--baseline', default=BASELINE, help="Baseline results file")
+    parser.add_argument('--save-baseline', action='store_true', help="Store results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed slowdown against baseline")
+    parser.add_argument('--output', help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='enhancer-benchmark-')
+    os.makedirs(data_dir, exist_ok=True)
+    options = dict(streaming=args.streaming, workers=args.workers, rate=0, payload=args.payload,
+                   method='POST' if args.post else 'GET', query_order=args.query_order)
+    server = ElevationServer(latency=args.latency, throttle=args.throttle, max_url=args.max_url).start()
+    try:
+        results = run([int(s) for s in args.sizes.split(',')], args.formats.split(','), data_dir, server, options)
+    finally:
+        server.stop()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, stage, seconds, expected in regressions:
+            print('[REGRESSION]: {} {}: {:.4f} s, baseline {:.4f} s'.format(name, stage, seconds, expected))
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
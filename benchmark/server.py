@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+'''Local stand-in for the elevation service.
+
+Understands the same requests as Enhancer sends (GET with `json` parameter or POST with JSON body, `shape`
+or `encoded_polyline` payload) and answers with synthetic heights. Latency, throttling (429) and request size
+limits (413/414) can be configured to exercise the client.
+'''
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import _decode_polyline
+
+
+# degrees of the square tiles a tile based service would load to answer a request
+TILE_SIZE = 0.01
+
+
+def height(lon, lat):
+    return int(round(150 + 40 * math.sin(lat * 700) + 25 * math.cos(lon * 500)))
+
+
+class ElevationHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if self.server.max_url and len(self.path) > self.server.max_url:
+            return self._reject(414, 'URI too long')
+        params = urllib.parse.parse_qs(url.query)
+        self._handle(params.get('json', ['{}'])[0], len(self.path))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.server.max_body and length > self.server.max_body:
+            return self._reject(413, 'payload too large')
+        self._handle(body.decode('utf-8'), len(self.path) + length)
+
+    def _handle(self, data, size):
+        server = self.server
+        with server.lock:
+            server.stats['requests'] += 1
+            server.stats['bytes'] += size
+            throttled = server.random.random() < server.throttle
+            if throttled:
+                server.stats['throttled'] += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if throttled:
+            return self._reply(429, {'error': 'too many requests'}, {'Retry-After': str(server.retry_after)})
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            return self._reply(400, {'error': 'invalid json'})
+        if 'encoded_polyline' in payload:
+            points = _decode_polyline(payload['encoded_polyline'])
+        else:
+            points = [(p['lon'], p['lat']) for p in payload.get('shape', [])]
+        with server.lock:
+            server.stats['points'] += len(points)
+            server.stats['tiles'] += len(set((math.floor(lon / TILE_SIZE), math.floor(lat / TILE_SIZE))
+                                             for lon, lat in points))
+        payload['height'] = [height(lon, lat) for lon, lat in points]
+        self._reply(200, payload)
+
+    def _reject(self, status, error):
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+            self.server.stats['rejected'] += 1
+        self._reply(status, {'error': error})
+
+    def _reply(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ElevationServer(ThreadingHTTPServer):
+    '''Stand-in elevation service listening on `url`, `stats` counts what it has seen'''
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0, throttle=0, retry_after=0, max_url=0, max_body=0, seed=0):
+        super().__init__(('127.0.0.1', port), ElevationHandler)
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.max_url = max_url
+        self.max_body = max_body
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/height'.format(*self.server_address)
+
+    def reset(self):
+        self.stats = dict(requests=0, throttled=0, rejected=0, points=0, bytes=0, tiles=0)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help="Seconds added to every response")
+    parser.add_argument('--throttle', type=float, default=0, help="Fraction of requests answered with 429")
+    parser.add_argument('--retry-after', type=float, default=0, help="Retry-After sent with 429 responses")
+    parser.add_argument('--max-url', type=int, default=0, help="Longer GET urls are answered with 414")
+    parser.add_argument('--max-body', type=int, default=0, help="Larger POST bodies are answered with 413")
+    args = parser.parse_args()
+    server = ElevationServer(args.port, args.latency, args.throttle, args.retry_after, args.max_url, args.max_body)
+    print('Serving on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    sys.exit(main())
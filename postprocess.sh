@@ -6,11 +6,16 @@ if [ $# -eq 0 ]
     fi
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
 API_KEY=${MAPZEN_API_KEY}
+# Socket of a running `TrainingEnhancer.py --daemon`, if any
+SOCKET=${ENHANCER_SOCKET}
 TTBIN=$1
 BASE=$(basename $TTBIN .ttbin)
-if [ ! -f ${BASE}.tcx ] ; then 
-   ttbincnv -E -t ${TTBIN}
-fi
 if [[ $TTBIN == *"Running"* ]]; then
-    python3 ${DIR}/TrainingEnhancer.py ${BASE}.tcx ${BASE}.out.tcx $API_KEY
+    # the enhancer reads ttbin files itself, no conversion needed
+    if [ -n "$SOCKET" ] && [ -S "$SOCKET" ] ; then
+        python3 ${DIR}/EnhancerClient.py $SOCKET ${TTBIN} ${BASE}.out.tcx && exit 0
+    fi
+    python3 ${DIR}/TrainingEnhancer.py ${TTBIN} ${BASE}.out.tcx $API_KEY
+elif [ ! -f ${BASE}.tcx ] ; then
+   ttbincnv -E -t ${TTBIN}
 fi
@@ -13,3 +13,70 @@ def test_key():
 @pytest.fixture
 def test_input():
     return 'test_input.xml'
+
+
+TCX_SAMPLE = '''<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2" xmlns:ae="http://www.garmin.com/xmlschemas/ActivityExtension/v2">
+  <Activities>
+    <!-- exported -->
+    <Activity Sport="Running">
+      <Id>2017-01-01T10:00:00Z</Id>
+      <Lap StartTime="2017-01-01T10:00:00Z">
+        <Notes/>
+        <Track>
+          <Trackpoint>
+            <Time>2017-01-01T10:00:00Z</Time>
+            <Position>
+              <LatitudeDegrees>51.100001</LatitudeDegrees>
+              <LongitudeDegrees>17.000001</LongitudeDegrees>
+            </Position>
+            <Extensions><ae:TPX><ae:Speed>1.0</ae:Speed></ae:TPX></Extensions>
+          </Trackpoint>
+          <Trackpoint>
+            <Time>2017-01-01T10:00:01Z</Time>
+          </Trackpoint>
+          <Trackpoint>
+            <Time>2017-01-01T10:00:02Z</Time>
+            <Position>
+              <LatitudeDegrees>51.100101</LatitudeDegrees>
+              <LongitudeDegrees>17.000201</LongitudeDegrees>
+            </Position>
+          </Trackpoint>
+          <Trackpoint>
+            <Time>2017-01-01T10:00:03Z</Time>
+            <Position>
+              <LatitudeDegrees>51.100001</LatitudeDegrees>
+              <LongitudeDegrees>17.000001</LongitudeDegrees>
+            </Position>
+          </Trackpoint>
+        </Track>
+      </Lap>
+    </Activity>
+  </Activities>
+</TrainingCenterDatabase>
+'''
+
+GPX_SAMPLE = '''<?xml version="1.0" encoding="UTF-8"?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1" xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" version="1.1" creator="a &amp; b">
+ <metadata><name>Łódź &amp; &lt;x&gt;</name><desc/></metadata>
+ <trk><name>t</name><trkseg>
+  <trkpt lat="51.100001" lon="17.000001"><time>2017-01-01T10:00:00Z</time><extensions><gpxtpx:TrackPointExtension><gpxtpx:hr>120</gpxtpx:hr></gpxtpx:TrackPointExtension></extensions></trkpt>
+  <trkpt lat="51.100101" lon="17.000201"/>
+  <trkpt lat="51.100001" lon="17.000001"><time>2017-01-01T10:00:02Z</time></trkpt>
+ </trkseg></trk>
+</gpx>
+'''
+
+
+@pytest.fixture
+def tcx_file(tmpdir):
+    path = tmpdir.join('sample.tcx')
+    path.write_text(TCX_SAMPLE, encoding='utf-8')
+    return str(path)
+
+
+@pytest.fixture
+def gpx_file(tmpdir):
+    path = tmpdir.join('sample.gpx')
+    path.write_text(GPX_SAMPLE, encoding='utf-8')
+    return str(path)
@@ -0,0 +1,81 @@
+import math
+import numpy as np
+import pytest
+from unittest.mock import Mock
+
+from Analyzer import Analyzer, haversine
+from Enhancer import Enhancer
+from TrackStore import TrackStore
+from TrainingDocument import StreamingTCXDocument, TCXDocument
+
+
+class TestAnalyzer(object):
+
+    def test_haversine(self):
+        # one degree of latitude
+        assert haversine(17.0, 51.0, 17.0, 52.0) == pytest.approx(111195, rel=1e-4)
+        assert haversine(np.array([0.0]), np.array([0.0]), np.array([0.0]), np.array([0.0]))[0] == 0
+
+    def test_analyze(self):
+        # 100 m steps to the north, up 10 m, then down 20 m, one point without position
+        step = 100 / 111195.08
+        latitudes = [51.0, 51.0 + step, np.nan, 51.0 + 2 * step, 51.0 + 3 * step]
+        longitudes = [17.0, 17.0, np.nan, 17.0, 17.0]
+        elevations = [100, 110, np.nan, 110, 90]
+        analysis = Analyzer(smoothing=1).analyze(longitudes, latitudes, elevations, lap_starts=[0, 3])
+        assert analysis.distance == pytest.approx([0, 100, 100, 200, 300], abs=0.01)
+        assert analysis.elevation.tolist() == [100, 110, 110, 110, 90]
+        assert analysis.grade[[1, 3, 4]] == pytest.approx([10, 0, -20], abs=0.01)
+        assert math.isnan(analysis.grade[2])
+        summary = analysis.summary()
+        assert summary['distance'] == 300
+        assert (summary['ascent'], summary['descent']) == (10, 20)
+        assert [(lap['start'], lap['points'], lap['ascent'], lap['descent']) for lap in summary['laps']] == \
+            [(0, 3, 10, 0), (3, 2, 0, 20)]
+        assert summary['laps'][1]['min_elevation'] == 90
+
+    def test_smoothing(self):
+        elevations = [100, 104, 100, 104, 100, 104]
+        rough = Analyzer(smoothing=1).analyze([17.0] * 6, [51.0] * 6, elevations).summary()
+        smooth = Analyzer(smoothing=3).analyze([17.0] * 6, [51.0] * 6, elevations).summary()
+        assert rough['ascent'] == 12
+        assert smooth['ascent'] < 3
+
+    def test_no_elevations(self):
+        analysis = Analyzer().analyze([17.0, 17.1], [51.0, 51.0], [np.nan, np.nan])
+        assert analysis.summary()['ascent'] == 0
+        assert analysis.laps[0]['max_elevation'] is None
+        assert Analyzer().analyze([], [], []).laps == []
+
+    def test_analyze_store(self):
+        store = TrackStore()
+        for position in (('17.0', '51.0'), (None, None), ('17.0', '51.001'), ('17.0', '51.0')):
+            store.add(*position)
+        analysis = Analyzer(smoothing=1).analyze_store(store.finish(), {(17.0, 51.0): 100, (17.0, 51.001): 120})
+        assert analysis.elevation.tolist() == [100, 100, 120, 100]
+        assert analysis.summary()['ascent'] == 20
+
+    @pytest.mark.parametrize('streaming', (False, True))
+    def test_enhancer(self, tcx_file, streaming):
+        provider = Mock()
+        provider.get_heights = Mock(return_value=[100, 110])
+        enhancer = Enhancer(tcx_file, None, None, provider=provider, streaming=streaming)
+        enhancer.parse()
+        enhancer.get_altitudes()
+        summary = enhancer.analyze(Analyzer(smoothing=1)).summary()
+        assert summary['ascent'] == 10
+        assert summary['descent'] == 10
+        assert len(summary['laps']) == 1
+        assert summary['distance'] == pytest.approx(35.7, abs=0.1)
+
+    @pytest.mark.parametrize('document_class', (TCXDocument, StreamingTCXDocument))
+    def test_lap_starts(self, tcx_file, document_class):
+        with open(tcx_file) as f:
+            content = f.read()
+        # split the lap before the third track point
+        second = content.index('<Trackpoint>', content.index('10:00:01Z'))
+        with open(tcx_file, 'w') as f:
+            f.write(content[:second] + '</Track></Lap><Lap StartTime="x"><Track>' + content[second:])
+        document = document_class()
+        document.parse(tcx_file)
+        assert document.get_lap_starts() == [0, 2]
@@ -0,0 +1,90 @@
+import os
+import pytest
+from lxml import etree
+from unittest.mock import Mock, patch
+
+from Batch import BatchEnhancer, find_inputs
+from TrainingDocument import TCXDocument, GPXDocument
+
+
+class TestFindInputs(object):
+
+    @pytest.fixture
+    def input_dir(self, tmpdir):
+        for name in ('a.tcx', 'b.GPX', 'c.txt'):
+            tmpdir.join(name).write('')
+        return tmpdir
+
+    def test_directory(self, input_dir):
+        assert find_inputs(str(input_dir), 'out') == \
+            [(str(input_dir.join('a.tcx')), os.path.join('out', 'a.tcx')),
+             (str(input_dir.join('b.GPX')), os.path.join('out', 'b.GPX'))]
+
+    def test_glob(self, input_dir):
+        assert find_inputs(str(input_dir.join('*.tcx')), 'out') == \
+            [(str(input_dir.join('a.tcx')), os.path.join('out', 'a.tcx'))]
+
+    def test_manifest(self, input_dir):
+        manifest = input_dir.join('manifest.txt')
+        manifest.write('# comment\n/x/a.tcx\n\n/x/b.gpx /y/c.gpx\n/x/d.ttbin\n')
+        assert find_inputs(str(manifest), 'out') == \
+            [('/x/a.tcx', os.path.join('out', 'a.tcx')), ('/x/b.gpx', '/y/c.gpx'),
+             ('/x/d.ttbin', os.path.join('out', 'd.tcx'))]
+
+
+class TestBatchEnhancer(object):
+
+    def test_run(self, tmpdir, tcx_file, gpx_file):
+        broken = tmpdir.join('broken.tcx')
+        broken.write('<not xml')
+        out = tmpdir.mkdir('out')
+        pairs = [(tcx_file, str(out.join('a.tcx'))), (str(broken), str(out.join('b.tcx'))),
+                 (gpx_file, str(out.join('c.gpx')))]
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [100] * len(points))
+        batch = BatchEnhancer(pairs, None, processes=2, provider=provider)
+        with patch('builtins.print'):
+            assert not batch.run()
+        # both documents share the same two points, they are fetched once
+        provider.get_heights.assert_called_once_with([(17.0, 51.1), (17.0002, 51.1001)])
+        assert list(batch.failures) == [str(broken)]
+        # the parse error itself, not a failure to pickle it
+        assert 'pickle' not in batch.failures[str(broken)] and 'line 1' in batch.failures[str(broken)]
+        assert batch.enhanced == [tcx_file, gpx_file]
+        for document, name, tag in ((TCXDocument(), 'a.tcx', 'AltitudeMeters'), (GPXDocument(), 'c.gpx', 'ele')):
+            document.parse(str(out.join(name)))
+            assert [p[-1].text for p in document.track_points] == ['100'] * len(document.track_points)
+            assert all(etree.QName(p[-1]).localname == tag for p in document.track_points)
+        assert not out.join('b.tcx').exists()
+
+    @pytest.mark.parametrize('streaming', (False, True))
+    def test_sidecar(self, tmpdir, tcx_file, streaming):
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [100] * len(points))
+        outputs = []
+        for run in ('first', 'second'):
+            out = tmpdir.mkdir(run)
+            batch = BatchEnhancer([(tcx_file, str(out.join('a.tcx')))], None, processes=1, provider=provider,
+                                  streaming=streaming, sidecar=True)
+            with patch('builtins.print'):
+                assert batch.run()
+            outputs.append(out.join('a.tcx').read_binary())
+        assert os.path.exists(tcx_file + '.track.npz')
+        assert b'<AltitudeMeters>100</AltitudeMeters>' in outputs[0]
+        assert outputs[0] == outputs[1]
+
+    def test_parsed_once(self, tmpdir, tcx_file):
+        # workers keep documents they parsed until they write them (they are forked, so they are patched too)
+        log = tmpdir.join('parsed.log')
+        parse = TCXDocument.parse
+        def logged_parse(document, input):
+            with open(str(log), 'a') as f:
+                f.write(input + '\n')
+            return parse(document, input)
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [100] * len(points))
+        out = tmpdir.mkdir('out')
+        with patch.object(TCXDocument, 'parse', logged_parse), patch('builtins.print'):
+            assert BatchEnhancer([(tcx_file, str(out.join('a.tcx')))], None, processes=1, provider=provider).run()
+        assert log.read().splitlines() == [tcx_file]
+        assert b'<AltitudeMeters>100</AltitudeMeters>' in out.join('a.tcx').read_binary()
@@ -0,0 +1,27 @@
+from Checkpoint import Checkpoint
+
+
+class TestCheckpoint(object):
+
+    def test_append_load(self, tmpdir):
+        path = str(tmpdir.join('checkpoint'))
+        checkpoint = Checkpoint(path)
+        assert checkpoint.load() == {}
+        checkpoint.append([((17.0, 51.1), 100), ((17.1, 51.2), None)])
+        checkpoint.append([])
+        checkpoint.append([((17.2, 51.3), 120.5)])
+        checkpoint.close()
+        assert Checkpoint(path).load() == {(17.0, 51.1): 100, (17.2, 51.3): 120.5}
+
+    def test_truncated_line(self, tmpdir):
+        path = tmpdir.join('checkpoint')
+        path.write('[[17.0, 51.1, 100]]\n[[17.1, 51.2, 1')
+        assert Checkpoint(str(path)).load() == {(17.0, 51.1): 100}
+
+    def test_remove(self, tmpdir):
+        path = tmpdir.join('checkpoint')
+        checkpoint = Checkpoint(str(path))
+        checkpoint.append([((17.0, 51.1), 100)])
+        checkpoint.remove()
+        assert not path.exists()
+        checkpoint.remove()
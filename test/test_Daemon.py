@@ -0,0 +1,73 @@
+import queue
+import time
+import pytest
+from unittest.mock import Mock, patch
+
+from Daemon import EnhancerDaemon, Poller
+from EnhancerClient import submit
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.01)
+
+
+class TestEnhancerDaemon(object):
+
+    @pytest.fixture
+    def provider(self):
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [100] * len(points))
+        return provider
+
+    @pytest.fixture
+    def daemon(self, tmpdir, provider):
+        daemon = EnhancerDaemon(None, output_dir=str(tmpdir.mkdir('out')), provider=provider, queue_size=2)
+        yield daemon
+        daemon.stop()
+
+    def test_socket(self, daemon, tmpdir, tcx_file):
+        socket_path = str(tmpdir.join('enhancer.sock'))
+        with patch('builtins.print'):
+            daemon.start(socket_path=socket_path)
+            assert submit(socket_path, tcx_file) == {'queued': True}
+            assert submit(socket_path, tcx_file, str(tmpdir.join('other.tcx')), 'tcx') == {'queued': True}
+            daemon.queue.join()
+        assert tmpdir.join('out', 'sample.tcx').read().count('<AltitudeMeters>100</AltitudeMeters>') == 4
+        assert tmpdir.join('other.tcx').exists()
+
+    def test_queue_full(self, daemon, tcx_file):
+        daemon.submit(tcx_file)
+        daemon.submit(tcx_file)
+        with pytest.raises(queue.Full):
+            daemon.submit(tcx_file)
+
+    def test_output(self, provider):
+        assert EnhancerDaemon(None)._output('/x/a.tcx') == '/x/a.out.tcx'
+        assert EnhancerDaemon(None, output_dir='/y')._output('/x/a.tcx') == '/y/a.tcx'
+
+    @pytest.mark.parametrize('poll', (True, False))
+    def test_watch(self, daemon, tmpdir, tcx_file, poll):
+        watched = tmpdir.mkdir('in')
+        daemon.POLL_INTERVAL = 0.05
+        with patch('builtins.print'):
+            daemon.start(watch_dir=str(watched), poll=poll)
+            time.sleep(0.1)
+            watched.join('new.tcx').write_binary(open(tcx_file, 'rb').read())
+            watched.join('ignored.txt').write('')
+            wait_for(lambda: tmpdir.join('out', 'new.tcx').exists())
+            daemon.queue.join()
+        assert not tmpdir.join('out', 'ignored.txt').exists()
+
+
+class TestPoller(object):
+
+    def test_read(self, tmpdir):
+        tmpdir.join('old').write('')
+        poller = Poller(str(tmpdir))
+        tmpdir.join('new').write('')
+        assert poller.read(0) == []
+        assert poller.read(0) == ['new']
+        assert poller.read(0) == []
@@ -0,0 +1,140 @@
+import json
+import time
+import pytest
+from unittest.mock import Mock
+
+from Dispatcher import HedgedDispatcher, ServiceStats
+from ElevationService import ElevationService, GoogleService, MapzenService, OpenElevationService, create_service
+
+
+class FakeService(ElevationService):
+    '''Answers `height` for every point after `delay` seconds, fails if `height` is an exception'''
+
+    def __init__(self, name, height, delay=0):
+        super().__init__(fetcher=Mock())
+        self.NAME = name
+        self.height = height
+        self.delay = delay
+        self.calls = 0
+
+    def fetch(self, points):
+        self.calls += 1
+        time.sleep(self.delay)
+        if isinstance(self.height, Exception):
+            raise self.height
+        return [self.height] * len(points)
+
+
+def response(jsn, status_code=200):
+    return Mock(ok=status_code < 400, status_code=status_code, json=Mock(return_value=jsn))
+
+
+class TestElevationService(object):
+    points = [(17.0, 51.0), (17.1, 51.1)]
+
+    def test_mapzen(self):
+        service = MapzenService('key', fetcher=Mock())
+        service.fetcher.fetch.return_value = response({'height': [100, 110]})
+        assert service.get_heights(self.points) == [100, 110]
+        url = service.fetcher.fetch.call_args[0][0]
+        assert url.startswith(MapzenService.API_URL) and 'api_key=key' in url
+
+    def test_google(self):
+        service = GoogleService('key', fetcher=Mock())
+        service.fetcher.fetch.return_value = response(
+            {'status': 'OK', 'results': [{'elevation': 100.123}, {'elevation': 110.0}]})
+        assert service.fetch(self.points) == [100.1, 110.0]
+        assert 'locations=enc%3A' in service.fetcher.fetch.call_args[0][0]
+        service.fetcher.fetch.return_value = response({'status': 'OVER_QUERY_LIMIT', 'results': []})
+        with pytest.raises(ValueError):
+            service.fetch(self.points)
+
+    def test_open_elevation(self):
+        service = OpenElevationService(fetcher=Mock())
+        service.fetcher.fetch.return_value = response({'results': [{'elevation': 100}, {'elevation': 110}]})
+        assert service.fetch(self.points) == [100, 110]
+        request = service.fetcher.fetch.call_args[0][0]
+        assert json.loads(request.data)['locations'][1] == {'latitude': 51.1, 'longitude': 17.1}
+
+    def test_failures(self):
+        service = MapzenService('key', fetcher=Mock())
+        service.fetcher.fetch.return_value = response({'height': [100]})
+        with pytest.raises(ValueError):
+            service.fetch(self.points)
+        service.fetcher.fetch.return_value = response({}, 500)
+        assert service.get_heights(self.points) == [None, None]
+
+    def test_create_service(self):
+        service = create_service('google=secret', api_key='default')
+        assert isinstance(service, GoogleService) and service.api_key == 'secret'
+        assert create_service('mapzen', api_key='default').api_key == 'default'
+        with pytest.raises(ValueError):
+            create_service('unknown')
+
+
+class TestServiceStats(object):
+
+    def test_stats(self):
+        stats = ServiceStats()
+        assert stats.latency == 0 and stats.p95 is None and stats.healthy()
+        for i in range(20):
+            stats.record(i / 100, True)
+        assert stats.p95 == 0.19
+        for _ in range(25):
+            stats.record(1, False)
+        assert stats.error_rate > 0.5
+        assert not stats.healthy()
+
+
+class TestHedgedDispatcher(object):
+    points = [(17.0, 51.0 + i / 100) for i in range(10)]
+
+    def test_fastest_healthy(self):
+        slow, fast = FakeService('slow', 100, delay=0.02), FakeService('fast', 110)
+        dispatcher = HedgedDispatcher([slow, fast], chunk_size=5, hedge_after=1)
+        dispatcher.get_heights(self.points)
+        # a service not asked yet counts as fastest, once both were asked the faster one gets all chunks
+        calls = slow.calls
+        assert dispatcher.get_heights(self.points) == [110] * 10
+        assert slow.calls == calls
+
+    def test_failover(self):
+        broken, working = FakeService('broken', ValueError('broken')), FakeService('working', 110)
+        dispatcher = HedgedDispatcher([broken, working], chunk_size=5)
+        assert dispatcher.get_heights(self.points) == [110] * 10
+        assert dispatcher.metrics.counters['service_broken_errors'] >= 1
+        assert HedgedDispatcher([broken]).get_heights(self.points) == [None] * 10
+
+    def test_failover_unexpected(self):
+        # e.g. a Google answer without results
+        broken, working = FakeService('broken', KeyError('results')), FakeService('working', 110)
+        dispatcher = HedgedDispatcher([broken, working], chunk_size=5)
+        dispatcher.stats[id(working)].record(1, True)
+        assert dispatcher.get_heights(self.points) == [110] * 10
+        assert dispatcher.metrics.counters['service_broken_errors'] >= 1
+
+    def test_hedge(self):
+        stuck, spare = FakeService('stuck', 100, delay=0.5), FakeService('spare', 110, delay=0.01)
+        dispatcher = HedgedDispatcher([stuck, spare], hedge_after=0.05)
+        # make the stuck one look fastest so that it is asked first
+        dispatcher.stats[id(spare)].record(1, True)
+        start = time.monotonic()
+        assert dispatcher.get_heights(self.points) == [110] * 10
+        assert time.monotonic() - start < 0.4
+        assert dispatcher.metrics.counters['hedged_requests'] == 1
+        assert dispatcher.metrics.counters['hedge_wins'] == 1
+
+    @pytest.mark.parametrize('policy, expected', (('first', 110), ('priority', 100), ('median', 105)))
+    def test_policy(self, policy, expected):
+        # the preferred service answers after the other one, but within another hedge delay
+        preferred, other = FakeService('preferred', 100, delay=0.1), FakeService('other', 110)
+        dispatcher = HedgedDispatcher([preferred, other], policy=policy, hedge_after=0.08)
+        dispatcher.stats[id(other)].record(1, True)
+        assert dispatcher.get_heights(self.points[:2]) == [expected] * 2
+        assert dispatcher.metrics.counters.get('disagreements', 0) == (0 if policy == 'first' else 2)
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            HedgedDispatcher([])
+        with pytest.raises(ValueError):
+            HedgedDispatcher([FakeService('a', 1)], policy='unknown')
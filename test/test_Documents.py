@@ -1,9 +1,19 @@
 import pytest
+import struct
 from collections import OrderedDict
 from lxml import etree
-from unittest.mock import patch, call, Mock
+from unittest.mock import patch, call, Mock, MagicMock
+
+from TrainingDocument import TCXDocument, GPXDocument, XMLDocument, StreamingTCXDocument, StreamingGPXDocument, \
+    TTBinDocument, CSVDocument
+
+@pytest.fixture
+def opened_input():
+    '''Patches opening of document inputs, returns the file object documents get'''
+    opened = Mock()
+    with patch('TrainingDocument.open_input', return_value=MagicMock(__enter__=Mock(return_value=opened))):
+        yield opened
 
-from TrainingDocument import TCXDocument, GPXDocument, XMLDocument
 
 @pytest.fixture
 def track_points():
@@ -54,6 +64,7 @@ class TestXMLDocument(object):
         document._get_latitude = Mock(side_effect = range(5))
         document._get_longitude = Mock(side_effect = range(5))
         document._create_altitude_elem = Mock(return_value = altitude_elem)
+        document._find_altitude_elem = Mock(return_value = None)
         return document
 
     @pytest.mark.parametrize('limit', (0, None))
@@ -93,48 +104,73 @@ class TestTCXDocument(object):
     def document(self):
         return TCXDocument()
 
-    def test_parse(self, document, test_input, track_points, mock_etree):
+    def test_parse(self, document, test_input, track_points, mock_etree, opened_input):
         with patch.object(etree, 'parse', return_value = mock_etree) as parse_mock:
             document.parse(test_input)
             assert document.track_points == track_points
-            parse_mock.assert_called_once_with(test_input)
+            parse_mock.assert_called_once_with(opened_input)
             assert mock_etree.findall.call_count == 2
             assert mock_etree.findall.call_args_list[1][0] == ('.//tcx:Trackpoint', document.namespaces)
             assert mock_etree.findall.call_args_list[0][0] == ('.//tcx:Lap', document.namespaces)
 
+    @pytest.fixture
+    def tcx_track_points(self, document):
+        points = []
+        tcx = '{{{}}}'.format(document.namespaces['tcx'])
+        for x in range(5):
+            point = etree.Element(tcx + 'Trackpoint')
+            position = etree.SubElement(point, tcx + 'Position')
+            etree.SubElement(position, tcx + 'LatitudeDegrees').text = str(x)
+            etree.SubElement(position, tcx + 'LongitudeDegrees').text = str(x)
+            points.append(point)
+        points.append(etree.Element(tcx + 'Trackpoint'))
+        return points
+
     @pytest.mark.parametrize('limit', (0, None))
-    def test_get_coordinates(self, limit, document, track_points):
-        document.track_points = track_points
+    def test_get_coordinates(self, limit, document, tcx_track_points):
+        document.track_points = tcx_track_points
         if limit is None:
             document.get_coordinates()
         else:
             document.get_coordinates(limit)
         assert document.coordinates =={(x,x):None  for x in range(5)}
-        for p in track_points:
-            assert p.find.call_count == 2
-            assert p.find.call_args_list == \
-                [call('./tcx:Position/tcx:LongitudeDegrees', document.namespaces),
-                 call('./tcx:Position/tcx:LatitudeDegrees', document.namespaces)]
+        assert list(document.store.indices) == [0, 1, 2, 3, 4, -1]
 
     @pytest.mark.parametrize('limit', (1,4,5,6))
-    def test_get_coordinates_limited(self, limit, document, track_points):
-        document.track_points = track_points
+    def test_get_coordinates_limited(self, limit, document, tcx_track_points):
+        document.track_points = tcx_track_points
         document.get_coordinates(limit)
         assert document.coordinates =={(x, x):None  for x in range(min(5,limit))}
-        for p in track_points[0:min(5,limit)]:
-            assert p.find.call_count == 2
-            assert p.find.call_args_list == \
-                [call('./tcx:Position/tcx:LongitudeDegrees', document.namespaces),
-                    call('./tcx:Position/tcx:LatitudeDegrees', document.namespaces)]
 
-    def test_append_altitudes(self, document, track_points):
-        coordinates = OrderedDict((((p.val, p.val), p.val) for p in track_points))
-        document.track_points = track_points
+    def test_append_altitudes(self, document, tcx_track_points):
+        coordinates = OrderedDict((((x, x), x + 1) for x in range(5)))
+        document.track_points = tcx_track_points
         document.append_altitudes(coordinates)
-        for p in document.track_points:
-            assert p.append.call_count == 1
-            (altitude,) = p.append.call_args[0]
-            assert altitude.text == str(p.val)
+        for p, expected in zip(document.track_points, ['1', '2', '3', '4', '5', '5']):
+            assert p[-1].tag == 'AltitudeMeters'
+            assert p[-1].text == expected
+
+    @pytest.mark.parametrize('incremental, expected', ((False, ['1', '2', '3', '4', '5', '5']),
+                                                        (True, ['1', '2', '30', '4', '5', '5'])))
+    def test_append_altitudes_in_place(self, document, tcx_track_points, incremental, expected):
+        tcx = '{{{}}}'.format(document.namespaces['tcx'])
+        etree.SubElement(tcx_track_points[2], tcx + 'AltitudeMeters').text = '30'
+        document.incremental = incremental
+        document.track_points = tcx_track_points
+        coordinates = document.get_coordinates()
+        assert coordinates[(2, 2)] == (30 if incremental else None)
+        coordinates.update(((x, x), x + 1) for x in range(5) if coordinates[(x, x)] is None)
+        document.append_altitudes(coordinates)
+        for p, expected in zip(document.track_points, expected):
+            assert len(p.xpath('*[local-name()="AltitudeMeters"]')) == 1
+            assert document._get_altitude(p) == expected
+
+    def test_append_altitudes_reuses_store(self, document, tcx_track_points):
+        document.track_points = tcx_track_points
+        document.get_coordinates()
+        with patch.object(TCXDocument, '_get_position') as position_mock:
+            document.append_altitudes(OrderedDict((((x, x), x) for x in range(5))))
+            assert position_mock.call_count == 0
 
 
 class TestGPXDocument(object):
@@ -143,11 +179,11 @@ class TestGPXDocument(object):
     def document(self):
         return GPXDocument()
 
-    def test_parse(self, document, test_input, track_points, mock_etree):
+    def test_parse(self, document, test_input, track_points, mock_etree, opened_input):
         with patch.object(etree, 'parse', return_value = mock_etree) as parse_mock:
             document.parse(test_input)
             assert document.track_points == track_points
-            parse_mock.assert_called_once_with(test_input)
+            parse_mock.assert_called_once_with(opened_input)
             mock_etree.findall.assert_called_once_with('.//gpx:trkpt', document.namespaces)
 
     @pytest.mark.parametrize('limit', (0, None))
@@ -171,9 +207,203 @@ class TestGPXDocument(object):
 
     def test_append_altitudes(self, document, track_points):
         coordinates = OrderedDict((((p.val, p.val), p.val) for p in track_points))
+        for p in track_points:
+            p.find = Mock(return_value=None)
         document.track_points = track_points
         document.append_altitudes(coordinates)
         for p in document.track_points:
             assert p.append.call_count == 1
             (altitude,) = p.append.call_args[0]
             assert altitude.text ==  str(p.val)
+
+
+class TestStreamingDocuments(object):
+
+    def _enhance(self, document, input, output):
+        document.parse(input)
+        coordinates = document.get_coordinates()
+        document.append_altitudes(OrderedDict((k, i + 0.5) for i, k in enumerate(coordinates)))
+        document.write(output)
+        return coordinates
+
+    @pytest.mark.parametrize('document_class, streaming_class, input_fixture',
+        ((TCXDocument, StreamingTCXDocument, 'tcx_file'),
+         (GPXDocument, StreamingGPXDocument, 'gpx_file')))
+    def test_output_equal(self, request, tmpdir, document_class, streaming_class, input_fixture):
+        input = request.getfixturevalue(input_fixture)
+        expected = self._enhance(document_class(), input, str(tmpdir.join('tree.xml')))
+        coordinates = self._enhance(streaming_class(), input, str(tmpdir.join('streaming.xml')))
+        assert coordinates == expected
+        assert tmpdir.join('streaming.xml').read_binary() == tmpdir.join('tree.xml').read_binary()
+
+    @pytest.mark.parametrize('limit', (1, 2, 3))
+    def test_get_coordinates_limited(self, tcx_file, limit):
+        document = StreamingTCXDocument()
+        document.parse(tcx_file)
+        assert list(document.get_coordinates(limit)) == [(17.0, 51.1), (17.0002, 51.1001)][0:limit]
+
+    def test_write_without_altitudes(self, tmpdir, tcx_file):
+        document = StreamingTCXDocument()
+        document.parse(tcx_file)
+        document.write(str(tmpdir.join('out.tcx')))
+        tree = TCXDocument()
+        tree.parse(tcx_file)
+        tree.write(str(tmpdir.join('tree.tcx')))
+        assert tmpdir.join('out.tcx').read_binary() == tmpdir.join('tree.tcx').read_binary()
+
+
+def write_ttbin(path, records, lengths=None):
+    '''Writes a ttbin file with given (tag, payload) records'''
+    lengths = lengths or {0x21: 7, 0x22: 28, 0x25: 7, 0x2f: 11, 0x35: 5}
+    data = bytearray([TTBinDocument.TAG_FILE_HEADER])
+    data += TTBinDocument.HEADER.pack(7, b'\x01\x0b\x00\x00', 14, 1483264800, b'', b'', 1483264800, 3600, 0,
+                                      len(lengths))
+    for tag, length in sorted(lengths.items()):
+        data += TTBinDocument.RECORD_LENGTH.pack(tag, length)
+    for tag, payload in records:
+        data += bytes([tag]) + payload
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def gps(lat, lon, timestamp, distance, calories=0, speed=0, cycles=0):
+    return TTBinDocument.TAG_GPS, TTBinDocument.GPS.pack(int(lat * 1e7), int(lon * 1e7), 0, 0, timestamp,
+                                                         calories, speed, distance, cycles)
+
+
+class TestTTBinDocument(object):
+
+    @pytest.fixture
+    def ttbin_file(self, tmpdir):
+        path = str(tmpdir.join('activity.ttbin'))
+        write_ttbin(path, [
+            (0x21, TTBinDocument.STATUS.pack(0, 0, 1483264800)),
+            gps(0, 0, 0, 0),
+            (0x25, TTBinDocument.HEART_RATE.pack(120, 0, 1483264800)),
+            gps(51.1, 17.0, 1483264800, 0),
+            (0x35, b'\x00\x00\x00\x00'),
+            gps(51.1001, 17.0002, 1483264801, 2.5, 1, 2.5, 3),
+            (0x2f, struct.pack('<IfH', 1, 2.5, 1)),
+            gps(0, 0, 1483264802, 2.5, 1),
+            gps(51.1, 17.0, 1483264803, 5, 2),
+            (0x22, b'\x00' * 5)])
+        return path
+
+    def test_parse(self, ttbin_file):
+        document = TTBinDocument()
+        document.parse(ttbin_file)
+        assert document.sport == 'Running'
+        assert list(document.timestamps) == [1483264800 + x for x in range(4)]
+        assert list(document.heart_rates) == [120] * 4
+        assert list(document.cycles) == [0, 3, 0, 0]
+        assert list(document.lap_starts) == [0, 2]
+        assert list(document.get_coordinates()) == [(17.0, 51.1), (17.0002, 51.1001)]
+
+    def test_parse_invalid(self, tmpdir):
+        path = tmpdir.join('x.ttbin')
+        path.write_binary(b'<?xml')
+        with pytest.raises(ValueError):
+            TTBinDocument().parse(str(path))
+
+    def test_iter_coordinates(self, ttbin_file):
+        document = TTBinDocument()
+        assert list(document.iter_coordinates(ttbin_file)) == [((17.0, 51.1), None), ((17.0002, 51.1001), None)]
+        assert list(document.store.indices) == [0, 1, -1, 0]
+
+    @pytest.mark.parametrize('output_format', ('tcx', 'gpx'))
+    def test_write(self, tmpdir, ttbin_file, output_format):
+        document = TTBinDocument(output_format)
+        document.parse(ttbin_file)
+        document.append_altitudes(OrderedDict((((17.0, 51.1), 100), ((17.0002, 51.1001), 110))))
+        output = str(tmpdir.join('out.' + output_format))
+        document.write(output)
+        if output_format == 'tcx':
+            written = TCXDocument()
+            written.parse(output)
+            assert len(written.laps) == 2
+            assert [p.findtext('tcx:AltitudeMeters', namespaces=written.namespaces) for p in written.track_points] \
+                == ['100', '110', '110', '100']
+            assert written.laps[0].findtext('tcx:DistanceMeters', namespaces=written.namespaces) == '2.50'
+            tpx = {'tpx': TTBinDocument.TPX_NAMESPACE}
+            assert [p.findtext('.//tpx:Speed', namespaces=tpx) for p in written.track_points] \
+                == ['0.00', '2.50', '0.00', '0.00']
+            assert [p.findtext('.//tpx:RunCadence', namespaces=tpx) for p in written.track_points] \
+                == ['0', '3', '0', '0']
+        else:
+            written = GPXDocument()
+            written.parse(output)
+            assert [p.findtext('gpx:ele', namespaces=written.namespaces) for p in written.track_points] \
+                == ['100', '110', '100']
+        assert list(written.get_coordinates()) == [(17.0, 51.1), (17.0002, 51.1001)]
+
+
+class TestCSVDocument(object):
+    CSV = (b'time,lat,long,hr\r\n2017-01-01T10:00:00Z,51.100001,17.000001,120\r\n2017-01-01T10:00:01Z,,,121\r\n'
+           b'2017-01-01T10:00:02Z,51.2,17.1,122\r\n2017-01-01T10:00:03Z,51.1,17.0,123')
+    altitudes = OrderedDict((((17.0, 51.1), 100), ((17.1, 51.2), 110.5)))
+
+    @pytest.fixture(params=(1024, 16), ids=('vectorized', 'blocks'))
+    def document(self, request, tmpdir):
+        path = tmpdir.join('track.csv')
+        path.write_binary(self.CSV)
+        document = CSVDocument()
+        document.BLOCK_SIZE = request.param
+        document.parse(str(path))
+        return document
+
+    def test_get_coordinates(self, document):
+        assert list(document.get_coordinates().items()) == [((17.0, 51.1), None), ((17.1, 51.2), None)]
+        assert list(document.store.indices) == [0, -1, 1, 0]
+        assert list(document.get_coordinates(1)) == [(17.0, 51.1)]
+
+    def test_iter_coordinates(self, document):
+        assert list(document.iter_coordinates(document.input)) == [((17.0, 51.1), None), ((17.1, 51.2), None)]
+        assert list(document.store.indices) == [0, -1, 1, 0]
+
+    def test_write(self, document, tmpdir):
+        document.get_coordinates()
+        document.append_altitudes(self.altitudes)
+        document.write(str(tmpdir.join('out.csv')))
+        assert tmpdir.join('out.csv').read_binary() == (
+            b'time,lat,long,hr,altitude\r\n2017-01-01T10:00:00Z,51.100001,17.000001,120,100\r\n'
+            b'2017-01-01T10:00:01Z,,,121,100\r\n2017-01-01T10:00:02Z,51.2,17.1,122,110.5\r\n'
+            b'2017-01-01T10:00:03Z,51.1,17.0,123,100')
+
+    def test_write_without_altitudes(self, document, tmpdir):
+        document.write(str(tmpdir.join('out.csv')))
+        assert tmpdir.join('out.csv').read_binary() == self.CSV
+
+    @pytest.mark.parametrize('block_size', (1024, 8))
+    @pytest.mark.parametrize('incremental, expected', ((False, [b'100', b'110.5', b'100']),
+                                                       (True, [b'95', b'110.5', b'100'])))
+    def test_altitude_column(self, tmpdir, block_size, incremental, expected):
+        path = tmpdir.join('track.csv')
+        path.write_binary(b'lon;ele;lat\n17.0;95;51.1\n17.1;;51.2\n\n17.0;x;51.1\n')
+        document = CSVDocument()
+        document.BLOCK_SIZE = block_size
+        document.incremental = incremental
+        document.parse(str(path))
+        known = list(document.get_coordinates().values())
+        assert known == ([95, None] if incremental else [None, None])
+        document.append_altitudes(self.altitudes)
+        document.write(str(tmpdir.join('out.csv')))
+        lines = tmpdir.join('out.csv').read_binary().split(b'\n')
+        assert lines[0] == b'lon;ele;lat' and lines[3] == b''
+        assert [line.split(b';')[1] for line in lines[1:3] + lines[4:5]] == expected
+
+    def test_quoted(self, tmpdir):
+        path = tmpdir.join('track.csv')
+        path.write_binary(b'name,lat,lon\n"a, b",51.1,17.0\nc,51.2,17.1,extra\n')
+        document = CSVDocument()
+        document.parse(str(path))
+        assert list(document.get_coordinates()) == [(17.0, 51.1), (17.1, 51.2)]
+        document.append_altitudes(self.altitudes)
+        document.write(str(tmpdir.join('out.csv')))
+        assert tmpdir.join('out.csv').read_binary() == \
+            b'name,lat,lon,altitude\n"a, b",51.1,17.0,100\nc,51.2,17.1,extra,110.5\n'
+
+    def test_no_position_columns(self, tmpdir):
+        path = tmpdir.join('track.csv')
+        path.write_binary(b'time,hr\n0,120\n')
+        with pytest.raises(ValueError):
+            CSVDocument().parse(str(path))
@@ -0,0 +1,53 @@
+import pytest
+
+from ElevationCache import ElevationCache
+
+
+class TestElevationCache(object):
+
+    @pytest.fixture
+    def path(self, tmpdir):
+        return str(tmpdir.join('cache.sqlite'))
+
+    @pytest.fixture
+    def cache(self, path):
+        cache = ElevationCache(path, max_size=3)
+        yield cache
+        cache.close()
+
+    def test_get_empty(self, cache):
+        assert cache.get([(1.0, 2.0)]) == {}
+        assert cache.hits == 0
+        assert cache.misses == 1
+
+    def test_put_get(self, cache):
+        cache.put([((1.0, 2.0), 10), ((1.5, 2.5), None), ((3.0, None), 5)])
+        assert len(cache) == 1
+        assert cache.get([(1.0, 2.0), (1.5, 2.5), (3.0, None)]) == {(1.0, 2.0): 10}
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+    def test_types(self, cache, path):
+        cache.put([((1.0, 2.0), 119), ((1.5, 2.5), 119.0)])
+        found = cache.get([(1.0, 2.0), (1.5, 2.5)])
+        assert type(found[(1.0, 2.0)]) == int and type(found[(1.5, 2.5)]) == float
+
+    def test_persistent(self, cache, path):
+        cache.put([((1.0, 2.0), 10)])
+        other = ElevationCache(path)
+        assert other.get([(1.0, 2.0)]) == {(1.0, 2.0): 10}
+        other.close()
+
+    def test_lru_eviction(self, cache):
+        cache.put([((float(x), 0.0), x) for x in range(3)])
+        cache.get([(0.0, 0.0)])
+        cache.put([((3.0, 0.0), 3)])
+        assert len(cache) == 3
+        assert cache.get([(float(x), 0.0) for x in range(4)]) == {(0.0, 0.0): 0, (2.0, 0.0): 2, (3.0, 0.0): 3}
+
+    def test_many_points(self, path):
+        cache = ElevationCache(path)
+        points = [(x / 1000, 1.0) for x in range(2 * ElevationCache.BATCH_SIZE + 1)]
+        cache.put([(p, p[0]) for p in points])
+        assert cache.get(points) == {p: p[0] for p in points}
+        cache.close()
@@ -0,0 +1,117 @@
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+
+from ElevationProvider import ElevationProvider, DEMProvider, HGTTile, GeoTIFFTile
+
+
+def write_hgt(path, data):
+    np.asarray(data, dtype='>i2').tofile(str(path))
+
+
+def write_geotiff(path, data, left, top, scale, nodata=None):
+    '''Minimal little endian, single strip, PixelIsArea GeoTIFF'''
+    data = np.asarray(data, dtype='<f4')
+    height, width = data.shape
+    extra = b''
+    entries = []
+    data_offset = 8
+    extra_offset = data_offset + data.nbytes
+
+    def add(tag, _type, values, fmt):
+        nonlocal extra
+        packed = struct.pack('<' + fmt * len(values), *values)
+        if len(packed) <= 4:
+            entries.append(struct.pack('<HHI', tag, _type, len(values)) + packed.ljust(4, b'\x00'))
+        else:
+            entries.append(struct.pack('<HHII', tag, _type, len(values), extra_offset + len(extra)))
+            extra += packed
+
+    add(256, 4, [width], 'I')
+    add(257, 4, [height], 'I')
+    add(258, 3, [32], 'H')
+    add(259, 3, [1], 'H')
+    add(273, 4, [data_offset], 'I')
+    add(277, 3, [1], 'H')
+    add(279, 4, [data.nbytes], 'I')
+    add(339, 3, [3], 'H')
+    add(33550, 12, [scale, scale, 0.0], 'd')
+    add(33922, 12, [0.0, 0.0, 0.0, left, top, 0.0], 'd')
+    if nodata is not None:
+        text = '{}\x00'.format(nodata).encode('ascii')
+        entries.append(struct.pack('<HHII', 42113, 2, len(text), extra_offset + len(extra)))
+        extra += text
+    ifd_offset = extra_offset + len(extra)
+    with open(str(path), 'wb') as f:
+        f.write(b'II*\x00' + struct.pack('<I', ifd_offset))
+        f.write(data.tobytes())
+        f.write(extra)
+        f.write(struct.pack('<H', len(entries)) + b''.join(entries) + struct.pack('<I', 0))
+
+
+class TestElevationProvider(object):
+
+    def test_not_implemented(self):
+        with pytest.raises(NotImplementedError):
+            ElevationProvider().get_heights([(1, 1)])
+
+
+class TestDEMProvider(object):
+
+    @pytest.fixture
+    def hgt_dir(self, tmpdir):
+        # 3x3 samples, 0.5 degree apart, rows from north to south
+        write_hgt(tmpdir.join('N50E017.hgt'), [[300, 400, 500], [200, 300, 400], [100, 200, HGTTile.NODATA]])
+        write_hgt(tmpdir.join('S01W001.hgt'), [[1, 1], [1, 1]])
+        tmpdir.join('readme.txt').write('not a tile')
+        return str(tmpdir)
+
+    @pytest.mark.parametrize('point, expected',
+        (((17.0, 51.0), 300),
+         ((17.0, 50.0), 100),
+         ((17.5, 50.5), 300),
+         ((17.25, 50.75), 300),
+         ((17.25, 50.5), 250),
+         ((17.0, 50.25), 150),
+         ((17.75, 50.25), 300),
+         ((18.0, 50.0), None),
+         ((18.5, 50.5), None),
+         ((-0.5, -0.5), 1),
+         ((17.5, None), None)))
+    def test_hgt(self, hgt_dir, point, expected):
+        assert DEMProvider(hgt_dir).get_heights([point]) == [expected]
+
+    def test_many_points(self, hgt_dir):
+        provider = DEMProvider(hgt_dir)
+        assert provider.get_heights([(17.0, 51.0), (-0.5, -0.5), (17.5, 50.5)]) == [300, 1, 300]
+        assert provider.get_heights([]) == []
+        # whole metres, written as services' heights are
+        assert [type(h) for h in provider.get_heights([(17.25, 50.6), (17.0, 51.0)])] == [int, int]
+
+    def test_concurrent(self, hgt_dir):
+        provider = DEMProvider(hgt_dir, max_open_tiles=1)
+        points = [(17.0, 51.0), (-0.5, -0.5)] * 50
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda p: provider.get_heights([p]), points))
+        assert results == [[300], [1]] * 50
+        assert len(provider.open_tiles) == 1
+
+    def test_tile_lru(self, hgt_dir):
+        provider = DEMProvider(hgt_dir, max_open_tiles=1)
+        provider.get_heights([(17.0, 51.0)])
+        provider.get_heights([(-0.5, -0.5)])
+        assert len(provider.open_tiles) == 1
+        assert list(provider.open_tiles)[0].endswith('S01W001.hgt')
+
+    def test_invalid_hgt(self, tmpdir):
+        tmpdir.join('N00E000.hgt').write_binary(b'\x00' * 6)
+        with pytest.raises(ValueError):
+            DEMProvider(str(tmpdir)).get_heights([(0.5, 0.5)])
+
+    def test_geotiff(self, tmpdir):
+        write_geotiff(tmpdir.join('dem.tif'), [[10, 20], [30, -9999]], left=17.0, top=51.0, scale=0.5, nodata=-9999)
+        provider = DEMProvider(str(tmpdir))
+        assert GeoTIFFTile.bounds(str(tmpdir.join('dem.tif'))) == (17.25, 50.25, 17.75, 50.75)
+        assert provider.get_heights([(17.25, 50.75), (17.5, 50.75), (17.25, 50.5), (17.75, 50.25), (17.0, 51.0)]) == \
+            [10, 15, 20, None, None]
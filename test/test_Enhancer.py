@@ -6,9 +6,14 @@ import urllib
 from collections import OrderedDict
 from unittest.mock import Mock, patch, call
 
+from ElevationCache import ElevationCache
 from Enhancer import Enhancer
-from TrainingDocument import TCXDocument, GPXDocument
-from utils import _normalized_float
+from TrainingDocument import TCXDocument, GPXDocument, StreamingTCXDocument, StreamingGPXDocument, TTBinDocument, \
+    CSVDocument
+from QueryPlanner import QueryPlanner
+from Simplifier import Simplifier
+from SpatialIndex import SpatialIndex
+from utils import _normalized_float, _encode_polyline, _decode_polyline
 
 class TestUtils(object):
 
@@ -22,6 +27,17 @@ class TestUtils(object):
     def test_normalized_float(self, value, expected):
         assert _normalized_float(value) == expected
 
+    @pytest.mark.parametrize('points, precision, expected',
+        (([(-120.2, 38.5), (-120.95, 40.7), (-126.453, 43.252)], 5, '_p~iF~ps|U_ulLnnqC_mqNvxq`@'),
+         ([], 6, '')))
+    def test_polyline(self, points, precision, expected):
+        assert _encode_polyline(points, precision) == expected
+        assert _decode_polyline(expected, precision) == points
+
+    def test_polyline_precision(self):
+        points = [(17.123456, 51.654321), (-0.000001, 0.1)]
+        assert _decode_polyline(_encode_polyline(points)) == points
+
 
 class TestEnhancer(object):
 
@@ -41,10 +57,22 @@ class TestEnhancer(object):
 
     @pytest.mark.parametrize('format, expected',
     (('TCX', TCXDocument), ('tcx', TCXDocument), ('other', TCXDocument),
-    ('GPX', GPXDocument), ('gpx',GPXDocument)))
+    ('GPX', GPXDocument), ('gpx',GPXDocument), ('csv', CSVDocument)))
     def test_document_factory(self, enhancer, format, expected):
         assert type(enhancer._document_factory(format)) == expected
 
+    @pytest.mark.parametrize('format, expected',
+    (('TCX', StreamingTCXDocument), ('other', StreamingTCXDocument), ('gpx', StreamingGPXDocument)))
+    def test_document_factory_streaming(self, enhancer, format, expected):
+        enhancer.streaming = True
+        assert type(enhancer._document_factory(format)) == expected
+
+    @pytest.mark.parametrize('output, expected', (('out.tcx', 'tcx'), ('out.GPX', 'gpx'), (None, 'tcx')))
+    def test_document_factory_ttbin(self, output, expected):
+        enhancer = Enhancer('activity.ttbin', output, 'key')
+        assert type(enhancer.document) == TTBinDocument
+        assert enhancer.document.output_format == expected
+
     @patch.object(TCXDocument, 'parse')
     @patch.object(TCXDocument, 'get_coordinates')
     def test_parse(self, get_coordinates_mock, parse_mock, enhancer):
@@ -129,7 +157,7 @@ class TestEnhancer(object):
     @pytest.fixture
     def response(self, jsn):
         response = Mock(spec=requests.Response)
-        response.json = Mock(return_value=jsn)
+        response.content = json.dumps(jsn).encode('utf-8')
         response.ok = True
         return response
 
@@ -144,7 +172,8 @@ class TestEnhancer(object):
 
     @patch.object(Enhancer, '_check_thresholds', return_value=0)
     def test_get_altitudes(self, check_mock, enhancer, points_with_heights, response):
-        with patch.object(Enhancer, '_get_responses', return_value=[response, response]) as get_resp_mock:
+        points = list(points_with_heights)
+        with patch.object(Enhancer, '_get_responses', return_value=[(points, response)] * 2) as get_resp_mock:
             enhancer.get_altitudes()
             assert check_mock.call_count == 1
             assert get_resp_mock.call_count == 1
@@ -153,7 +182,7 @@ class TestEnhancer(object):
 
     @patch.object(Enhancer, '_check_thresholds', return_value=1)
     def test_get_altitudes_err_response(self, check_mock, enhancer, err_response):
-        with patch.object(Enhancer, '_get_responses', return_value=[err_response]) as get_resp_mock:
+        with patch.object(Enhancer, '_get_responses', return_value=[([], err_response)]) as get_resp_mock:
             enhancer.get_altitudes()
             assert check_mock.call_count == 1
             assert get_resp_mock.call_count == 1
@@ -162,7 +191,7 @@ class TestEnhancer(object):
 
     @patch.object(Enhancer, '_check_thresholds', return_value=1)
     def test_get_altitudes_wrong_response(self, check_mock, enhancer, wrong_jsn_response):
-        with patch.object(Enhancer, '_get_responses', return_value=[wrong_jsn_response]) as get_resp_mock:
+        with patch.object(Enhancer, '_get_responses', return_value=[([], wrong_jsn_response)]) as get_resp_mock:
             enhancer.get_altitudes()
             assert check_mock.call_count == 1
             assert get_resp_mock.call_count == 1
@@ -177,3 +206,261 @@ class TestEnhancer(object):
             assert get_resp_mock.call_count == 1
             assert enhancer.coordinates == OrderedDict()
             assert enhancer.document.append_altitudes.call_count == 0
+
+    def test_get_altitudes_cached(self, enhancer, points_with_heights, response):
+        cached = list(points_with_heights.keys())[0]
+        enhancer.coordinates = OrderedDict((k, None) for k in points_with_heights.keys())
+        enhancer.cache = Mock()
+        enhancer.cache.get = Mock(return_value={cached: 1000})
+        with patch.object(Enhancer, '_get_responses', return_value=[(list(points_with_heights), response)]), \
+                patch.object(Enhancer, '_check_thresholds', return_value=0):
+            enhancer.get_altitudes()
+        assert len(list(enhancer._build_request_urls())) == 0
+        enhancer.cache.get.assert_called_once_with(list(points_with_heights.keys()))
+        assert enhancer.cache.put.call_count == 1
+        assert enhancer.coordinates == points_with_heights
+        assert enhancer.metrics.counters['cache_hits'] == 1
+        assert enhancer.metrics.counters['points_resolved'] == len(points_with_heights)
+        assert set(enhancer.metrics.stages) == {'fetch', 'append_altitudes'}
+
+    def test_cold_and_warm_cache(self, tmpdir, gpx_file):
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [119] * len(points))
+        outputs = []
+        for run in ('cold', 'warm'):
+            cache = ElevationCache(str(tmpdir.join('cache.sqlite')))
+            Enhancer(gpx_file, str(tmpdir.join(run + '.gpx')), None, provider=provider, cache=cache).enhance()
+            cache.close()
+            outputs.append(tmpdir.join(run + '.gpx').read_binary())
+        assert provider.get_heights.call_args_list[1] == call([])
+        assert b'<ele>119</ele>' in outputs[0]
+        assert outputs[0] == outputs[1]
+
+    def test_build_request_urls_cached(self, enhancer, test_key):
+        enhancer.coordinates = OrderedDict((((1, 1), 10), ((1, 2), None)))
+        assert list(enhancer._build_request_urls()) == \
+        ['http://elevation.mapzen.com/height?json={}&api_key={}'.\
+        format(urllib.parse.quote_plus('{"shape": [{"lat": 2, "lon": 1}]}'), test_key)]
+
+    def test_build_request_urls_nearby(self, enhancer, test_key):
+        # the same requests as fetched, without points resolved from known heights next to them
+        enhancer.coordinates = OrderedDict((((1, 1), 10), ((1, 1.00001), None), ((1, 2), None)))
+        enhancer.spatial = SpatialIndex(5)
+        enhancer.spatial.add((1, 1), 10)
+        assert list(enhancer._build_request_urls()) == \
+        ['http://elevation.mapzen.com/height?json={}&api_key={}'.\
+        format(urllib.parse.quote_plus('{"shape": [{"lat": 2, "lon": 1}]}'), test_key)]
+        assert enhancer.coordinates[(1, 1.00001)] == 10
+
+    def test_resume_from_checkpoint(self, tmpdir, tcx_file):
+        checkpoint = tmpdir.join('checkpoint')
+        checkpoint.write('[[17.0, 51.1, 100]]\n')
+        provider = Mock()
+        provider.get_heights = Mock(return_value=[120])
+        enhancer = Enhancer(tcx_file, str(tmpdir.join('out.tcx')), None, provider=provider,
+                            checkpoint=str(checkpoint))
+        enhancer.parse()
+        enhancer.get_altitudes()
+        provider.get_heights.assert_called_once_with([(17.0002, 51.1001)])
+        assert checkpoint.read().splitlines() == ['[[17.0, 51.1, 100]]', '[[17.0002, 51.1001, 120]]']
+        enhancer.write()
+        assert not checkpoint.exists()
+
+    @pytest.mark.parametrize('streaming', (False, True))
+    def test_incremental(self, tmpdir, tcx_file, streaming):
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [100] * len(points))
+        for input, output in (('sample.tcx', 'first.tcx'), ('first.tcx', 'second.tcx')):
+            enhancer = Enhancer(str(tmpdir.join(input)), str(tmpdir.join(output)), None, provider=provider,
+                                streaming=streaming, incremental=True)
+            enhancer.parse()
+            enhancer.get_altitudes()
+            enhancer.write()
+        assert provider.get_heights.call_args_list == [call([(17.0, 51.1), (17.0002, 51.1001)]), call([])]
+        assert tmpdir.join('second.tcx').read_binary() == tmpdir.join('first.tcx').read_binary()
+        assert tmpdir.join('first.tcx').read().count('<AltitudeMeters>100</AltitudeMeters>') == 4
+
+    def test_get_altitudes_simplified(self, enhancer):
+        enhancer.simplifier = Simplifier(5)
+        enhancer.document.store = None
+        enhancer.coordinates = OrderedDict(((17 + x * 0.0001, 51.0), None) for x in range(5))
+        enhancer.provider = Mock()
+        enhancer.provider.get_heights = Mock(return_value=[10, 50])
+        with patch('builtins.print'):
+            enhancer.get_altitudes()
+        enhancer.provider.get_heights.assert_called_once_with([(17.0, 51.0), (17.0004, 51.0)])
+        assert list(enhancer.coordinates.values()) == [10, 20, 30, 40, 50]
+
+    def test_get_altitudes_simplified_track_order(self, tmpdir):
+        # out and back, then north: the way back passes the same points again
+        out = [(17 + x * 0.0001, 51.0) for x in range(5)]
+        north = [(17.0, 51.0 + y * 0.0001) for y in range(1, 3)]
+        track = out + out[-2::-1] + north
+        input = tmpdir.join('track.csv')
+        input.write('lon,lat\n' + ''.join('{},{}\n'.format(*p) for p in track))
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [int(p[0] * 1e4 - 170000) * 10 + 100 for p in points])
+        enhancer = Enhancer(str(input), str(tmpdir.join('out.csv')), None, provider=provider)
+        enhancer.simplifier = Mock(wraps=Simplifier(5))
+        enhancer.simplifier.error = 0
+        enhancer.parse()
+        with patch('builtins.print'):
+            enhancer.get_altitudes()
+        assert enhancer.simplifier.simplify.call_args[0][0] == track
+        assert enhancer.simplifier.interpolate.call_args[0][0] == track
+        # the turn and the ends are asked for, points between them are interpolated along the track
+        assert provider.get_heights.call_args[0][0] == [out[0], out[-1], north[-1]]
+        assert [enhancer.coordinates[p] for p in out] == [100, 110, 120, 130, 140]
+
+    @pytest.fixture
+    def many_points(self):
+        return OrderedDict(((17 + x * 0.0001, 51 + x * 0.0001), None) for x in range(1000))
+
+    def test_plan_chunks(self, enhancer, many_points):
+        points = list(many_points.keys())
+        points = points + [(lon + 1, lat) for lon, lat in points]
+        enhancer.chunk_size = 300
+        enhancer.max_request_bytes = 10 ** 6
+        assert [len(c) for c in enhancer._plan_chunks(points)] == [300] * 6 + [200]
+        enhancer.planner = QueryPlanner()
+        chunks = list(enhancer._plan_chunks(points))
+        # no chunk spans both tiles
+        assert [len(c) for c in chunks] == [300, 300, 300, 100] * 2
+        assert sorted(sum(chunks, [])) == sorted(points)
+        assert len(set(int(lon) for lon, _ in chunks[3])) == 1
+
+    def test_provider_query_order(self, tmpdir, gpx_file):
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [int(p[0] * 10000) for p in points])
+        enhancer = Enhancer(gpx_file, str(tmpdir.join('out.gpx')), None, provider=provider, query_order='zorder')
+        enhancer.enhance()
+        queried = provider.get_heights.call_args[0][0]
+        assert queried == enhancer.planner.ordered(list(enhancer.coordinates))
+        assert all(enhancer.coordinates[p] == int(p[0] * 10000) for p in queried)
+
+    @pytest.mark.parametrize('payload, method', (('json', 'GET'), ('polyline', 'GET'), ('json', 'POST')))
+    def test_size_chunks(self, enhancer, many_points, payload, method):
+        enhancer.payload = payload
+        enhancer.method = method
+        enhancer.max_request_bytes = 2000
+        chunks = list(enhancer._size_chunks(list(many_points.keys())))
+        assert len(chunks) > 1
+        assert sum(chunks, []) == list(many_points.keys())
+        for chunk in chunks:
+            assert enhancer._request_size(enhancer._build_request(chunk)) <= 2000
+
+    def test_size_chunks_chunk_size(self, enhancer, many_points):
+        enhancer.chunk_size = 10
+        enhancer.payload = 'polyline'
+        assert [len(c) for c in enhancer._size_chunks(list(many_points.keys()))] == [10] * 100
+
+    def test_build_request_post_polyline(self, enhancer, test_key):
+        enhancer.payload = 'polyline'
+        enhancer.method = 'POST'
+        request = enhancer._build_request([(-120.2, 38.5), (-120.95, 40.7)])
+        assert request.method == 'POST'
+        assert request.url == 'http://elevation.mapzen.com/height?api_key={}'.format(test_key)
+        assert json.loads(request.data) == {'encoded_polyline': _encode_polyline([(-120.2, 38.5), (-120.95, 40.7)])}
+
+    @pytest.mark.parametrize('decoder', ('orjson', 'json'))
+    def test_store_response(self, enhancer, decoder):
+        points = [(17.12345, 51.12345), (17.2, 51.2)]
+        enhancer.coordinates = OrderedDict((p, None) for p in points)
+        # heights are matched by position, whatever the service echoes
+        resp = Mock(ok=True, content=b'{"encoded_polyline": "?", "height": [100, 110.5]}')
+        with patch('Enhancer.orjson', pytest.importorskip('orjson') if decoder == 'orjson' else None):
+            enhancer._store_response(resp, points)
+            assert list(enhancer.coordinates.values()) == [100, 110.5]
+            enhancer._store_response(Mock(ok=True, content=b'{"height": [1]}'), points)
+        assert list(enhancer.coordinates.values()) == [100, 110.5]
+        assert enhancer.metrics.counters['mismatched_responses'] == 1
+
+    def test_get_responses_too_large(self, enhancer, many_points):
+        def fetch(reqs):
+            for request in reqs:
+                future = Mock()
+                resp = Mock(spec=requests.Response)
+                resp.status_code = 414 if len(request) > 3000 else 200
+                future.result = Mock(return_value=resp)
+                yield future
+        enhancer.coordinates = many_points
+        enhancer.max_request_bytes = 10000
+        enhancer.fetcher = Mock()
+        enhancer.fetcher.map = Mock(side_effect=fetch)
+        responses = list(enhancer._get_responses())
+        assert all(r.status_code == 200 for _, r in responses)
+        assert sum((points for points, _ in responses), []) == list(many_points)
+        assert enhancer.max_request_bytes < 3000
+
+    @pytest.mark.parametrize('streaming, format', ((False, 'tcx'), (True, 'tcx'), (False, 'gpx'), (True, 'gpx')))
+    def test_enhance_pipelined(self, request, tmpdir, streaming, format):
+        input = request.getfixturevalue(format + '_file')
+        progress = []
+        def fetch(reqs):
+            for url in reqs:
+                progress.append(len(enhancer.coordinates))
+                shape = json.loads(urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)['json'][0])['shape']
+                resp = Mock(spec=requests.Response, ok=True, status_code=200)
+                resp.content = json.dumps({'shape': shape, 'height': [p['lon'] * 10 for p in shape]}).encode('utf-8')
+                future = Mock()
+                future.result = Mock(return_value=resp)
+                yield future
+        outputs = []
+        for pipelined in (False, True):
+            output = str(tmpdir.join('{}.{}'.format(pipelined, format)))
+            enhancer = Enhancer(input, output, 'key', streaming=streaming, chunk_size=1)
+            enhancer.fetcher = Mock()
+            enhancer.fetcher.map = Mock(side_effect=fetch)
+            if pipelined:
+                enhancer.enhance()
+            else:
+                enhancer.parse()
+                enhancer.get_altitudes()
+                enhancer.write()
+            outputs.append(tmpdir.join('{}.{}'.format(pipelined, format)).read_binary())
+        assert outputs[0] == outputs[1]
+        assert b'170.002' in outputs[1]
+        # the first request was built when only the first point had been read
+        assert progress[2:] == [1, 2]
+
+    def test_enhance_pipelined_cached(self, tmpdir):
+        input = tmpdir.join('track.csv')
+        points = [(17 + i / 1000, 51 + i / 1000) for i in range(200)]
+        input.write('lon,lat\n' + ''.join('{},{}\n'.format(*p) for p in points))
+        sent = []
+        def fetch(reqs):
+            for url in reqs:
+                shape = json.loads(urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)['json'][0])['shape']
+                sent.append(len(shape))
+                yield Mock(result=Mock(return_value=Mock(ok=True, status_code=200, content=json.dumps(
+                    {'height': [120] * len(shape)}).encode('utf-8'))))
+        requests_sent = []
+        for pipelined in (False, True):
+            cache = ElevationCache(str(tmpdir.join('{}.sqlite'.format(pipelined))))
+            cache.put({p: 100 for p in points[::2]}.items())
+            enhancer = Enhancer(str(input), str(tmpdir.join('out.csv')), 'key', cache=cache, chunk_size=10)
+            enhancer.fetcher = Mock(map=Mock(side_effect=fetch))
+            del sent[:]
+            if pipelined:
+                enhancer.enhance()
+            else:
+                enhancer.parse()
+                enhancer.get_altitudes()
+            cache.close()
+            requests_sent.append(list(sent))
+        # cached points are dropped before requests are cut, so that every request is full
+        assert requests_sent[0] == requests_sent[1] == [10] * 10
+
+    def test_enhance_csv(self, tmpdir):
+        input = tmpdir.join('track.csv')
+        input.write_binary(b'lat,lon\n51.1,17.0\n,\n51.1001,17.0002\n')
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [p[0] * 10 for p in points])
+        for options in ({}, {'provider': provider}):
+            output = tmpdir.join('out.csv')
+            enhancer = Enhancer(str(input), str(output), 'key', **options)
+            enhancer.fetcher = Mock()
+            enhancer.fetcher.map = Mock(side_effect=lambda reqs: [Mock(result=Mock(return_value=Mock(
+                ok=True, status_code=200, content=b'{"height": [170.0, 170.002]}'))) for _ in reqs])
+            enhancer.enhance()
+            assert output.read_binary() == b'lat,lon,altitude\n51.1,17.0,170.0\n,,170.0\n51.1001,17.0002,170.002\n'
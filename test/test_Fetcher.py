@@ -0,0 +1,102 @@
+import time
+import pytest
+import requests
+from unittest.mock import Mock, patch, call
+
+from Fetcher import Fetcher, TokenBucket
+
+
+class TestTokenBucket(object):
+
+    def test_unlimited(self):
+        bucket = TokenBucket(0)
+        with patch('time.sleep') as sleep_mock:
+            for _ in range(100):
+                bucket.acquire()
+            assert sleep_mock.call_count == 0
+
+    def test_burst(self):
+        bucket = TokenBucket(1, burst=3)
+        with patch('time.sleep') as sleep_mock:
+            for _ in range(3):
+                bucket.acquire()
+            assert sleep_mock.call_count == 0
+
+    def test_rate(self):
+        bucket = TokenBucket(50, burst=1)
+        start = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        assert time.monotonic() - start >= 0.09
+
+    def test_pause(self):
+        bucket = TokenBucket(0)
+        bucket.pause(0.05)
+        start = time.monotonic()
+        bucket.acquire()
+        assert time.monotonic() - start >= 0.04
+
+
+class TestFetcher(object):
+
+    def response(self, status_code, headers=None):
+        response = Mock(spec=requests.Response)
+        response.status_code = status_code
+        response.headers = headers or {}
+        response.content = b'{}'
+        return response
+
+    @pytest.fixture
+    def session(self):
+        return Mock(spec=requests.Session)
+
+    @pytest.fixture
+    def fetcher(self, session):
+        return Fetcher(workers=3, rate=0, session=session)
+
+    def test_map_keeps_order(self, fetcher, session):
+        responses = [self.response(200) for _ in range(6)]
+        def get(url, timeout):
+            time.sleep(0.01 * (5 - int(url)))
+            return responses[int(url)]
+        session.get = Mock(side_effect=get)
+        urls = [str(x) for x in range(6)]
+        assert [f.result() for f in fetcher.map(urls)] == responses
+        assert session.get.call_count == 6
+
+    def test_map_exception(self, fetcher, session):
+        session.get = Mock(side_effect=[ValueError('error')])
+        (future,) = list(fetcher.map(['url']))
+        with pytest.raises(ValueError):
+            future.result()
+
+    @pytest.mark.parametrize('headers, expected', (({'Retry-After': '3'}, 3), ({}, Fetcher.BACKOFF)))
+    def test_fetch_retries_429(self, fetcher, session, headers, expected):
+        ok = self.response(200)
+        session.get = Mock(side_effect=[self.response(429, headers), ok])
+        with patch.object(fetcher.bucket, 'pause') as pause_mock:
+            assert fetcher.fetch('url') is ok
+            pause_mock.assert_called_once_with(expected)
+        assert session.get.call_args_list == [call('url', timeout=Fetcher.TIMEOUT)] * 2
+
+    def test_fetch_gives_up(self, fetcher, session):
+        too_many = self.response(429, {'Retry-After': '0'})
+        session.get = Mock(return_value=too_many)
+        assert fetcher.fetch('url') is too_many
+        assert session.get.call_count == Fetcher.MAX_RETRIES + 1
+
+    def test_fetch_request(self, fetcher, session):
+        ok = self.response(200)
+        session.request = Mock(return_value=ok)
+        request = requests.Request('POST', 'url', data='body', headers={'Content-Type': 'application/json'})
+        assert fetcher.fetch(request) is ok
+        session.request.assert_called_once_with('POST', 'url', data='body',
+                                                headers={'Content-Type': 'application/json'}, timeout=Fetcher.TIMEOUT)
+
+    def test_saturated(self, fetcher):
+        assert not fetcher.saturated()
+        fetcher.bucket.waiting = fetcher.workers + 1
+        assert fetcher.saturated()
+        fetcher.bucket.waiting = 0
+        fetcher.bucket.pause(10)
+        assert fetcher.saturated()
@@ -0,0 +1,115 @@
+import gzip
+import threading
+import time
+import pytest
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+from Enhancer import enhance_bytes
+from HTTPService import EnhancerService
+
+
+class TestEnhancerService(object):
+
+    @pytest.fixture
+    def provider(self):
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [100] * len(points))
+        return provider
+
+    @pytest.fixture
+    def service(self, provider):
+        service = EnhancerService(None, provider=provider, jobs=2)
+        yield service
+        service.stop()
+
+    def url(self, service, path='/enhance'):
+        return 'http://127.0.0.1:{}{}'.format(service.port, path)
+
+    @pytest.mark.parametrize('streaming', (False, True))
+    def test_enhance(self, provider, tcx_file, gpx_file, streaming):
+        service = EnhancerService(None, provider=provider, streaming=streaming)
+        service.start()
+        try:
+            for source, content_type in ((tcx_file, 'application/vnd.garmin.tcx+xml'),
+                                         (gpx_file, 'application/gpx+xml')):
+                with open(source, 'rb') as f:
+                    data = f.read()
+                with ThreadPoolExecutor(4) as executor:
+                    responses = list(executor.map(lambda body: requests.post(self.url(service), data=body),
+                                                  [data, gzip.compress(data)] * 2))
+                for resp in responses:
+                    assert resp.status_code == 200
+                    assert resp.headers['Content-Type'] == content_type
+                    assert resp.content == enhance_bytes(data, provider=provider)
+        finally:
+            service.stop()
+        assert service.metrics.counters['uploads_enhanced'] == 8
+
+    def test_errors(self, service):
+        service.start()
+        assert requests.post(self.url(service), data=b'<gpx').status_code == 400
+        assert requests.get(self.url(service)).status_code == 405
+        assert requests.get(self.url(service, '/other')).status_code == 404
+        metrics = requests.get(self.url(service, '/metrics'))
+        assert 'enhancer_uploads_failed_total 1' in metrics.text
+
+    def test_queue_full(self, provider, tcx_file):
+        release = threading.Event()
+        provider.get_heights = Mock(side_effect=lambda points: release.wait() and [100] * len(points))
+        service = EnhancerService(None, provider=provider, jobs=1, queue_size=1)
+        service.start()
+        with open(tcx_file, 'rb') as f:
+            data = f.read()
+        try:
+            with ThreadPoolExecutor(2) as executor:
+                running = executor.submit(requests.post, self.url(service), data=data)
+                while provider.get_heights.call_count == 0:
+                    time.sleep(0.01)
+                waiting = executor.submit(requests.post, self.url(service), data=data)
+                while service.waiting == 0:
+                    time.sleep(0.01)
+                refused = requests.post(self.url(service), data=data)
+                assert refused.status_code == 503
+                assert refused.headers['Retry-After'] == str(EnhancerService.RETRY_AFTER)
+                release.set()
+                assert running.result().status_code == waiting.result().status_code == 200
+        finally:
+            release.set()
+            service.stop()
+
+    def test_more_uploads_than_jobs(self, provider, tcx_file):
+        release = threading.Event()
+        provider.get_heights = Mock(side_effect=lambda points: release.wait() and [100] * len(points))
+        service = EnhancerService(None, provider=provider, jobs=2)
+        service.start()
+        with open(tcx_file, 'rb') as f:
+            data = f.read()
+        try:
+            with ThreadPoolExecutor(5) as executor:
+                uploads = [executor.submit(requests.post, self.url(service), data=data) for _ in range(5)]
+                while service.waiting < 3:
+                    time.sleep(0.01)
+                release.set()
+                assert [upload.result().status_code for upload in uploads] == [200] * 5
+        finally:
+            release.set()
+            service.stop()
+        assert service.metrics.counters['uploads_enhanced'] == 5
+
+    def test_saturated_backend(self, service, tcx_file):
+        service.start()
+        with open(tcx_file, 'rb') as f:
+            data = f.read()
+        with patch.object(service.fetcher, 'saturated', side_effect=[True, True, False]) as saturated:
+            assert requests.post(self.url(service), data=data).status_code == 200
+            assert saturated.call_count == 3
+
+
+    def test_enhance_bytes(self, provider, tcx_file):
+        with open(tcx_file, 'rb') as f:
+            data = f.read()
+        enhanced = enhance_bytes(gzip.compress(data), provider=provider)
+        # track points without position get the altitude of the previous one
+        assert enhanced.count(b'<AltitudeMeters>100</AltitudeMeters>') == 4
@@ -0,0 +1,72 @@
+import json
+import pytest
+import requests
+from unittest.mock import Mock
+
+from Fetcher import Fetcher
+from Metrics import Histogram, Metrics
+
+
+class TestMetrics(object):
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            histogram.observe(value)
+        assert histogram.cumulative() == [(1, 2), (2, 3), (float('inf'), 4)]
+        assert histogram.sum == 6
+        assert histogram.count == 4
+
+    def test_record(self):
+        metrics = Metrics()
+        events = []
+        metrics.add_hook(lambda kind, name, value: events.append((kind, name)))
+        with metrics.stage('parse'):
+            pass
+        with metrics.stage('parse'):
+            pass
+        metrics.count('requests')
+        metrics.count('requests', 2)
+        metrics.observe('request_seconds', 0.2)
+        assert metrics.stages['parse'] >= 0
+        assert metrics.counters == {'requests': 3}
+        assert metrics.histograms['request_seconds'].count == 1
+        assert events == [('stage', 'parse'), ('stage', 'parse'), ('counter', 'requests'), ('counter', 'requests'),
+                          ('histogram', 'request_seconds')]
+
+    def test_stage_exception(self):
+        metrics = Metrics()
+        with pytest.raises(ValueError):
+            with metrics.stage('write'):
+                raise ValueError()
+        assert 'write' in metrics.stages
+
+    def test_write(self, tmpdir):
+        metrics = Metrics()
+        metrics.stages['fetch'] = 1.5
+        metrics.count('requests', 3)
+        metrics.observe('request_seconds', 0.2)
+        metrics.write(str(tmpdir.join('metrics.json')))
+        data = json.loads(tmpdir.join('metrics.json').read())
+        assert data['stages'] == {'fetch': 1.5}
+        assert data['counters'] == {'requests': 3}
+        assert data['histograms']['request_seconds']['buckets']['0.25'] == 1
+        metrics.write(str(tmpdir.join('metrics.prom')))
+        lines = tmpdir.join('metrics.prom').read().splitlines()
+        assert 'enhancer_stage_seconds{stage="fetch"} 1.5' in lines
+        assert 'enhancer_requests_total 3' in lines
+        assert 'enhancer_request_seconds_bucket{le="0.1"} 0' in lines
+        assert 'enhancer_request_seconds_bucket{le="+Inf"} 1' in lines
+        assert 'enhancer_request_seconds_count 1' in lines
+        assert tmpdir.listdir(lambda p: p.ext == '.tmp') == []
+
+    def test_fetcher(self):
+        too_many = Mock(spec=requests.Response, status_code=429, headers={'Retry-After': '0'}, content=b'')
+        ok = Mock(spec=requests.Response, status_code=200, headers={}, content=b'1234')
+        session = Mock(spec=requests.Session)
+        session.get = Mock(side_effect=[too_many, ok])
+        fetcher = Fetcher(rate=0, session=session)
+        fetcher.fetch('url')
+        assert fetcher.metrics.counters == {'requests': 2, 'bytes_sent': 6, 'bytes_received': 4,
+                                            'throttled': 1, 'retries': 1, 'backoff_seconds': 0}
+        assert fetcher.metrics.histograms['request_seconds'].count == 2
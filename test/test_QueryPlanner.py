@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from QueryPlanner import QueryPlanner, hilbert_index, zorder_index
+
+
+class TestCurves(object):
+    cells = np.array([(x, y) for x in range(8) for y in range(8)])
+
+    @pytest.mark.parametrize('curve', (hilbert_index, zorder_index))
+    def test_covers_grid(self, curve):
+        assert sorted(curve(self.cells[:, 0], self.cells[:, 1], 3).tolist()) == list(range(64))
+
+    def test_hilbert_steps_to_neighbours(self):
+        order = np.argsort(hilbert_index(self.cells[:, 0], self.cells[:, 1], 3))
+        steps = np.abs(np.diff(self.cells[order], axis=0)).sum(axis=1)
+        assert (steps == 1).all()
+
+    def test_zorder(self):
+        assert zorder_index([1, 0, 1, 2], [0, 1, 1, 0], 2).tolist() == [1, 2, 3, 4]
+
+
+class TestQueryPlanner(object):
+    # out and back: the way back passes the same places in reverse order, then a point in the next tile
+    out = [(17.0 + i / 1000, 51.0) for i in range(10)]
+    points = out + [(lon, lat + 0.00001) for lon, lat in reversed(out)] + [(18.2, 51.0)]
+
+    @pytest.mark.parametrize('curve', ('hilbert', 'zorder'))
+    def test_groups(self, curve):
+        groups = list(QueryPlanner(curve).groups(self.points))
+        assert [len(g) for g in groups] == [20, 1]
+        assert sorted(groups[0]) == sorted(self.points[:20])
+        # both passes of every place are next to each other
+        ordered = groups[0]
+        assert all(abs(a[0] - b[0]) < 0.0015 for a, b in zip(ordered[::2], ordered[1::2]))
+
+    def test_ordered(self):
+        planner = QueryPlanner()
+        assert sorted(planner.ordered(self.points)) == sorted(self.points)
+        assert planner.ordered([]) == []
+        assert list(planner.groups([])) == []
+
+    def test_unknown_curve(self):
+        with pytest.raises(ValueError):
+            QueryPlanner('peano')
@@ -0,0 +1,82 @@
+import pytest
+from unittest.mock import Mock
+
+from Enhancer import Enhancer
+from Segments import SegmentedEnhancer, split_activities
+
+
+@pytest.fixture
+def provider():
+    provider = Mock()
+    provider.get_heights = Mock(side_effect=lambda points: [int(p[1] * 1e6) % 1000 for p in points])
+    return provider
+
+
+@pytest.fixture
+def activities_file(tmpdir, tcx_file):
+    '''Sample TCX with three activities, the second one starting with a track point without position'''
+    with open(tcx_file, 'rb') as f:
+        content = f.read()
+    start, end = content.index(b'<Activity '), content.index(b'</Activity>') + len(b'</Activity>')
+    activity = content[start:end]
+    second = activity.replace(b'51.100001', b'51.200001').replace(b'<Track>', b'<Track>\n          <Trackpoint>'
+                                                                  b'<Time>2017-01-02T09:59:59Z</Time></Trackpoint>')
+    third = activity.replace(b'51.100101', b'51.300101')
+    path = tmpdir.join('activities.tcx')
+    path.write_binary(content[:end] + b'\n    ' + second + b'\n    <!-- third -->\n    ' + third + content[end:])
+    return str(path)
+
+
+class TestSegments(object):
+
+    def test_broken_activity(self, tmpdir, activities_file, provider):
+        path = tmpdir.join('broken.tcx')
+        with open(activities_file, 'rb') as f:
+            data = f.read()
+        second = data.index(b'<Activity ', data.index(b'</Activity>'))
+        path.write_binary(data[:second] + data[second:].replace(b'</Id>', b'</Idd>', 1))
+        with pytest.raises(ValueError, match='Idd'):
+            SegmentedEnhancer(str(path), str(tmpdir.join('out.tcx')), None, processes=2, provider=provider).enhance()
+
+    def test_split_activities(self, activities_file):
+        with open(activities_file, 'rb') as f:
+            data = f.read()
+        bounds, documents = split_activities(data)
+        assert len(bounds) == len(documents) == 3
+        assert all(data[s:e].startswith(b'<Activity ') and data[s:e].endswith(b'</Activity>') for s, e in bounds)
+        assert documents[1].endswith(b'</Activities></TrainingCenterDatabase>')
+        assert documents[0].endswith(data[bounds[-1][1]:])
+
+    def test_not_split(self, tcx_file):
+        with open(tcx_file, 'rb') as f:
+            data = f.read()
+        assert split_activities(data) is None
+        assert split_activities(data.replace(b'</Activity>', b'</Activity><Activity>')) is None
+        latin = data.replace(b'encoding="UTF-8"', b'encoding="ISO-8859-2"')
+        assert split_activities(latin.replace(b'</Activities>', b'<Activity/></Activities>')) is None
+
+    @pytest.mark.parametrize('processes', (1, 2))
+    def test_enhance(self, tmpdir, activities_file, provider, processes):
+        Enhancer(activities_file, str(tmpdir.join('whole.tcx')), None, provider=provider).enhance()
+        enhancer = SegmentedEnhancer(activities_file, str(tmpdir.join('split.tcx')), None, processes=processes,
+                                     provider=provider)
+        enhancer.enhance()
+        assert tmpdir.join('split.tcx').read_binary() == tmpdir.join('whole.tcx').read_binary()
+        # points of all activities are fetched in one go
+        assert provider.get_heights.call_count == 2
+        assert len(provider.get_heights.call_args[0][0]) == 4
+        assert enhancer.metrics.stages['parse'] > 0
+
+    def test_single_activity(self, tmpdir, tcx_file, provider):
+        SegmentedEnhancer(tcx_file, str(tmpdir.join('split.tcx')), None, provider=provider).enhance()
+        Enhancer(tcx_file, str(tmpdir.join('whole.tcx')), None, provider=provider).enhance()
+        assert tmpdir.join('split.tcx').read_binary() == tmpdir.join('whole.tcx').read_binary()
+
+    def test_failure(self, tmpdir, activities_file, provider):
+        with open(activities_file, 'rb') as f:
+            data = f.read()
+        with open(activities_file, 'wb') as f:
+            f.write(data.replace(b'<Id>', b'<Id><Broken>', 1))
+        with pytest.raises(Exception):
+            SegmentedEnhancer(activities_file, str(tmpdir.join('split.tcx')), None, processes=2,
+                              provider=provider).enhance()
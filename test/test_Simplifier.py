@@ -0,0 +1,36 @@
+import pytest
+
+from Simplifier import Simplifier
+
+
+class TestSimplifier(object):
+
+    @pytest.fixture
+    def line(self):
+        # ~11 m steps east, with a ~55 m spike in the middle
+        points = [(17 + x * 0.0001, 51.0) for x in range(11)]
+        points[5] = (17.0005, 51.0005)
+        return points
+
+    @pytest.mark.parametrize('tolerance, expected', ((100, [0, 10]), (10, [0, 4, 5, 6, 10])))
+    def test_simplify(self, line, tolerance, expected):
+        simplifier = Simplifier(tolerance)
+        assert simplifier.simplify(line).tolist() == expected
+        assert simplifier.error <= tolerance
+
+    def test_simplify_error(self, line):
+        simplifier = Simplifier(100)
+        simplifier.simplify(line)
+        assert 50 < simplifier.error < 60
+
+    @pytest.mark.parametrize('points', ([], [(1, 1)], [(1, 1), (1, 1)]))
+    def test_simplify_short(self, points):
+        assert Simplifier(1).simplify(points).tolist() == list(range(len(points)))
+
+    def test_interpolate(self):
+        points = [(17 + x * 0.0001, 51.0) for x in range(5)]
+        assert Simplifier(1).interpolate(points, [None, 10, None, None, 40]) == [10, 10, 20, 30, 40]
+
+    @pytest.mark.parametrize('heights', ([None, None], [1, 2]))
+    def test_interpolate_nothing(self, heights):
+        assert Simplifier(1).interpolate([(1, 1), (2, 2)], heights) == heights
@@ -0,0 +1,135 @@
+import json
+import math
+import urllib
+import pytest
+import requests
+from unittest.mock import Mock
+
+from ElevationCache import ElevationCache
+from Enhancer import Enhancer
+from SpatialIndex import METRES_PER_DEGREE, SpatialIndex
+
+
+class TestSpatialIndex(object):
+    # about one metre to the north
+    step = 1 / METRES_PER_DEGREE
+
+    def test_height(self):
+        index = SpatialIndex(5)
+        index.update([((17.0, 51.0), 100), ((17.0, 51.0 + 4 * self.step), 110), ((17.0, 51.1), 500),
+                      ((17.0, 51.2), None), ((None, None), 100)])
+        assert len(index) == 3
+        assert index.height((17.0, 51.0)) == 100
+        assert index.height((17.0, 51.0 + 2 * self.step)) == 105
+        assert index.height((17.0, 51.0 - 4 * self.step)) == 100
+        assert index.height((17.0, 51.0 - 6 * self.step)) is None
+        assert index.height((None, None)) is None
+        assert index.resolve([(17.0, 51.0 + self.step), (17.0, 51.05)]) == {(17.0, 51.0 + self.step): 101}
+
+    @pytest.mark.parametrize('latitude', (0.0, 60.0, -75.0))
+    def test_longitudes(self, latitude):
+        # four metres to the east spans more cells far from the equator
+        index = SpatialIndex(5)
+        east = 4 * self.step / math.cos(math.radians(latitude))
+        index.add((17.0 + east, latitude), 100.5)
+        assert index.height((17.0, latitude)) == 100.5
+        assert index.height((17.0 - 2 * east, latitude)) is None
+
+    def test_bounds(self):
+        index = SpatialIndex(5)
+        assert index.bounds([(None, None)]) is None
+        left, bottom, right, top = index.bounds([(17.0, 51.0), (17.1, 51.1)])
+        assert left < 17.0 and bottom < 51.0 and right > 17.1 and top > 51.1
+
+    def test_cache_within(self, tmpdir):
+        cache = ElevationCache(str(tmpdir.join('cache.sqlite')))
+        cache.put([((17.0, 51.0), 100), ((18.0, 51.0), 200)])
+        assert cache.within(16.5, 50.5, 17.5, 51.5) == [((17.0, 51.0), 100)]
+        cache.close()
+
+    @pytest.mark.parametrize('streaming', (False, True))
+    def test_enhancer(self, tmpdir, tcx_file, streaming):
+        # an earlier track passed two metres away from the first point of the sample
+        cache = ElevationCache(str(tmpdir.join('cache.sqlite')))
+        cache.put([((17.000001, 51.100001 + 2 * self.step), 120)])
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [100] * len(points))
+        enhancer = Enhancer(tcx_file, str(tmpdir.join('out.tcx')), None, provider=provider, cache=cache,
+                            streaming=streaming, reuse_radius=5)
+        enhancer.enhance()
+        assert provider.get_heights.call_args[0][0] == [(17.0002, 51.1001)]
+        assert enhancer.metrics.counters['nearby_hits'] == 1
+        assert list(enhancer.coordinates.values()) == [120, 100]
+        cache.close()
+
+    def test_pipelined_laps(self, tmpdir, tcx_file):
+        # the last point repeats the first one a metre away, by then the first one is known
+        with open(tcx_file) as f:
+            content = f.read()
+        last = content.rindex('51.100001')
+        with open(tcx_file, 'w') as f:
+            f.write(content[:last] + '51.100010' + content[last + len('51.100001'):])
+        sent = []
+        def fetch(reqs):
+            for url in reqs:
+                shape = json.loads(urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)['json'][0])['shape']
+                sent.extend(shape)
+                resp = Mock(spec=requests.Response, ok=True, status_code=200)
+                resp.content = json.dumps({'shape': shape, 'height': [100] * len(shape)}).encode('utf-8')
+                yield Mock(result=Mock(return_value=resp))
+        enhancer = Enhancer(tcx_file, str(tmpdir.join('out.tcx')), 'key', chunk_size=1, reuse_radius=5)
+        enhancer.fetcher = Mock(map=Mock(side_effect=fetch))
+        enhancer.enhance()
+        assert len(sent) == 2
+        assert list(enhancer.coordinates.values()) == [100, 100, 100]
+
+    def _fetch(self, sent):
+        def fetch(reqs):
+            for url in reqs:
+                shape = json.loads(urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)['json'][0])['shape']
+                sent.append(len(shape))
+                resp = Mock(spec=requests.Response, ok=True, status_code=200)
+                resp.content = json.dumps({'height': [100] * len(shape)}).encode('utf-8')
+                yield Mock(result=Mock(return_value=resp))
+        return Mock(map=Mock(side_effect=fetch))
+
+    @pytest.mark.parametrize('pipelined', (False, True))
+    def test_laps(self, tmpdir, pipelined):
+        # the second lap runs three metres north of the first one, 22 metres between points
+        input = tmpdir.join('track.csv')
+        input.write('lon,lat\n' + ''.join('17.0,{:.5f}\n'.format(51.0 + i * 0.0002 + offset)
+                                          for offset in (0, 0.00003) for i in range(50)))
+        sent = []
+        enhancer = Enhancer(str(input), str(tmpdir.join('out.csv')), 'key', chunk_size=10, reuse_radius=5)
+        enhancer.fetcher = self._fetch(sent)
+        if pipelined:
+            enhancer.enhance()
+        else:
+            enhancer.parse()
+            enhancer.get_altitudes()
+        assert sent == [10] * 5
+        assert enhancer.metrics.counters['nearby_hits'] == 50
+        assert set(enhancer.coordinates.values()) == {100}
+
+    @pytest.mark.parametrize('pipelined', (False, True))
+    def test_resolved_route(self, tmpdir, pipelined):
+        # an earlier track passed two metres away from every other point
+        route = [(17.0, 51.0 + 20 * i * self.step) for i in range(60)]
+        cache = ElevationCache(str(tmpdir.join('cache.sqlite')))
+        cache.put([((lon, lat + 2 * self.step), 120) for lon, lat in route[::2]])
+        input = tmpdir.join('route.csv')
+        input.write('lon,lat\n' + ''.join('{!r},{!r}\n'.format(*p) for p in route))
+        sent = []
+        enhancer = Enhancer(str(input), str(tmpdir.join('out.csv')), 'key', cache=cache, chunk_size=10,
+                            reuse_radius=5)
+        enhancer.fetcher = self._fetch(sent)
+        if pipelined:
+            enhancer.enhance()
+        else:
+            enhancer.parse()
+            enhancer.get_altitudes()
+        cache.close()
+        # resolved points are dropped before requests are cut, so that every request is full
+        assert sent == [10] * 3
+        assert enhancer.metrics.counters['nearby_hits'] == 30
+        assert list(enhancer.coordinates.values()) == [120, 100] * 30
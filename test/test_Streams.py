@@ -0,0 +1,93 @@
+import bz2
+import gzip
+import io
+import lzma
+import pytest
+from unittest.mock import Mock
+
+from Enhancer import Enhancer
+from Streams import guess_format, open_input, open_output, split_compression, spool
+from TrainingDocument import StreamingGPXDocument
+from utils import _extension, _output_name
+
+
+class Pipe(io.RawIOBase):
+    '''Stream which can be read only once, like standard input'''
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.data.readinto(b)
+
+
+class TestStreams(object):
+
+    @pytest.mark.parametrize('compress', (lambda d: d, gzip.compress, bz2.compress, lzma.compress))
+    def test_open_input(self, tmpdir, compress):
+        path = tmpdir.join('input.bin')
+        path.write_binary(compress(b'content'))
+        with open_input(str(path)) as f:
+            assert f.read() == b'content'
+        source = io.BytesIO(compress(b'content'))
+        source.read()
+        with open_input(source) as f:
+            assert f.read() == b'content'
+        assert not source.closed
+        with open_input(Pipe(compress(b'content'))) as f:
+            assert f.read() == b'content'
+
+    @pytest.mark.parametrize('name, decompress', (('out.tcx', lambda d: d), ('out.tcx.gz', gzip.decompress),
+                                                  ('out.tcx.bz2', bz2.decompress), ('out.tcx.xz', lzma.decompress)))
+    def test_open_output(self, tmpdir, name, decompress):
+        with open_output(str(tmpdir.join(name))) as f:
+            f.write(b'content')
+        assert decompress(tmpdir.join(name).read_binary()) == b'content'
+        target = io.BytesIO()
+        with open_output(target, compression=split_compression(name)[1]) as f:
+            f.write(b'content')
+        assert decompress(target.getvalue()) == b'content'
+
+    def test_names(self):
+        assert split_compression('a.tcx.GZ') == ('a.tcx', 'gzip')
+        assert split_compression('a.gpx') == ('a.gpx', None)
+        assert _extension('a.ttbin.xz') == '.ttbin'
+        assert _output_name('a.ttbin.xz') == 'a.tcx.xz'
+        assert _output_name('a.gpx.gz') == 'a.gpx.gz'
+
+    def test_guess_format(self, tmpdir, tcx_file, gpx_file):
+        # content wins over misleading names
+        path = tmpdir.join('track.tcx.gz')
+        with open(gpx_file, 'rb') as f:
+            path.write_binary(gzip.compress(f.read()))
+        assert guess_format(str(path)) == 'gpx'
+        with open(tcx_file, 'rb') as f:
+            assert guess_format(io.BytesIO(f.read())) == 'tcx'
+        assert guess_format(io.BytesIO(b'\x20\x07\x00' + b'\x00' * 100)) == 'ttbin'
+        assert guess_format(str(tmpdir.join('missing.gpx'))) == 'gpx'
+        assert guess_format(io.BytesIO(b'time;Latitude;Longitude\r\n0;51.1;17.0\r\n')) == 'csv'
+        assert guess_format(io.BytesIO(b'latency,lonely\n')) is None
+
+    def test_spool(self):
+        spooled = spool(Pipe(b'content'))
+        assert spooled.read() == b'content'
+        with open_input(spooled) as f:
+            assert f.read() == b'content'
+
+    def test_enhancer(self, tmpdir, gpx_file):
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [100] * len(points))
+        Enhancer(gpx_file, str(tmpdir.join('plain.gpx')), None, provider=provider).enhance()
+        output = io.BytesIO()
+        with open(gpx_file, 'rb') as f:
+            source = Pipe(bz2.compress(f.read()))
+        enhancer = Enhancer(source, output, None, provider=provider,
+                            streaming=True)
+        assert isinstance(enhancer.document, StreamingGPXDocument)
+        enhancer.enhance()
+        assert output.getvalue() == tmpdir.join('plain.gpx').read_binary()
+        Enhancer(gpx_file, str(tmpdir.join('out.gpx.gz')), None, provider=provider).enhance()
+        assert gzip.decompress(tmpdir.join('out.gpx.gz').read_binary()) == output.getvalue()
@@ -0,0 +1,82 @@
+import os
+import pytest
+from unittest.mock import Mock, patch
+
+from Enhancer import Enhancer
+from TrackSidecar import TrackSidecar
+from TrackStore import TrackStore
+from TrainingDocument import TCXDocument
+
+
+class TestTrackSidecar(object):
+
+    @pytest.fixture
+    def store(self):
+        store = TrackStore()
+        for lon, lat, time in (('17.0', '51.1', 10.0), (None, None, 11.0), ('17.1', '51.2', float('nan'))):
+            store.add(lon, lat, time=time)
+        return store.finish()
+
+    def test_save_load(self, tcx_file, store):
+        sidecar = TrackSidecar(tcx_file)
+        assert sidecar.load() is None
+        sidecar.save(store, {(17.0, 51.1): 100}, [0, 2])
+        loaded, altitudes, lap_starts = TrackSidecar(tcx_file).load()
+        assert list(loaded.keys()) == list(store.keys())
+        assert list(loaded.indices) == [0, -1, 1]
+        assert list(loaded.times)[0:2] == [10.0, 11.0]
+        assert altitudes == [100, None]
+        assert lap_starts == [0, 2]
+
+    def test_source_changed(self, tcx_file, store):
+        sidecar = TrackSidecar(tcx_file)
+        sidecar.save(store, {}, [0])
+        stat = os.stat(tcx_file)
+        with open(tcx_file, 'r+b') as f:
+            f.write(b'<?xml version="1.1"')
+        os.utime(tcx_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assert sidecar.load() is None
+
+    def test_corrupted(self, tcx_file):
+        sidecar = TrackSidecar(tcx_file)
+        with open(sidecar.path, 'wb') as f:
+            f.write(b'garbage')
+        assert sidecar.load() is None
+
+    def test_enhancer(self, tmpdir, tcx_file):
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [100] * len(points))
+        for output in ('first.tcx', 'second.tcx'):
+            enhancer = Enhancer(tcx_file, str(tmpdir.join(output)), None, provider=provider, sidecar=True)
+            enhancer.enhance()
+        assert provider.get_heights.call_count == 2
+        assert provider.get_heights.call_args[0][0] == []
+        assert enhancer.metrics.counters['sidecar_hits'] == 1
+        assert tmpdir.join('second.tcx').read_binary() == tmpdir.join('first.tcx').read_binary()
+        enhancer = Enhancer(tcx_file, None, None, sidecar=True)
+        with patch.object(TCXDocument, '_get_position') as position_mock:
+            enhancer.parse()
+            assert position_mock.call_count == 0
+        assert list(enhancer.coordinates.values()) == [100, 100]
+        assert len(enhancer.document.store.times) == 4
+
+    @pytest.mark.parametrize('streaming', (False, True))
+    def test_enhancer_deferred_parse(self, tmpdir, tcx_file, streaming):
+        provider = Mock()
+        provider.get_heights = Mock(side_effect=lambda points: [100] * len(points))
+        Enhancer(tcx_file, str(tmpdir.join('first.tcx')), None, provider=provider, sidecar=True).enhance()
+        enhancer = Enhancer(tcx_file, str(tmpdir.join('second.tcx')), None, provider=provider, sidecar=True,
+                            streaming=streaming)
+        document = type(enhancer.document)
+        # the document is read only to be written, lap starts come from the sidecar
+        with patch.object(document, 'parse', autospec=True, side_effect=document.parse) as parse_mock, \
+                patch.object(document, 'get_lap_starts', autospec=True) as lap_starts_mock:
+            enhancer.parse()
+            enhancer.get_altitudes()
+            analysis = enhancer.analyze()
+            assert parse_mock.call_count == 0
+            enhancer.write()
+            assert parse_mock.call_count == 1
+            assert lap_starts_mock.call_count == 0
+        assert [(lap['start'], lap['points']) for lap in analysis.laps] == [(0, 4)]
+        assert tmpdir.join('second.tcx').read_binary() == tmpdir.join('first.tcx').read_binary()
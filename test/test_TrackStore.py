@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from collections import OrderedDict
+
+from TrackStore import TrackStore
+
+
+class TestTrackStore(object):
+
+    @pytest.fixture
+    def store(self):
+        store = TrackStore()
+        for position in (('17.000001', '51.1'), ('17.1', '51.2'), (None, '51.2'), ('17.0', '51.100004'),
+                         ('x', '51'), ('17.3', '51.3')):
+            store.add(*position)
+        return store.finish()
+
+    def test_add(self, store):
+        assert len(store) == 3
+        assert list(store.indices) == [0, 1, -1, 0, -1, 2]
+        assert list(store.keys()) == [(17.0, 51.1), (17.1, 51.2), (17.3, 51.3)]
+
+    @pytest.mark.parametrize('limit, expected', ((0, 3), (2, 2), (5, 3)))
+    def test_coordinates(self, store, limit, expected):
+        coordinates = store.coordinates(limit)
+        assert type(coordinates) == OrderedDict
+        assert list(coordinates.items()) == [(k, None) for k in list(store.keys())[0:expected]]
+
+    def test_altitudes(self, store):
+        assert store.altitudes({(17.0, 51.1): 100, (17.3, 51.3): 0}) == [100, None, 0]
+
+    def test_add_columns(self, store):
+        columns = TrackStore()
+        nan = float('nan')
+        columns.add_columns(np.array([17.0, 17.1, nan]), np.array([51.1, 51.2, 51.2]), np.array([nan, 120.5, nan]))
+        columns.add_columns(np.array([17.0, nan, 17.3]), np.array([51.1, 51.0, 51.3]), np.array([100, nan, 130]))
+        assert list(columns.finish().indices) == list(store.indices)
+        assert list(columns.keys()) == list(store.keys())
+        assert list(columns.coordinates().values()) == [100, 120.5, 130]
+
+    def test_heights(self):
+        store = TrackStore()
+        for position in (('17.0', '51.1', None), ('17.1', '51.2', '120.5'), ('17.0', '51.1', '100'),
+                         ('17.1', '51.2', '130'), ('17.2', '51.2', 'x')):
+            store.add(*position)
+        assert list(store.finish().coordinates().values()) == [100, 120.5, None]
@@ -0,0 +1,36 @@
+import os
+import sys
+import pytest
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark'))
+from generate import generate
+from server import ElevationServer, height
+from Enhancer import Enhancer
+
+
+class TestBenchmark(object):
+
+    @pytest.fixture
+    def server(self):
+        server = ElevationServer(throttle=0.5, max_url=2000).start()
+        yield server
+        server.stop()
+
+    @pytest.mark.parametrize('format', ['tcx', 'gpx'])
+    def test_enhance(self, tmpdir, server, format):
+        input, output = str(tmpdir.join('in.' + format)), str(tmpdir.join('out.' + format))
+        generate(input, format, 300)
+        enh = Enhancer(input, output, 'key', rate=0)
+        enh.API_URL = server.url
+        enh.fetcher.max_retries = 20
+        enh.parse()
+        assert len(enh.coordinates) == 300
+        enh.get_altitudes()
+        enh.write()
+        assert server.stats['throttled'] > 0
+        assert server.stats['rejected'] > 0
+        assert server.stats['points'] == 300
+        assert all(alt == height(*point) for point, alt in enh.coordinates.items())
+        altitudes = [e for e in etree.parse(output).iter() if etree.QName(e).localname in ('AltitudeMeters', 'ele')]
+        assert len(altitudes) == 300
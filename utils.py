@@ -1,5 +1,93 @@
+import os
+from datetime import datetime
+
+import numpy as np
+
+from Streams import split_compression
+
+
 def _normalized_float(value, round_digits=5):
     try:
         return round(float(value), round_digits)
-    except ValueError:
+    except (TypeError, ValueError):
         return None
+
+
+def _normalized_floats(values, round_digits=5):
+    '''`_normalized_float` of every item of NumPy array `values`, NaN where they are not finite'''
+    values = np.where(np.isfinite(values), values, np.nan)
+    scale = 10.0 ** round_digits
+    scaled = values * scale
+    result = np.rint(scaled) / scale
+    # the product may be rounded across a half, the few values next to one are rounded as `round` does
+    near = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    result[near] = [round(v, round_digits) for v in values[near].tolist()]
+    return result
+
+
+def _timestamp(text):
+    '''Seconds since epoch of ISO 8601 time `text` as used by TCX and GPX, NaN if it is not one'''
+    try:
+        return datetime.fromisoformat(text.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return float('nan')
+
+
+def _extension(name):
+    '''Lower case extension of file `name`, ignoring compression suffix (`.tcx` for `a.tcx.gz`)'''
+    return os.path.splitext(split_compression(name)[0])[1].lower()
+
+
+def _output_name(name):
+    '''File name of enhanced `name`, TomTom .ttbin activities are written as TCX, compressed ones stay compressed'''
+    uncompressed = split_compression(name)[0]
+    base, extension = os.path.splitext(uncompressed)
+    return base + '.tcx' + name[len(uncompressed):] if extension.lower() == '.ttbin' else name
+
+
+def _polyline_value(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    chars = []
+    while value >= 0x20:
+        chars.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chars.append(chr(value + 63))
+    return ''.join(chars)
+
+
+def _polyline_point(point, prev=None, precision=6):
+    '''Encoded polyline fragment of (longitude, latitude) `point` following `prev` point'''
+    factor = 10 ** precision
+    prev = prev or (0, 0)
+    return _polyline_value(int(round(point[1] * factor)) - int(round(prev[1] * factor))) + \
+        _polyline_value(int(round(point[0] * factor)) - int(round(prev[0] * factor)))
+
+
+def _encode_polyline(points, precision=6):
+    prev = None
+    chars = []
+    for p in points:
+        chars.append(_polyline_point(p, prev, precision))
+        prev = p
+    return ''.join(chars)
+
+
+def _decode_polyline(encoded, precision=6):
+    '''Decodes polyline into list of (longitude, latitude) tuples'''
+    factor = 10 ** precision
+    values = []
+    value, shift = 0, 0
+    for c in encoded:
+        byte = ord(c) - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    points = []
+    lat, lon = 0, 0
+    for i in range(0, len(values) - 1, 2):
+        lat += values[i]
+        lon += values[i + 1]
+        points.append((lon / factor, lat / factor))
+    return points